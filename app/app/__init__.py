@@ -2,6 +2,22 @@ import os
 from pyramid.config import Configurator
 from sqlalchemy import engine_from_config
 from .models import Session, Base
+from . import wrs2, cache, jobfeed, profiling, views
+
+
+# Pool settings, as db.<name>, and the engine arguments they set.
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+def pool_options(settings):
+    """
+    Return the connection pool sizes set for a Postgres database. SQLite
+    keeps the pool SQLAlchemy picks for it.
+    """
+    if not (settings.get('sqlalchemy.url') or '').startswith('postgresql'):
+        return {}
+    return dict((name, int(settings['db.' + name])) for name in POOL_OPTIONS
+                if 'db.' + name in settings)
 
 
 def main(global_config, **settings):
@@ -9,11 +25,17 @@ def main(global_config, **settings):
     Configure and return a WSGI application.
     """
     settings['sqlalchemy.url'] = os.environ.get('DATABASE_URL')
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    engine = engine_from_config(settings, 'sqlalchemy.',
+                                **pool_options(settings))
     Session.configure(bind=engine)
     Base.metadata.bind = engine
+    wrs2.configure(settings)
+    cache.configure(settings)
+    jobfeed.configure(settings, engine)
+    views.configure(settings)
     config = Configurator(settings=settings)
     config.include('pyramid_jinja2')
+    profiling.configure(config, settings, engine)
     config.add_static_view('static', 'static', cache_max_age=3600)
 
     # Define routes
@@ -27,5 +49,10 @@ def main(global_config, **settings):
     config.add_route('scene_options_ajax', 'scene_options_ajax/')
     config.add_route('status_poll', 'status_poll/')
     config.add_route('preview_poll', 'preview_poll/')
+    config.add_route('jobs_poll', 'jobs_poll/')
+    config.add_route('status_stream', 'status_stream/')
+    config.add_route('cache_stats', 'cache_stats/')
+    config.add_route('metrics', 'metrics/')
+    config.add_route('route_stats', 'route_stats/')
     config.scan()
     return config.make_wsgi_app()
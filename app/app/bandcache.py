@@ -0,0 +1,168 @@
+"""
+On-disk cache of downloaded band files, shared by the worker processes of
+a box.
+
+Files are keyed by scene and band. Fills are written under a temporary name
+and renamed into place, and an exclusive flock on a per-file lock makes
+concurrent requests for the same band, from any thread or process, wait
+for a single download. The cache is held to a byte budget by evicting the
+least recently used files; hits refresh a file's modification time.
+"""
+import os
+import fcntl
+import shutil
+import urllib2
+import threading
+from contextlib import contextmanager
+
+LOCK_SUFFIX = '.lock'
+PARTIAL_SUFFIX = '.part'
+
+
+def download(url, path):
+    """
+    Copy url to path without holding it in memory.
+    """
+    response = urllib2.urlopen(url, timeout=60)
+    try:
+        with open(path, 'wb') as out:
+            shutil.copyfileobj(response, out, 1 << 20)
+    finally:
+        response.close()
+
+
+@contextmanager
+def flocked(path):
+    """
+    Hold an exclusive lock on path, creating it if needed.
+    """
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class BandCache(object):
+    """
+    Band files under directory, at most max_bytes of them.
+    """
+
+    def __init__(self, directory, max_bytes, fetch=download):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fetch = fetch
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, entityid, band):
+        return os.path.join(self.directory,
+                            '{}_B{}.TIF'.format(entityid, band))
+
+    def _hit(self, path):
+        try:
+            os.utime(path, None)
+            size = os.path.getsize(path)
+        except OSError:
+            # Evicted since it was found.
+            return False
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+        return True
+
+    def lookup(self, entityid, band):
+        """
+        Return the path of a cached band, or None without fetching it.
+        """
+        path = self.path(entityid, band)
+        if os.path.exists(path) and self._hit(path):
+            return path
+        return None
+
+    def get(self, entityid, band, url):
+        """
+        Return the path of a band, downloading it from url on a miss.
+        Open the file soon: once other jobs fill the cache past its budget
+        it may be evicted, though open files stay readable.
+        """
+        path = self.lookup(entityid, band)
+        if path is not None:
+            return path
+        path = self.path(entityid, band)
+        with flocked(path + LOCK_SUFFIX):
+            # Another job may have fetched it while we waited.
+            if os.path.exists(path) and self._hit(path):
+                return path
+            partial = '{}.{}.{}{}'.format(path, os.getpid(),
+                                          threading.current_thread().ident,
+                                          PARTIAL_SUFFIX)
+            try:
+                self.fetch(url, partial)
+                os.rename(partial, path)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+            with self._lock:
+                self.misses += 1
+                self.bytes_fetched += os.path.getsize(path)
+        self.evict(keep=path)
+        return path
+
+    def entries(self):
+        """
+        Return (mtime, size, path) of every cached band.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith((LOCK_SUFFIX, PARTIAL_SUFFIX)):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used bands until the cache fits its
+        budget, sparing keep.
+        """
+        with flocked(os.path.join(self.directory, 'evict' + LOCK_SUFFIX)):
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+
+    def stats(self):
+        """
+        Return a dictionary of this process's cache counters.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'bytes_fetched': self.bytes_fetched,
+                'evictions': self.evictions,
+                'bytes': sum(size for _, size, _ in self.entries()),
+                'max_bytes': self.max_bytes}
@@ -0,0 +1,111 @@
+"""
+Per-worker response caches.
+
+Entries expire after a timeout and are dropped wholesale when the stamp file
+is touched, which is how processes that ingest new path_row rows tell every
+web worker that cached scene lists are stale.
+"""
+import os
+import threading
+from repoze.lru import ExpiringLRUCache
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache with a timeout, hit/miss counters and invalidation
+    through the modification time of a stamp file.
+    """
+
+    def __init__(self, size=512, timeout=300, stamp_file=None):
+        self.lru = ExpiringLRUCache(size, default_timeout=timeout)
+        self.stamp_file = stamp_file
+        self.stamp = self._read_stamp()
+        self.invalidations = 0
+        # Bumped by every invalidation, so that values computed before one
+        # are not cached after it.
+        self.generation = 0
+        # ExpiringLRUCache.clear resets its counters, so carry them over.
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def _read_stamp(self):
+        if not self.stamp_file:
+            return None
+        try:
+            return os.stat(self.stamp_file).st_mtime
+        except OSError:
+            return None
+
+    def _check_stamp(self):
+        stamp = self._read_stamp()
+        if stamp != self.stamp:
+            with self._lock:
+                if stamp != self.stamp:
+                    self.stamp = stamp
+                    self.invalidate()
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None. Read generation after a
+        miss and pass it to put along with the value computed.
+        """
+        self._check_stamp()
+        return self.lru.get(key)
+
+    def put(self, key, value, generation=None):
+        """
+        Cache value under key, unless the cache has been invalidated since
+        generation, when the value was computed from data now stale.
+        """
+        self._check_stamp()
+        with self._lock:
+            if generation is None or generation == self.generation:
+                self.lru.put(key, value)
+
+    def invalidate(self):
+        """
+        Drop every cached entry.
+        """
+        self._hits += self.lru.hits
+        self._misses += self.lru.misses
+        self.lru.clear()
+        self.invalidations += 1
+        self.generation += 1
+
+    def stats(self):
+        """
+        Return a dictionary of cache counters.
+        """
+        hits = self._hits + self.lru.hits
+        misses = self._misses + self.lru.misses
+        lookups = hits + misses
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': float(hits) / lookups if lookups else 0.0,
+                'evictions': self.lru.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self.lru.data),
+                'maxsize': self.lru.size}
+
+
+def touch_stamp(stamp_file):
+    """
+    Mark every worker's cache as stale by updating the stamp file.
+    """
+    with open(stamp_file, 'a'):
+        os.utime(stamp_file, None)
+
+
+scene_options_cache = ResponseCache()
+
+
+def configure(settings):
+    """
+    Size the scene options cache from the app settings.
+    """
+    global scene_options_cache
+    scene_options_cache = ResponseCache(
+        size=int(settings.get('scene_cache.size', 512)),
+        timeout=int(settings.get('scene_cache.timeout', 300)),
+        stamp_file=settings.get('scene_cache.stamp_file'))
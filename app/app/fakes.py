@@ -0,0 +1,300 @@
+"""
+In-memory stand-ins for the AWS services the app talks to, for tests,
+benchmarks and local load testing without an AWS account.
+"""
+import time
+import socket
+import threading
+from itertools import count
+
+
+class FakeMessage(object):
+    """
+    Message with the parts of boto.sqs.message.Message the app uses.
+    """
+
+    def __init__(self, queue, body, message_attributes=None):
+        self.queue = queue
+        self.body = body
+        self.message_attributes = message_attributes or {}
+        self.receipt_handle = None
+        self.visible_at = 0
+        self.receives = 0
+
+    def get_body(self):
+        return self.body
+
+
+class FakeQueue(object):
+    """
+    Queue with the parts of boto.sqs.queue.Queue the app uses.
+    """
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.messages = []
+
+    def count(self):
+        return len(self.messages)
+
+    def get_messages(self, num_messages=1, visibility_timeout=None,
+                     wait_time_seconds=None, message_attributes=None):
+        return self.connection.receive_message(
+            self, num_messages, visibility_timeout,
+            wait_time_seconds=wait_time_seconds)
+
+
+class FakeSQSConnection(object):
+    """
+    Connection with the parts of boto.sqs.connection.SQSConnection the app
+    uses. Queues spring into existence on first lookup, and every API call
+    is counted in calls. Setting failures makes that many of the following
+    calls fail as if the connection had dropped, and setting batch_errors
+    makes SQS reject that many entries of the following batches. Received
+    messages stay hidden for their visibility timeout and come back unless
+    deleted, as on SQS.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.calls = []
+        self.failures = 0
+        self.batch_errors = 0
+        self._lock = threading.Lock()
+        self._received = threading.Condition(self._lock)
+        self._handles = count(1)
+
+    def _call(self, name):
+        with self._lock:
+            self.calls.append(name)
+            if self.failures:
+                self.failures -= 1
+                raise socket.error('connection reset by fake')
+
+    def get_queue(self, queue_name):
+        self._call('get_queue')
+        with self._lock:
+            if queue_name not in self.queues:
+                self.queues[queue_name] = FakeQueue(self, queue_name)
+            return self.queues[queue_name]
+
+    def send_message(self, queue, message_content, message_attributes=None):
+        self._call('send_message')
+        message = FakeMessage(queue, message_content, message_attributes)
+        with self._lock:
+            queue.messages.append(message)
+            self._received.notify_all()
+        return message
+
+    def send_message_batch(self, queue, messages):
+        self._call('send_message_batch')
+        result = FakeBatchResults()
+        for entry in messages:
+            with self._lock:
+                reject = self.batch_errors > 0
+                if reject:
+                    self.batch_errors -= 1
+            if reject:
+                result.errors.append({'id': entry[0],
+                                      'sender_fault': 'false',
+                                      'error_code': 'InternalError',
+                                      'error_message': 'Rejected by fake'})
+                continue
+            message = FakeMessage(queue, entry[1],
+                                  entry[3] if len(entry) > 3 else None)
+            with self._lock:
+                queue.messages.append(message)
+                self._received.notify_all()
+            result.results.append({'id': entry[0]})
+        return result
+
+    def receive_message(self, queue, number_messages=1,
+                        visibility_timeout=None, attributes=None,
+                        wait_time_seconds=None, message_attributes=None):
+        self._call('receive_message')
+        deadline = time.time() + (wait_time_seconds or 0)
+        with self._lock:
+            while True:
+                now = time.time()
+                received = [message for message in queue.messages
+                            if message.visible_at <= now][:number_messages]
+                if received or now >= deadline:
+                    break
+                # Wake up for new messages or for the next one to reappear.
+                hidden = [message.visible_at for message in queue.messages]
+                self._received.wait(min([deadline] + hidden) - now)
+            for message in received:
+                message.receipt_handle = 'handle-{}'.format(
+                    next(self._handles))
+                message.visible_at = now + (visibility_timeout or 30)
+                message.receives += 1
+        return received
+
+    def change_message_visibility(self, queue, receipt_handle,
+                                  visibility_timeout):
+        self._call('change_message_visibility')
+        with self._lock:
+            for message in queue.messages:
+                if message.receipt_handle == receipt_handle:
+                    message.visible_at = time.time() + visibility_timeout
+                    return True
+        return False
+
+    def delete_message_from_handle(self, queue, receipt_handle):
+        self._call('delete_message_from_handle')
+        with self._lock:
+            queue.messages = [message for message in queue.messages
+                              if message.receipt_handle != receipt_handle]
+        return True
+
+
+class FakeBatchResults(object):
+    """
+    Result of send_message_batch, as boto.sqs.batchresults.BatchResults.
+    """
+
+    def __init__(self):
+        self.results = []
+        self.errors = []
+
+
+class FakeSQS(object):
+    """
+    Factory with the signature of sqs.make_SQS_connection that hands out a
+    single shared FakeSQSConnection and counts connections made.
+    """
+
+    def __init__(self):
+        self.connection = FakeSQSConnection()
+        self.connects = 0
+
+    def __call__(self, region_name, aws_access_key_id,
+                 aws_secret_access_key):
+        self.connects += 1
+        return self.connection
+
+    def messages(self, queue_name):
+        queue = self.connection.queues.get(queue_name)
+        return queue.messages if queue else []
+
+
+class FakeKey(object):
+    """
+    Key with the parts of boto.s3.key.Key the app uses.
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def set_contents_from_file(self, fp, headers=None, policy=None):
+        self.bucket.connection._call('put_object')
+        self.bucket.objects[self.name] = fp.read()
+
+
+class FakeMultiPartUpload(object):
+    """
+    Upload with the parts of boto.s3.multipart.MultiPartUpload the app
+    uses. Parts take the connection's part_seconds to upload.
+    """
+
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.parts = {}
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        connection = self.bucket.connection
+        connection._call('upload_part')
+        with connection._lock:
+            connection.in_flight += 1
+            connection.max_in_flight = max(connection.max_in_flight,
+                                           connection.in_flight)
+        try:
+            time.sleep(connection.part_seconds)
+            self.parts[part_num] = fp.read(size)
+        finally:
+            with connection._lock:
+                connection.in_flight -= 1
+
+    def complete_upload(self):
+        self.bucket.connection._call('complete_upload')
+        if sorted(self.parts) != range(1, len(self.parts) + 1):
+            raise IOError('parts missing from upload')
+        self.bucket.objects[self.key_name] = ''.join(
+            self.parts[part_num] for part_num in sorted(self.parts))
+        self.bucket.uploads.remove(self)
+
+    def cancel_upload(self):
+        self.bucket.connection._call('cancel_upload')
+        self.bucket.uploads.remove(self)
+
+
+class FakeBucket(object):
+    """
+    Bucket with the parts of boto.s3.bucket.Bucket the app uses. objects
+    maps key names to contents, and uploads lists multipart uploads that
+    are neither completed nor cancelled.
+    """
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.objects = {}
+        self.uploads = []
+
+    def new_key(self, key_name):
+        return FakeKey(self, key_name)
+
+    def initiate_multipart_upload(self, key_name, headers=None,
+                                  policy=None):
+        self.connection._call('initiate_multipart_upload')
+        upload = FakeMultiPartUpload(self, key_name)
+        self.uploads.append(upload)
+        return upload
+
+
+class FakeS3Connection(object):
+    """
+    Connection with the parts of boto.s3.connection.S3Connection the app
+    uses. Buckets spring into existence on first lookup and API calls are
+    counted in calls, as on FakeSQSConnection; max_in_flight is the most
+    parts that were being uploaded at once.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.calls = []
+        self.failures = 0
+        self.part_seconds = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls.append(name)
+            if self.failures:
+                self.failures -= 1
+                raise socket.error('connection reset by fake')
+
+    def get_bucket(self, bucket_name, validate=True):
+        with self._lock:
+            if bucket_name not in self.buckets:
+                self.buckets[bucket_name] = FakeBucket(self, bucket_name)
+            return self.buckets[bucket_name]
+
+
+class FakeS3(object):
+    """
+    Factory with the signature of s3.make_S3_connection that hands out a
+    single shared FakeS3Connection.
+    """
+
+    def __init__(self):
+        self.connection = FakeS3Connection()
+
+    def __call__(self, region_name, aws_access_key_id,
+                 aws_secret_access_key):
+        return self.connection
@@ -0,0 +1,266 @@
+"""
+Bulk load of the AWS Landsat scene list into path_row.
+
+The gzipped CSV is decompressed as it streams in and bulk-loaded into a
+temporary staging table: through COPY on Postgres, in batched INSERTs
+elsewhere. Rows are then merged into path_row in a few set-based
+statements that only touch entities that are new or whose values
+changed, so loading the daily list costs the copy plus the size of the
+delta. The summaries of the path/rows touched are refreshed afterwards.
+"""
+import csv
+import time
+import zlib
+import urllib2
+from datetime import datetime
+from zope.sqlalchemy import mark_changed
+from sqlalchemy import (Table, Column, MetaData, UnicodeText, DateTime, Float,
+                        Integer, select, exists, union, or_)
+
+from models import Session, PathRow, PathRowSummary
+
+SCENE_LIST_URL = 'http://landsat-pds.s3.amazonaws.com/scene_list.gz'
+
+# Bytes read from the source at a time.
+READ_SIZE = 1 << 16
+
+# Rows per INSERT where COPY is not available.
+CHUNK = 1000
+
+# Scene list columns kept in path_row, by their name in the header.
+COLUMNS = [('entityid', UnicodeText), ('acquisitiondate', DateTime),
+           ('cloudcover', Float), ('path', Integer), ('row', Integer),
+           ('min_lat', Float), ('min_lon', Float), ('max_lat', Float),
+           ('max_lon', Float), ('download_url', UnicodeText)]
+TYPES = dict(COLUMNS)
+NAMES = [name for name, _ in COLUMNS]
+
+
+class IngestError(Exception):
+    """
+    Raised when a scene list cannot be loaded.
+    """
+
+
+class SceneListReader(object):
+    """
+    File-like reader of a scene list at a url or path, decompressing it on
+    the fly when it is gzipped.
+    """
+
+    def __init__(self, source):
+        if source.startswith(('http://', 'https://')):
+            self.raw = urllib2.urlopen(source)
+        else:
+            self.raw = open(source, 'rb')
+        self.decompress = None
+        self.buffer = self.raw.read(READ_SIZE)
+        if self.buffer[:2] == '\x1f\x8b':
+            # 16 + MAX_WBITS expects a gzip header and trailer.
+            self.decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.buffer = self.decompress.decompress(self.buffer)
+
+    def _fill(self, size):
+        while len(self.buffer) < size:
+            chunk = self.raw.read(READ_SIZE)
+            if not chunk:
+                if self.decompress is not None:
+                    self.buffer += self.decompress.flush()
+                    self.decompress = None
+                return
+            if self.decompress is not None:
+                chunk = self.decompress.decompress(chunk)
+            self.buffer += chunk
+
+    def read(self, size=-1):
+        """
+        Return up to size bytes of the decompressed list, all with size -1.
+        """
+        if size < 0:
+            self._fill(float('inf'))
+            size = len(self.buffer)
+        else:
+            self._fill(size)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        while '\n' not in self.buffer:
+            before = len(self.buffer)
+            self._fill(before + READ_SIZE)
+            if len(self.buffer) == before:
+                break
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        return self.read(end)
+
+    def __iter__(self):
+        pending = ''
+        while True:
+            chunk = self.read(READ_SIZE)
+            if not chunk:
+                break
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+    def close(self):
+        self.raw.close()
+
+
+def staging_table(header):
+    """
+    Return a temporary table with a column for every field of the header,
+    typed as path_row's for the fields path_row keeps.
+    """
+    names = [name.strip().lower() for name in header]
+    missing = set(NAMES) - set(names)
+    if missing:
+        raise IngestError('scene list lacks {}'.format(
+            ', '.join(sorted(missing))))
+    return Table('path_row_staging', MetaData(), *[
+        Column(name, TYPES.get(name, UnicodeText)) for name in names],
+        prefixes=['TEMPORARY'])
+
+
+def parse_date(value):
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise IngestError('bad acquisition date {!r}'.format(value))
+
+
+def parse(staging, fields):
+    """
+    Convert one CSV record to a staging row.
+    """
+    row = {}
+    for column, value in zip(staging.columns, fields):
+        kind = TYPES.get(column.name, UnicodeText)
+        if kind is DateTime:
+            value = parse_date(value)
+        elif kind is Float:
+            value = float(value)
+        elif kind is Integer:
+            value = int(value)
+        else:
+            value = value.decode('utf-8')
+        row[column.name] = value
+    return row
+
+
+def copy_in(connection, staging, reader):
+    """
+    Bulk load the rest of reader into staging with COPY.
+    """
+    cursor = connection.connection.cursor()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN WITH CSV'.format(
+        staging.name, ', '.join('"{}"'.format(column.name)
+                                for column in staging.columns)), reader)
+    return cursor.rowcount
+
+
+def insert_in(connection, staging, reader):
+    """
+    Load the rest of reader into staging in batched INSERTs.
+    """
+    count = 0
+    batch = []
+    for fields in csv.reader(reader):
+        batch.append(parse(staging, fields))
+        if len(batch) == CHUNK:
+            connection.execute(staging.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        connection.execute(staging.insert(), batch)
+        count += len(batch)
+    return count
+
+
+def merge(connection, staging):
+    """
+    Bring path_row in line with staging and return the number of new and
+    changed entities and the (path, row) pairs touched.
+    """
+    path_row = PathRow.__table__
+    same_entity = path_row.c.entityid == staging.c.entityid
+    changed = or_(*[path_row.c[name] != staging.c[name]
+                    for name in NAMES[1:]])
+    # Staged rows that are new or differ, and where the rows they replace
+    # used to be.
+    touched = connection.execute(union(
+        select([staging.c.path, staging.c.row]).select_from(
+            staging.outerjoin(path_row, same_entity)).where(
+            or_(path_row.c.entityid == None, changed)),
+        select([path_row.c.path, path_row.c.row]).select_from(
+            staging.join(path_row, same_entity)).where(changed))).fetchall()
+    updated = connection.execute(path_row.delete().where(
+        path_row.c.entityid.in_(
+            select([staging.c.entityid]).select_from(
+                staging.join(path_row, same_entity)).where(
+                changed).correlate(None)))
+        ).rowcount
+    inserted = connection.execute(path_row.insert().from_select(
+        NAMES, select([staging.c[name] for name in NAMES]).where(
+            ~exists([path_row.c.entityid]).where(
+                same_entity).correlate_except(path_row)))).rowcount
+    return inserted - updated, updated, [tuple(pair) for pair in touched]
+
+
+class IngestStats(object):
+    """
+    What one ingest did, and how fast.
+    """
+
+    def __init__(self, staged, new, changed, pathrows, load_seconds,
+                 merge_seconds):
+        self.staged = staged
+        self.new = new
+        self.changed = changed
+        self.pathrows = pathrows
+        self.load_seconds = load_seconds
+        self.merge_seconds = merge_seconds
+
+    @property
+    def rows_per_second(self):
+        seconds = self.load_seconds + self.merge_seconds
+        return self.staged / seconds if seconds else float(self.staged)
+
+    def __str__(self):
+        return ('{} rows staged in {:.1f} s, merged in {:.1f} s '
+                '({:.0f} rows/s): {} new, {} changed, {} path/rows '
+                'summarized'.format(self.staged, self.load_seconds,
+                                    self.merge_seconds,
+                                    self.rows_per_second, self.new,
+                                    self.changed, len(self.pathrows)))
+
+
+def ingest(source=SCENE_LIST_URL):
+    """
+    Load the scene list at source, a url or a path, gzipped or not, into
+    path_row and refresh the summaries it changes. Does not commit.
+    """
+    connection = Session.connection()
+    reader = SceneListReader(source)
+    try:
+        start = time.time()
+        staging = staging_table(next(csv.reader([reader.readline()])))
+        staging.create(connection)
+        if connection.dialect.name == 'postgresql':
+            staged = copy_in(connection, staging, reader)
+        else:
+            staged = insert_in(connection, staging, reader)
+        loaded = time.time()
+        new, changed, pathrows = merge(connection, staging)
+        PathRowSummary.refresh(pathrows)
+        staging.drop(connection)
+    finally:
+        reader.close()
+    mark_changed(Session())
+    return IngestStats(staged, new, changed, pathrows, loaded - start,
+                       time.time() - loaded)
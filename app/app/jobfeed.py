@@ -0,0 +1,198 @@
+"""
+Fan job status transitions out to subscribed clients.
+
+Each worker process keeps one change feed, a Postgres LISTEN on the
+job_status channel, and hands every transition to the subscriptions
+interested in that job. Watching jobs therefore costs one connection per
+worker however many clients are subscribed. The feed runs on a background
+thread, which is a greenlet under the gevent worker class.
+"""
+import json
+import time
+import select
+import threading
+from Queue import Queue, Empty
+from pyramid.settings import asbool
+
+CHANNEL = 'job_status'
+
+# Statuses after which a job does not change again.
+FINAL_STATUSES = (5, 10)
+
+# Installed by initialize_app_db. The payload carries the render url so that
+# clients learn where a finished render lives without another query.
+NOTIFY_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION notify_job_status() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' OR NEW.jobstatus IS DISTINCT FROM OLD.jobstatus THEN
+        PERFORM pg_notify('job_status', json_build_object(
+            'jobid', NEW.jobid,
+            'jobstatus', NEW.jobstatus,
+            'renderurl', (SELECT renderurl FROM render_cache
+                          WHERE jobid = NEW.jobid LIMIT 1))::text);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_job_status_notify ON user_job;
+CREATE TRIGGER user_job_status_notify
+    AFTER INSERT OR UPDATE OF jobstatus ON user_job
+    FOR EACH ROW EXECUTE PROCEDURE notify_job_status();
+"""
+
+feed = None
+
+
+class Subscription(object):
+    """
+    A client's interest in a set of jobs. Transitions are queued as
+    (jobid, jobstatus, renderurl) tuples.
+    """
+
+    def __init__(self, jobids):
+        self.jobids = frozenset(jobids)
+        self.queue = Queue()
+
+    def put(self, transition):
+        self.queue.put(transition)
+
+    def get(self, timeout):
+        """
+        Return the next transition, or None after timeout seconds.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class JobFeed(object):
+    """
+    Dispatch transitions from a notifier to subscriptions by jobid.
+    """
+
+    def __init__(self, notifier):
+        self.notifier = notifier
+        self.subscriptions = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """
+        Start the notifier. Called on first subscription, so that it runs in
+        the worker process rather than the gunicorn master.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self.notifier.start(self.publish)
+
+    def subscribe(self, jobids):
+        """
+        Return a new subscription to the given jobids.
+        """
+        self.start()
+        subscription = Subscription(jobids)
+        with self._lock:
+            for jobid in subscription.jobids:
+                self.subscriptions.setdefault(jobid, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for jobid in subscription.jobids:
+                subscriptions = self.subscriptions.get(jobid)
+                if subscriptions is None:
+                    continue
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[jobid]
+
+    def publish(self, jobid, jobstatus, renderurl=None):
+        """
+        Hand a transition to every subscription interested in jobid.
+        """
+        with self._lock:
+            subscriptions = list(self.subscriptions.get(jobid, ()))
+        for subscription in subscriptions:
+            subscription.put((jobid, jobstatus, renderurl))
+
+
+class PostgresNotifier(object):
+    """
+    Listen for job_status notifications on a dedicated connection.
+    """
+
+    def __init__(self, engine, timeout=5, retry_wait=5):
+        self.engine = engine
+        self.timeout = timeout
+        self.retry_wait = retry_wait
+
+    def start(self, publish):
+        thread = threading.Thread(target=self.run, args=(publish,))
+        thread.daemon = True
+        thread.start()
+
+    def connect(self):
+        raw = self.engine.raw_connection()
+        # Keep the LISTEN connection out of the pool for good.
+        raw.detach()
+        conn = raw.connection
+        try:
+            conn.set_isolation_level(0)
+            conn.cursor().execute('LISTEN {}'.format(CHANNEL))
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def run(self, publish):
+        while True:
+            conn = None
+            try:
+                conn = self.connect()
+                while True:
+                    if select.select([conn], [], [], self.timeout)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            notify = conn.notifies.pop(0)
+                            payload = json.loads(notify.payload)
+                            publish(payload['jobid'], payload['jobstatus'],
+                                    payload.get('renderurl'))
+            except Exception as e:
+                print 'Job status feed failed, reconnecting: {}'.format(e)
+                # Detached from the pool, so nothing else will close it.
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                time.sleep(self.retry_wait)
+
+
+class FakeNotifier(object):
+    """
+    Notifier driven by hand, for tests and local development.
+    """
+
+    def __init__(self):
+        self.publish = None
+
+    def start(self, publish):
+        self.publish = publish
+
+    def notify(self, jobid, jobstatus, renderurl=None):
+        self.publish(jobid, jobstatus, renderurl)
+
+
+def configure(settings, engine):
+    """
+    Create this process's job feed when job_stream.enabled is set.
+    """
+    global feed
+    if asbool(settings.get('job_stream.enabled', False)):
+        feed = JobFeed(PostgresNotifier(engine))
+    else:
+        feed = None
@@ -0,0 +1,95 @@
+"""
+Job stage latencies, summarized from the job_latency histograms.
+
+Quantiles are estimated from bucket counts the way Prometheus'
+histogram_quantile does: by interpolating linearly within the bucket the
+quantile falls in. They are only as precise as the buckets are narrow.
+"""
+from collections import OrderedDict
+from models import LATENCY_BUCKETS, stage_key
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+STAGES = [stage_key[status][0] for status in sorted(stage_key)]
+
+
+def quantile(counts, q):
+    """
+    Estimate the q-th quantile of a histogram, given its count per bucket
+    of LATENCY_BUCKETS.
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bucket, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if bucket == len(LATENCY_BUCKETS):
+                # Slower than the last bound: all that can be said.
+                return float(LATENCY_BUCKETS[-1])
+            low = LATENCY_BUCKETS[bucket - 1] if bucket else 0.0
+            high = LATENCY_BUCKETS[bucket]
+            return low + (high - low) * (rank - seen) / count
+        seen += count
+    return float(LATENCY_BUCKETS[-1])
+
+
+def histograms(rows):
+    """
+    Group (rendertype, stage, bucket, count, seconds) rows into a
+    dictionary of rendertype to stage to [counts, seconds], stages in
+    the order jobs go through them.
+    """
+    grouped = {}
+    for rendertype, stage, bucket, count, seconds in rows:
+        if stage not in STAGES:
+            continue
+        stages = grouped.setdefault(rendertype, OrderedDict(
+            (name, [[0] * (len(LATENCY_BUCKETS) + 1), 0.0])
+            for name in STAGES))
+        stages[stage][0][bucket] += count
+        stages[stage][1] += seconds
+    return grouped
+
+
+def summary(rows):
+    """
+    Return count, mean and quantiles of every stage, by rendertype.
+    """
+    result = {}
+    for rendertype, stages in histograms(rows).iteritems():
+        result[rendertype] = OrderedDict()
+        for stage, (counts, seconds) in stages.iteritems():
+            count = sum(counts)
+            stats = OrderedDict([('count', count),
+                                 ('mean', seconds / count if count
+                                  else None)])
+            for q in QUANTILES:
+                stats['p{}'.format(int(q * 100))] = quantile(counts, q)
+            result[rendertype][stage] = stats
+    return result
+
+
+def prometheus_text(rows):
+    """
+    Return the histograms in Prometheus' text exposition format.
+    """
+    name = 'landsat_job_stage_seconds'
+    lines = ['# HELP {} Seconds a render job spends in each stage.'.format(
+                 name),
+             '# TYPE {} histogram'.format(name)]
+    bounds = [repr(float(bound)) for bound in LATENCY_BUCKETS] + ['+Inf']
+    for rendertype, stages in sorted(histograms(rows).iteritems()):
+        for stage, (counts, seconds) in stages.iteritems():
+            labels = 'rendertype="{}",stage="{}"'.format(rendertype, stage)
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    name, labels, bound, cumulative))
+            lines.append('{}_sum{{{}}} {!r}'.format(name, labels,
+                                                   float(seconds)))
+            lines.append('{}_count{{{}}} {}'.format(name, labels,
+                                                    cumulative))
+    return '\n'.join(lines) + '\n'
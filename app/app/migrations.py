@@ -0,0 +1,148 @@
+"""
+Schema migrations.
+
+Base.metadata.create_all builds a fresh schema, indexes included, but does
+not change tables that already exist. Each migration below brings an
+existing database up to date with the models. Migrations are applied in
+order, once, and recorded in the schema_migrations table; statements are
+written so that running them against a freshly created schema is harmless.
+"""
+from datetime import datetime
+from sqlalchemy import Table, Column, UnicodeText, DateTime, MetaData
+from jobfeed import NOTIFY_TRIGGER_SQL
+from models import RENDERTYPES, LATENCY_BUCKETS, stage_key
+
+metadata = MetaData()
+
+
+def job_latency_rows():
+    """
+    Return statements creating every job_latency bucket that is missing.
+    """
+    statements = []
+    for rendertype in RENDERTYPES:
+        for stage, _ in stage_key.values():
+            for bucket in range(len(LATENCY_BUCKETS) + 1):
+                statements.append(
+                    "INSERT INTO job_latency "
+                    "(rendertype, stage, bucket, count, seconds) "
+                    "SELECT '{0}', '{1}', {2}, 0, 0.0 WHERE NOT EXISTS "
+                    "(SELECT 1 FROM job_latency WHERE rendertype = '{0}' "
+                    "AND stage = '{1}' AND bucket = {2})".format(
+                        rendertype, stage, bucket))
+    return statements
+
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', UnicodeText, primary_key=True),
+    Column('applied', DateTime, nullable=False))
+
+# (version, dialects the migration applies to, statements)
+MIGRATIONS = [
+    (u'0001_hot_path_indexes', ('postgresql', 'sqlite'), [
+        # PathRow.scenelist filters on path and row.
+        'CREATE INDEX IF NOT EXISTS path_row_path_row_idx '
+        'ON path_row (path, row)',
+        # RenderCache.get_renderurl, RenderCache.update and the
+        # user_job/render_cache joins go through jobid.
+        'CREATE INDEX IF NOT EXISTS render_cache_jobid_idx '
+        'ON render_cache (jobid)',
+        ]),
+    (u'0002_paths_geom_index', ('postgresql',), [
+        # Paths.pathandrow tests ST_Within against ST_SetSRID(geom, 4236),
+        # so only an index on that expression can serve it.
+        'CREATE INDEX IF NOT EXISTS paths_geom_idx '
+        'ON paths USING gist (ST_SetSRID(geom, 4236))',
+        'CREATE INDEX IF NOT EXISTS paths_mode_idx ON paths (mode)',
+        ]),
+    (u'0003_render_cache_composite_key', ('postgresql',), [
+        # Keep one row per composite: a rendered one if there is one,
+        # otherwise the newest.
+        '''
+        DELETE FROM render_cache a USING render_cache b
+        WHERE a.entityid = b.entityid
+          AND a.band1 = b.band1 AND a.band2 = b.band2 AND a.band3 = b.band3
+          AND a.rendertype = b.rendertype
+          AND ((a.renderurl IS NULL AND b.renderurl IS NOT NULL)
+               OR ((a.renderurl IS NULL) = (b.renderurl IS NULL)
+                   AND a.id < b.id))
+        ''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS render_cache_composite_key '
+        'ON render_cache (entityid, band1, band2, band3, rendertype)',
+        ]),
+    (u'0004_job_status_notify', ('postgresql',), [
+        NOTIFY_TRIGGER_SQL,
+        ]),
+    # The job_latency table itself comes from create_all.
+    (u'0005_job_latency_buckets', ('postgresql', 'sqlite'),
+     job_latency_rows()),
+    # The path_row_summary table comes from create_all; summarize the
+    # path/rows loaded before it existed the way PathRowSummary.refresh
+    # does, whole seconds of each time of day included.
+    (u'0006_path_row_summary', ('postgresql',), [
+        '''
+        INSERT INTO path_row_summary
+            (path, row, scenes, time_seconds, latest, cloudcover_sum,
+             under_10, under_30, under_60)
+        SELECT path, row, count(*),
+               sum(extract(hour FROM acquisitiondate) * 3600
+                   + extract(minute FROM acquisitiondate) * 60
+                   + floor(extract(second FROM acquisitiondate)))::integer,
+               max(acquisitiondate), sum(cloudcover),
+               sum(CASE WHEN cloudcover < 10 THEN 1 ELSE 0 END),
+               sum(CASE WHEN cloudcover < 30 THEN 1 ELSE 0 END),
+               sum(CASE WHEN cloudcover < 60 THEN 1 ELSE 0 END)
+        FROM path_row
+        WHERE NOT EXISTS (SELECT 1 FROM path_row_summary s
+                          WHERE s.path = path_row.path
+                            AND s.row = path_row.row)
+        GROUP BY path, row
+        ''',
+        ]),
+    (u'0007_path_row_date_index', ('postgresql', 'sqlite'), [
+        # PathRow.scenelist pages through a path/row newest first.
+        'CREATE INDEX IF NOT EXISTS path_row_path_row_date_idx '
+        'ON path_row (path, row, acquisitiondate DESC, entityid DESC)',
+        ]),
+    (u'0008_paths_geom_index_cast', ('postgresql',), [
+        # paths.geom holds WKT as text where the schema came from
+        # create_all. Index the same explicit cast Paths.pathandrow makes,
+        # so the planner matches it rather than relying on an implicit one.
+        'DROP INDEX IF EXISTS paths_geom_idx',
+        'CREATE INDEX paths_geom_idx '
+        'ON paths USING gist (ST_SetSRID(geom::geometry, 4236))',
+        ]),
+    ]
+
+
+def applied_versions(connection):
+    """
+    Return the set of migrations already applied.
+    """
+    metadata.create_all(connection)
+    return set(row[0] for row in
+               connection.execute(schema_migrations.select()))
+
+
+def migrate(engine):
+    """
+    Apply every pending migration, each in its own transaction, and return
+    the versions applied.
+    """
+    dialect = engine.dialect.name
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+
+    applied = []
+    for version, dialects, statements in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as connection:
+            if dialect in dialects:
+                for statement in statements:
+                    connection.execute(statement)
+            connection.execute(schema_migrations.insert().values(
+                version=version, applied=datetime.utcnow()))
+        applied.append(version)
+    return applied
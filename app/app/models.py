@@ -1,10 +1,17 @@
+import time
 import transaction
 from sqlalchemy import (Column, Integer, Boolean, UnicodeText, func, DateTime,
-                        Float, or_, and_, )
+                        Float, or_, and_, UniqueConstraint, Index, text,
+                        case, select, cast, )
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.types import UserDefinedType
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
 from datetime import datetime
+from bisect import bisect_left
 
 Session = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 Base = declarative_base()
@@ -17,6 +24,44 @@ status_key = {0: "In queue",
               5: "Done",
               10: "Failed"}
 
+# Rendering goes through the statuses as follows: 1 while the bands are
+# opened, 2 while their histograms are built for the contrast stretch, 3
+# while they are scaled and compressed, a block at a time, and 4 once the
+# composite starts going up: with its first part for multipart uploads,
+# otherwise when what is compressed is put or moved into place on close.
+
+# The stage of a job that ends when it reaches each status, and the column
+# holding the time the stage began.
+stage_key = {1: (u'queue_wait', 'starttime'),
+             2: (u'collect', 'status1time'),
+             3: (u'process', 'status2time'),
+             4: (u'compress', 'status3time'),
+             5: (u'upload', 'status4time')}
+
+# Kinds of render job.
+RENDERTYPES = (u'preview', u'full')
+
+# Upper bounds, in seconds, of the stage latency histogram buckets. The
+# last bucket holds everything slower.
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+                   1800, 3600)
+
+# Cloud cover percentages path_row_summary counts scenes under; each has
+# an under_<bound> column.
+CLOUD_BOUNDS = (10, 30, 60)
+
+# Path/rows PathRowSummary.refresh recomputes per query.
+SUMMARY_CHUNK = 100
+
+
+class Geometry(UserDefinedType):
+    """
+    PostGIS geometry, for casting the WKT held in paths.geom.
+    """
+
+    def get_col_spec(self):
+        return 'geometry'
+
 
 class Paths(Base):
     """
@@ -38,11 +83,22 @@ class Paths(Base):
             scene = (Session.query(cls.path, cls.row).filter(
                 func.ST_Within(func.ST_SetSRID(
                     func.ST_MakePoint(float(lon), float(lat)), 4236),
-                    func.ST_SetSRID(cls.geom, 4236)), cls.mode == u'D').all())
+                    func.ST_SetSRID(cast(cls.geom, Geometry), 4236)),
+                cls.mode == u'D').all())
             return scene
         except:
             return u'----'
 
+    @classmethod
+    def footprints(cls):
+        """
+        Return path, row and WKT footprint of every descending-mode path/row,
+        for building the in-process index in wrs2.
+        """
+        return (Session.query(cls.path, cls.row,
+                              func.ST_AsText(cls.geom)).filter(
+            cls.mode == u'D').order_by(cls.gid).all())
+
 
 class PathRow(Base):
     """
@@ -60,16 +116,39 @@ class PathRow(Base):
     max_lon = Column(Float, nullable=False)
     download_url = Column(UnicodeText, nullable=False)
 
+    __table_args__ = (Index('path_row_path_row_idx', 'path', 'row'),)
+
     @classmethod
-    def scenelist(cls, pr_output):
+    def scenelist(cls, pr_output, max_cloud=None, start=None, end=None,
+                  limit=None, after=None):
         """
         Query path_row table for a list of scenes that are available in the AWS
-        landsat public data set that correspond to the path row requested.
+        landsat public data set that correspond to the path row requested,
+        newest first. Optionally only scenes with at most max_cloud percent
+        cloud cover, acquired from start and before end, and older than the
+        (acquisitiondate, entityid) of after, limit at a time.
         """
         new = []
         for x in pr_output:
             new.append(and_(cls.row == x.row, cls.path == x.path))
-        return Session.query(cls).filter(or_(*new))
+        query = Session.query(cls).filter(or_(*new))
+        if max_cloud is not None:
+            query = query.filter(cls.cloudcover <= max_cloud)
+        if start is not None:
+            query = query.filter(cls.acquisitiondate >= start)
+        if end is not None:
+            query = query.filter(cls.acquisitiondate < end)
+        if after is not None:
+            acquisitiondate, entityid = after
+            # The first condition alone bounds the index scan.
+            query = query.filter(cls.acquisitiondate <= acquisitiondate,
+                                 or_(cls.acquisitiondate < acquisitiondate,
+                                     cls.entityid < entityid))
+        query = query.order_by(cls.acquisitiondate.desc(),
+                               cls.entityid.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        return query
 
     @classmethod
     def meta_data(cls, scene_id):
@@ -89,6 +168,129 @@ class PathRow(Base):
                              ).filter(cls.entityid == scene_id).first()
 
 
+# Serves PathRow.scenelist's filters, newest first, and its keyset cursor.
+Index('path_row_path_row_date_idx', PathRow.path, PathRow.row,
+      PathRow.acquisitiondate.desc(), PathRow.entityid.desc())
+
+
+def seconds_of_day(when):
+    """
+    Return the whole seconds since midnight of a datetime.
+    """
+    return when.hour * 3600 + when.minute * 60 + when.second
+
+
+class day_seconds(FunctionElement):
+    """
+    SQL for seconds_of_day of a timestamp column.
+    """
+    name = 'day_seconds'
+    type = Integer()
+
+
+@compiles(day_seconds)
+def compile_day_seconds(element, compiler, **kw):
+    return ('CAST(EXTRACT(HOUR FROM {0}) * 3600 + EXTRACT(MINUTE FROM {0}) '
+            '* 60 + FLOOR(EXTRACT(SECOND FROM {0})) AS INTEGER)'.format(
+                compiler.process(element.clauses, **kw)))
+
+
+@compiles(day_seconds, 'sqlite')
+def compile_day_seconds_sqlite(element, compiler, **kw):
+    return "(CAST(strftime('%s', {}) AS INTEGER) % 86400)".format(
+        compiler.process(element.clauses, **kw))
+
+
+def average_time(time_seconds, scenes):
+    """
+    Return the average of scenes times of day summing to time_seconds, as
+    HH:MM.
+    """
+    return time.strftime('%H:%M', time.gmtime(float(time_seconds) / scenes))
+
+
+class PathRowSummary(Base):
+    """
+    Per path/row totals of path_row: how many scenes there are, the sum of
+    their times of day for the average acquisition time, the latest
+    acquisition, and the cloud cover distribution as the sum of cloud cover
+    and the number of scenes under each of CLOUD_BOUNDS percent. Kept up to
+    date by refresh whenever path_row rows are loaded.
+    """
+    __tablename__ = 'path_row_summary'
+    path = Column(Integer, primary_key=True, autoincrement=False)
+    row = Column(Integer, primary_key=True, autoincrement=False)
+    scenes = Column(Integer, nullable=False)
+    time_seconds = Column(Integer, nullable=False)
+    latest = Column(DateTime, nullable=False)
+    cloudcover_sum = Column(Float, nullable=False)
+    under_10 = Column(Integer, nullable=False)
+    under_30 = Column(Integer, nullable=False)
+    under_60 = Column(Integer, nullable=False)
+
+    @classmethod
+    def refresh(cls, pathrows):
+        """
+        Recompute the summaries of the given (path, row) pairs from
+        path_row, without committing.
+        """
+        pathrows = sorted(set(pathrows))
+        table = cls.__table__
+        for start in xrange(0, len(pathrows), SUMMARY_CHUNK):
+            chunk = pathrows[start:start + SUMMARY_CHUNK]
+            Session.execute(table.delete().where(or_(*[
+                and_(table.c.path == path, table.c.row == row)
+                for path, row in chunk])))
+            columns = [PathRow.path, PathRow.row, func.count(),
+                       func.sum(day_seconds(PathRow.acquisitiondate)),
+                       func.max(PathRow.acquisitiondate),
+                       func.sum(PathRow.cloudcover)]
+            columns.extend(func.sum(case([(PathRow.cloudcover < bound, 1)],
+                                         else_=0))
+                           for bound in CLOUD_BOUNDS)
+            Session.execute(table.insert().from_select(
+                ['path', 'row', 'scenes', 'time_seconds', 'latest',
+                 'cloudcover_sum'] +
+                ['under_{}'.format(bound) for bound in CLOUD_BOUNDS],
+                select(columns).where(or_(*[
+                    and_(PathRow.path == path, PathRow.row == row)
+                    for path, row in chunk])).group_by(PathRow.path,
+                                                       PathRow.row)))
+        mark_changed(Session())
+
+    @classmethod
+    def for_pathrows(cls, pathrows):
+        """
+        Return a dictionary of (path, row) to summary for the given pairs.
+        """
+        match = or_(*[and_(cls.path == path, cls.row == row)
+                      for path, row in pathrows])
+        return dict(((summary.path, summary.row), summary)
+                    for summary in Session.query(cls).filter(match))
+
+    @property
+    def average_time(self):
+        """
+        Average acquisition time of day, as HH:MM.
+        """
+        return average_time(self.time_seconds, self.scenes)
+
+    def header(self):
+        """
+        Return the summary as reported with scene lists.
+        """
+        return {'path': self.path,
+                'row': self.row,
+                'scenes': self.scenes,
+                'average_time': self.average_time,
+                'latest': self.latest.strftime('%Y %m %d'),
+                'mean_cloudcover': round(self.cloudcover_sum / self.scenes,
+                                         2),
+                'cloudcover_under': dict(
+                    (str(bound), getattr(self, 'under_{}'.format(bound)))
+                    for bound in CLOUD_BOUNDS)}
+
+
 class UserJob(Base):
     """
     Model for the user job queue. Possible job statuses:
@@ -129,34 +331,42 @@ class UserJob(Base):
                 email=None
                 ):
         """
-        Create new job in db.
+        Create new job in db, together with its render_cache row, in one
+        transaction. Returns None if the composite already has a job.
+
+        Both rows are written with plain INSERTs, which return the new
+        primary key with RETURNING on Postgres, and committed once.
         """
         try:
-            session = Session
-            current_time = datetime.utcnow()
-            job = UserJob(
-                entityid=entityid,
-                band1=band1, band2=band2, band3=band3,
-                jobstatus=0,
-                starttime=current_time,
-                lastmodified=current_time,
-                rendertype=rendertype,
-                email=email)
-            session.add(job)
-            session.flush()
-            session.refresh(job)
-            pk = job.jobid
+            pk = cls.insert(entityid, band1, band2, band3, rendertype, email)
+            RenderCache.add(pk, entityid, band1, band2, band3,
+                            True, rendertype)
             transaction.commit()
             transaction.begin()
-        except:
+        except IntegrityError:
+            # Another request claimed this composite first.
+            transaction.abort()
+            transaction.begin()
             return None
-
-        try:
-            RenderCache.add(pk, True, rendertype)
-        except:
-            print 'Could not add the job to the Rendered database.'
         return pk
 
+    @classmethod
+    def insert(cls, entityid, band1, band2, band3, rendertype, email=None):
+        """
+        Insert a queued job and return its jobid, without committing.
+        """
+        current_time = datetime.utcnow()
+        result = Session.execute(cls.__table__.insert().values(
+            entityid=entityid,
+            band1=band1, band2=band2, band3=band3,
+            jobstatus=0,
+            starttime=current_time,
+            lastmodified=current_time,
+            rendertype=rendertype,
+            email=email))
+        mark_changed(Session())
+        return result.inserted_primary_key[0]
+
     @classmethod
     def job_status(cls, jobid):
         """
@@ -191,6 +401,52 @@ class UserJob(Base):
         except:
             print 'Database operation'
 
+    @classmethod
+    def set_job_status(cls, jobid, jobstatus):
+        """
+        Set the status of a job and stamp the time it was reached. The
+        stage the status ends is recorded the first time the job reaches
+        it only, so a requeued job that runs again is not counted twice.
+        """
+        current_time = datetime.utcnow()
+        values = {'jobstatus': jobstatus, 'lastmodified': current_time}
+        if jobstatus in status_key and jobstatus != 0:
+            values['status{}time'.format(jobstatus)] = current_time
+        began = None
+        if jobstatus in stage_key:
+            stage, column = stage_key[jobstatus]
+            began = Session.query(
+                getattr(cls, column), cls.rendertype,
+                getattr(cls, 'status{}time'.format(jobstatus))).filter(
+                cls.jobid == jobid).first()
+        Session.query(cls).filter(cls.jobid == jobid).update(values)
+        if began is not None and began[0] is not None and began[2] is None:
+            JobLatency.record(began[1], stage,
+                              (current_time - began[0]).total_seconds())
+
+    @classmethod
+    def requeue(cls, jobid):
+        """
+        Put a job that was taken off its queue without running back to
+        queued. Its stamps are kept, and no stage latency is recorded.
+        """
+        Session.query(cls).filter(cls.jobid == jobid).update(
+            {'jobstatus': 0, 'lastmodified': datetime.utcnow()})
+
+    @classmethod
+    def jobs_status(cls, jobids):
+        """
+        Get jobs and their render urls for every jobid passed in, in a single
+        query.
+        """
+        try:
+            return Session.query(cls, RenderCache.renderurl).outerjoin(
+                RenderCache, RenderCache.jobid == cls.jobid).filter(
+                cls.jobid.in_(jobids)).all()
+        except:
+            print 'Database query failed jobs_status'
+            return None
+
 
 class RenderCache(Base):
     """
@@ -208,21 +464,35 @@ class RenderCache(Base):
     currentlyrend = Column(Boolean)
     rendertype = Column(UnicodeText)
 
+    # One row, and so one job, per composite.
+    __table_args__ = (UniqueConstraint('entityid', 'band1', 'band2', 'band3',
+                                       'rendertype',
+                                       name='render_cache_composite_key'),
+                      Index('render_cache_jobid_idx', 'jobid'))
+
+    @classmethod
+    def composite(cls, entityid, band1, band2, band3, rendertype):
+        """Return the filter matching a given composite."""
+        return and_(cls.entityid == entityid,
+                    cls.band1 == band1, cls.band2 == band2,
+                    cls.band3 == band3,
+                    cls.rendertype == rendertype)
+
     @classmethod
-    def add(cls, jobid, currentlyrend, rendertype):
+    def add(cls, jobid, entityid, band1, band2, band3, currentlyrend,
+            rendertype):
         """
-        Method adds entry into db given jobid and optional url.
+        Method adds entry into db given jobid and its composite, without
+        committing.
         """
-        jobQuery = Session.query(UserJob).get(jobid)
-        job = RenderCache(
-            entityid=jobQuery.entityid,
+        Session.execute(cls.__table__.insert().values(
             jobid=jobid,
-            band1=jobQuery.band1, band2=jobQuery.band2, band3=jobQuery.band3,
+            entityid=entityid,
+            band1=band1, band2=band2, band3=band3,
+            rendercount=0,
             currentlyrend=currentlyrend,
-            rendertype=rendertype)
-
-        Session.add(job)
-        transaction.commit()
+            rendertype=rendertype))
+        mark_changed(Session())
 
     @classmethod
     def update(cls, jobid, currentlyrend, renderurl):
@@ -237,11 +507,14 @@ class RenderCache(Base):
 
     @classmethod
     def get_rendered_rendering_composites_sceneid(cls, entityid):
-        """Return rendered or rendering composites for a given sceneID."""
+        """
+        Return rendered or rendering composites for a given sceneID, each
+        paired with its job, in a single query.
+        """
         try:
-            rendered = Session.query(cls).filter(
-                cls.entityid == entityid,
-                cls.currentlyrend is not True).all()
+            rendered = Session.query(cls, UserJob).outerjoin(
+                UserJob, UserJob.jobid == cls.jobid).filter(
+                cls.entityid == entityid).all()
         except:
             print 'Database query failed get_rendered_rendering_composites_sceneid'
             return None
@@ -250,41 +523,109 @@ class RenderCache(Base):
     @classmethod
     def get_rendered_rendering_composites_band_combo(cls, entityid,
                                                      band1, band2, band3):
-        """Return rendered or rendering composites for a given band combo."""
+        """
+        Return rendered or rendering composites for a given band combo, each
+        paired with its job, in a single query.
+        """
         try:
-            rendered = Session.query(cls).filter(
+            rendered = Session.query(cls, UserJob).outerjoin(
+                UserJob, UserJob.jobid == cls.jobid).filter(
                 cls.entityid == entityid,
-                cls.band1 == band1, cls.band2 == band2, cls.band3 == band3,
-                cls.currentlyrend is not True).all()
+                cls.band1 == band1, cls.band2 == band2,
+                cls.band3 == band3).all()
         except:
-            print 'Database query failed get_rendered_rendering_composites_sceneid'
+            print 'Database query failed get_rendered_rendering_composites_band_combo'
             return None
         return rendered
 
     @classmethod
-    def composite_availability(cls, entityid, band1, band2, band3, rendertype):
-        """Check if given composite is already rendered."""
-        try:
-            output = Session.query(cls).filter(
-                cls.entityid == entityid,
-                cls.band1 == band1, cls.band2 == band2, cls.band3 == band3,
-                cls.rendertype == rendertype,
-                cls.renderurl.isnot(None)).count()
-        except:
-            print 'Database query failed composite_availability'
+    def hit(cls, entityid, band1, band2, band3, rendertype):
+        """
+        Count a request for a composite and return its jobid, renderurl and
+        jobstatus, or None if the composite has never been requested.
+
+        One UPDATE ... RETURNING statement, found through the unique index on
+        the composite, so the count and the lookup cannot race.
+        """
+        result = Session.execute(text("""
+            UPDATE render_cache SET rendercount = rendercount + 1
+            WHERE entityid = :entityid
+              AND band1 = :band1 AND band2 = :band2 AND band3 = :band3
+              AND rendertype = :rendertype
+            RETURNING jobid, renderurl,
+                (SELECT jobstatus FROM user_job
+                 WHERE user_job.jobid = render_cache.jobid) AS jobstatus
+            """), {'entityid': entityid,
+                   'band1': band1, 'band2': band2, 'band3': band3,
+                   'rendertype': rendertype})
+        # Some drivers describe no result columns when nothing matched.
+        if not result.returns_rows:
             return None
+        row = result.first()
+        if row is not None:
+            mark_changed(Session())
+        return row
 
-        return output != 0
+    @classmethod
+    def claim(cls, entityid, band1, band2, band3, rendertype, email=None,
+              existing=None):
+        """
+        Return (jobid, created) for a composite.
+
+        The first request for a composite creates its job. Concurrent and
+        later requests attach to that job and bump its render count, relying
+        on the unique constraint on the composite. A failed job is replaced by
+        a new one, by exactly one of the requests that find it failed.
+        Pass the composite's row as returned by hit, if it has one.
+        """
+        if existing is None:
+            jobid = UserJob.new_job(entityid=entityid,
+                                    band1=band1, band2=band2, band3=band3,
+                                    rendertype=rendertype, email=email)
+            if jobid is not None:
+                return jobid, True
+
+            # Another request created the composite first.
+            existing = cls.hit(entityid, band1, band2, band3, rendertype)
+            if existing is None:
+                return None, False
+
+        if existing.jobstatus == 10:
+            jobid = cls.replace_failed_job(entityid, band1, band2, band3,
+                                           rendertype, existing.jobid, email)
+            if jobid is not None:
+                return jobid, True
+            existing = cls.composite_job(entityid, band1, band2, band3,
+                                         rendertype)
+
+        return existing.jobid, False
 
     @classmethod
-    def update_render_count(cls, entityid, band1, band2, band3, rendertype):
-        """Update render count of composite."""
-        # if this scene/band has already been requested, increase the count
-        Session.query(cls).filter(
-            cls.entityid == entityid,
-            cls.band1 == band1, cls.band2 == band2, cls.band3 == band3,
-            cls.rendertype == rendertype
-            ).update({"rendercount": cls.rendercount+1})
+    def composite_job(cls, entityid, band1, band2, band3, rendertype):
+        """Return id, jobid and jobstatus of a composite's row."""
+        return Session.query(cls.id, cls.jobid, UserJob.jobstatus).outerjoin(
+            UserJob, UserJob.jobid == cls.jobid).filter(
+            cls.composite(entityid, band1, band2, band3, rendertype)).first()
+
+    @classmethod
+    def replace_failed_job(cls, entityid, band1, band2, band3, rendertype,
+                           failed_jobid, email=None):
+        """
+        Point a composite whose job failed at a new job. Returns None if
+        another request replaced the failed job first.
+        """
+        pk = UserJob.insert(entityid, band1, band2, band3, rendertype, email)
+        replaced = Session.query(cls).filter(
+            cls.composite(entityid, band1, band2, band3, rendertype),
+            cls.jobid == failed_jobid).update(
+            {'jobid': pk, 'currentlyrend': True}, synchronize_session=False)
+        if not replaced:
+            Session.execute(UserJob.__table__.delete().where(
+                UserJob.jobid == pk))
+            return None
+        transaction.commit()
+        transaction.begin()
+        return pk
 
     @classmethod
     def get_renderurl(cls, jobid):
@@ -299,3 +640,43 @@ class RenderCache(Base):
             return None
 
         return render_url[0]
+
+
+class JobLatency(Base):
+    """
+    Histograms of how long each stage of a job takes, by rendertype,
+    updated as jobs move through their stages. Each row counts the jobs of
+    a rendertype whose stage fell in one bucket of LATENCY_BUCKETS, and
+    sums their seconds. Every row is created up front by a migration, so
+    that counting a job is a single UPDATE that never races an INSERT.
+    """
+    __tablename__ = 'job_latency'
+    rendertype = Column(UnicodeText, primary_key=True)
+    stage = Column(UnicodeText, primary_key=True)
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
+    seconds = Column(Float, nullable=False, default=0.0)
+
+    @classmethod
+    def record(cls, rendertype, stage, seconds):
+        """
+        Count one stage of a job taking seconds, without committing.
+        """
+        table = cls.__table__
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        update = table.update().where(and_(
+            table.c.rendertype == rendertype,
+            table.c.stage == stage,
+            table.c.bucket == bucket)).values(
+            count=table.c.count + 1,
+            seconds=table.c.seconds + seconds)
+        Session.execute(update)
+        mark_changed(Session())
+
+    @classmethod
+    def histograms(cls):
+        """
+        Return every bucket as (rendertype, stage, bucket, count, seconds).
+        """
+        return Session.query(cls.rendertype, cls.stage, cls.bucket,
+                             cls.count, cls.seconds).all()
@@ -0,0 +1,197 @@
+"""
+Per-request SQL profiling.
+
+Engine events time every statement and charge it to the request being
+served on the thread, if any. A tween totals each request's queries and
+database time by route, logs statements slower than a threshold with the
+route that issued them, and can report the totals to the browser in a
+Server-Timing header. query_budget lets tests hold a view to a number of
+queries.
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+
+log = logging.getLogger(__name__)
+
+# Statements slower than this many seconds are logged.
+SLOW_QUERY_SECONDS = 0.1
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised when a block issues more queries than its budget.
+    """
+
+
+class Recorder(object):
+    """
+    Statements issued on one thread for a request or a test, and the
+    seconds each took.
+    """
+
+    def __init__(self, request=None):
+        self.request = request
+        self.queries = []
+
+    @property
+    def route(self):
+        """
+        Name of the route the request matched, once it has been routed.
+        """
+        route = getattr(self.request, 'matched_route', None)
+        return route.name if route is not None else None
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def seconds(self):
+        return sum(seconds for _, seconds in self.queries)
+
+
+class RouteStats(object):
+    """
+    Requests, queries and database seconds per route, for this process.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def add(self, route, recorder, seconds):
+        with self._lock:
+            stats = self.routes.setdefault(route, {
+                'requests': 0, 'queries': 0, 'max_queries': 0,
+                'db_seconds': 0.0, 'seconds': 0.0, 'slow_queries': 0})
+            stats['requests'] += 1
+            stats['queries'] += recorder.count
+            stats['max_queries'] = max(stats['max_queries'], recorder.count)
+            stats['db_seconds'] += recorder.seconds
+            stats['seconds'] += seconds
+            stats['slow_queries'] += sum(
+                1 for _, query_seconds in recorder.queries
+                if query_seconds >= slow_query_seconds)
+
+    def stats(self):
+        """
+        Return a dictionary of counters and means per route.
+        """
+        with self._lock:
+            result = {}
+            for route, stats in self.routes.iteritems():
+                result[route] = dict(stats)
+                result[route]['mean_queries'] = (float(stats['queries']) /
+                                                 stats['requests'])
+                result[route]['mean_db_seconds'] = (stats['db_seconds'] /
+                                                    stats['requests'])
+            return result
+
+
+route_stats = RouteStats()
+slow_query_seconds = SLOW_QUERY_SECONDS
+server_timing = False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    # Kept on the statement's own context, so that nothing is left behind
+    # on the connection when the statement raises.
+    if context is not None:
+        context._query_start = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = getattr(context, '_query_start', None)
+    if start is None:
+        return
+    seconds = time.time() - start
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is not None:
+        recorder.queries.append((statement, seconds))
+    if seconds >= slow_query_seconds:
+        log.warning('slow query (%.0f ms) in %s: %s', seconds * 1000,
+                    recorder.route if recorder is not None else None,
+                    statement)
+
+
+def install(engine):
+    """
+    Time every statement executed on engine.
+    """
+    if not event.contains(engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute',
+                     _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+@contextmanager
+def recording(request=None):
+    """
+    Yield a Recorder of the statements issued on this thread in the block.
+    """
+    outer = getattr(_local, 'recorder', None)
+    recorder = _local.recorder = Recorder(request)
+    try:
+        yield recorder
+    finally:
+        _local.recorder = outer
+
+
+@contextmanager
+def query_budget(max_queries):
+    """
+    Fail with QueryBudgetExceeded if the block issues more than
+    max_queries statements on an installed engine.
+    """
+    with recording() as recorder:
+        yield recorder
+    if recorder.count > max_queries:
+        raise QueryBudgetExceeded(
+            '{} queries, budget {}:\n{}'.format(
+                recorder.count, max_queries,
+                '\n'.join(statement for statement, _ in recorder.queries)))
+
+
+def profiling_tween_factory(handler, registry):
+    """
+    Record the queries and database time of every request by route.
+    """
+    def profiling_tween(request):
+        start = time.time()
+        with recording(request) as recorder:
+            response = handler(request)
+        seconds = time.time() - start
+        route_stats.add(recorder.route or 'no route', recorder, seconds)
+        if server_timing:
+            response.headers['Server-Timing'] = (
+                'db;dur={:.1f};desc="{} queries", app;dur={:.1f}'.format(
+                    recorder.seconds * 1000, recorder.count, seconds * 1000))
+        return response
+
+    return profiling_tween
+
+
+def configure(config, settings, engine):
+    """
+    Install the profiler on engine and its tween in config when
+    profiling.enabled is set.
+    """
+    global slow_query_seconds, server_timing
+    if not asbool(settings.get('profiling.enabled', False)):
+        return
+    slow_query_seconds = float(settings.get(
+        'profiling.slow_query_ms', SLOW_QUERY_SECONDS * 1000)) / 1000
+    server_timing = asbool(settings.get('profiling.server_timing', False))
+    install(engine)
+    # Outermost, so that the commit by pyramid_tm is counted too.
+    config.add_tween('app.profiling.profiling_tween_factory', under=INGRESS)
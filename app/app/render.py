@@ -0,0 +1,452 @@
+"""
+Render band composites.
+
+Three bands are stacked into an 8-bit RGB PNG a block of rows at a time.
+A first pass builds each band's histogram to find its contrast stretch; a
+second pass reads the bands again, scales each block into preallocated
+buffers and compresses it straight into the PNG. Peak memory depends on
+the block size, not on the size of the scene. Previews are rendered the
+same way from bands read at reduced resolution.
+"""
+import io
+import os
+import zlib
+import struct
+import numpy as np
+from bandcache import BandCache
+from s3 import S3Output, make_S3_connection, get_bucket, PART_SIZE, UPLOADERS
+
+try:
+    import rasterio
+except ImportError:
+    rasterio = None
+
+# Rows read, scaled and written at a time. Landsat GeoTIFFs are tiled in
+# 512 by 512 pixel blocks, so windows this tall read whole tiles.
+BLOCK_ROWS = 512
+
+# Percentiles of each band's pixels that are stretched to 0 and 255.
+STRETCH = (2, 98)
+
+# Pixel value of Landsat's fill around the scene.
+NODATA = 0
+
+# Longest side of a preview, in pixels.
+PREVIEW_SIZE = 1000
+
+LANDSAT_BAND_URL = ('http://landsat-pds.s3.amazonaws.com/L8/'
+                    '{path:03d}/{row:03d}/{entityid}/{entityid}_B{band}.TIF')
+
+
+class ArrayBand(object):
+    """
+    Band held in a 2D array.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def read(self, start, stop, out):
+        """
+        Read rows start to stop into out.
+        """
+        np.copyto(out, self.array[start:stop])
+
+    def decimated(self, factor):
+        """
+        Return this band keeping every factor-th row and column.
+        """
+        return ArrayBand(self.array[::factor, ::factor])
+
+    def close(self):
+        pass
+
+
+class RawBand(object):
+    """
+    Band stored as a headerless file of pixels in row order. With a step,
+    only every step-th row is read, and every step-th column kept.
+    """
+
+    def __init__(self, path, shape, dtype=np.uint16, step=1, file=None):
+        self.path = path
+        self.file = file or io.open(path, 'rb')
+        self.full_shape = shape
+        self.dtype = np.dtype(dtype)
+        self.step = step
+        self.shape = (-(-shape[0] // step), -(-shape[1] // step))
+        self.row_bytes = shape[1] * self.dtype.itemsize
+        self.row = np.empty(shape[1], self.dtype) if step > 1 else None
+
+    def read(self, start, stop, out):
+        if self.step == 1:
+            self.file.seek(start * self.row_bytes)
+            self.file.readinto(out)
+            return
+        for i, row in enumerate(xrange(start * self.step, stop * self.step,
+                                       self.step)):
+            self.file.seek(row * self.row_bytes)
+            self.file.readinto(self.row)
+            out[i] = self.row[::self.step]
+
+    def decimated(self, factor):
+        return RawBand(self.path, self.full_shape, self.dtype,
+                       self.step * factor, self.file)
+
+    def close(self):
+        self.file.close()
+
+
+class RasterioBand(object):
+    """
+    Band of a GeoTIFF, or anything else GDAL opens, read through rasterio.
+    A decimated band is read at reduced resolution, which GDAL serves from
+    the file's internal overviews when it has them.
+    """
+
+    def __init__(self, path, factor=1, dataset=None):
+        if rasterio is None:
+            raise ImportError('rendering GeoTIFFs requires rasterio')
+        self.path = path
+        self.dataset = dataset or rasterio.open(path)
+        self.factor = factor
+        height, width = self.dataset.shape
+        self.shape = (-(-height // factor), -(-width // factor))
+        self.dtype = np.dtype(self.dataset.dtypes[0])
+
+    def read(self, start, stop, out):
+        height, width = self.dataset.shape
+        window = ((start * self.factor, min(stop * self.factor, height)),
+                  (0, width))
+        self.dataset.read(1, window=window, out=out)
+
+    def decimated(self, factor):
+        return RasterioBand(self.path, self.factor * factor, self.dataset)
+
+    def close(self):
+        self.dataset.close()
+
+
+class PNGWriter(object):
+    """
+    Write an 8-bit RGB PNG a block of rows at a time.
+    """
+
+    def __init__(self, out, width, height, level=6):
+        self.out = out
+        self.width = width
+        self.compressor = zlib.compressobj(level)
+        self.rows = np.zeros((0, width * 3 + 1), np.uint8)
+        out.write('\x89PNG\r\n\x1a\n')
+        self._chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+                                        8, 2, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.out.write(struct.pack('>I', len(data)))
+        self.out.write(tag)
+        self.out.write(data)
+        self.out.write(struct.pack('>I',
+                                   zlib.crc32(data, zlib.crc32(tag))
+                                   & 0xffffffff))
+
+    def write(self, rgb):
+        """
+        Write rows of an (rows, width, 3) uint8 array.
+        """
+        count = rgb.shape[0]
+        if self.rows.shape[0] < count:
+            # Each row starts with its filter type, 0 for none.
+            self.rows = np.zeros((count, self.width * 3 + 1), np.uint8)
+        rows = self.rows[:count]
+        rows[:, 1:] = rgb.reshape(count, -1)
+        data = self.compressor.compress(rows)
+        if data:
+            self._chunk('IDAT', data)
+
+    def close(self):
+        self._chunk('IDAT', self.compressor.flush())
+        self._chunk('IEND', '')
+
+
+def band_histogram(band, block_rows, raw):
+    """
+    Return the pixel counts of every value of an integer band, reading it
+    block_rows at a time into raw.
+    """
+    height = band.shape[0]
+    counts = np.zeros(np.iinfo(band.dtype).max + 1, np.int64)
+    for start in xrange(0, height, block_rows):
+        block = raw[:min(block_rows, height - start)]
+        band.read(start, start + block.shape[0], block)
+        counts += np.bincount(block.ravel(), minlength=counts.size)
+    return counts
+
+
+def stretch_limits(counts, stretch=STRETCH):
+    """
+    Return the pixel values at the stretch percentiles of a histogram,
+    leaving out fill.
+    """
+    counts = counts.copy()
+    counts[NODATA] = 0
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    if not total:
+        return 0, 1
+    low = int(np.searchsorted(cumulative, total * stretch[0] / 100.0))
+    high = int(np.searchsorted(cumulative, total * stretch[1] / 100.0))
+    return low, max(high, low + 1)
+
+
+def render_composite(bands, out, block_rows=BLOCK_ROWS, stretch=STRETCH,
+                     limits=None):
+    """
+    Stack three bands into an RGB PNG written to the file object out.
+    Pixels that are fill in any band are black. Pass the bands' stretch
+    limits if they are already known.
+    """
+    height, width = bands[0].shape
+    if any(band.shape != (height, width) for band in bands):
+        raise ValueError('bands differ in size')
+    block_rows = min(block_rows, height)
+
+    raw = np.empty((block_rows, width), bands[0].dtype)
+    if limits is None:
+        limits = [stretch_limits(band_histogram(band, block_rows, raw),
+                                 stretch)
+                  for band in bands]
+
+    scaled = np.empty((block_rows, width), np.float32)
+    has_data = np.empty((block_rows, width), np.bool_)
+    valid = np.empty((block_rows, width), np.bool_)
+    rgb = np.empty((block_rows, width, 3), np.uint8)
+    writer = PNGWriter(out, width, height)
+    for start in xrange(0, height, block_rows):
+        count = min(block_rows, height - start)
+        valid[:count] = True
+        for i, (band, (low, high)) in enumerate(zip(bands, limits)):
+            block = raw[:count]
+            band.read(start, start + count, block)
+            np.not_equal(block, NODATA, out=has_data[:count])
+            np.logical_and(valid[:count], has_data[:count],
+                           out=valid[:count])
+            values = scaled[:count]
+            np.copyto(values, block)
+            np.subtract(values, low, out=values)
+            np.multiply(values, 255.0 / (high - low), out=values)
+            np.clip(values, 0, 255, out=values)
+            np.copyto(rgb[:count, :, i], values, casting='unsafe')
+        np.multiply(rgb[:count], valid[:count, :, np.newaxis],
+                    out=rgb[:count])
+        writer.write(rgb[:count])
+    writer.close()
+
+
+def preview_factor(shape, size=PREVIEW_SIZE):
+    """
+    Return the decimation that brings the longest side of shape down to
+    at most size pixels.
+    """
+    return max(1, -(-max(shape) // size))
+
+
+def render_preview(bands, out, size=PREVIEW_SIZE, block_rows=BLOCK_ROWS):
+    """
+    Render a preview of at most size pixels a side from decimated reads of
+    the bands. The stretch is computed from the same sample.
+    """
+    factor = preview_factor(bands[0].shape, size)
+    render_composite([band.decimated(factor) for band in bands], out,
+                     block_rows)
+
+
+class SceneBands(object):
+    """
+    Bands of one scene, each opened once and its stretch computed once,
+    for rendering several composites of the scene. open_band(number)
+    opens a band; with a preview_size, bands are read decimated to it.
+    """
+
+    def __init__(self, open_band, block_rows=BLOCK_ROWS, preview_size=None):
+        self.open_band = open_band
+        self.block_rows = block_rows
+        self.preview_size = preview_size
+        self.bands = {}
+        self.limits = {}
+
+    def band(self, number):
+        if number not in self.bands:
+            band = self.open_band(number)
+            if self.preview_size:
+                band = band.decimated(preview_factor(band.shape,
+                                                     self.preview_size))
+            self.bands[number] = band
+        return self.bands[number]
+
+    def stretch(self, number):
+        if number not in self.limits:
+            band = self.band(number)
+            raw = np.empty((min(self.block_rows, band.shape[0]),
+                            band.shape[1]), band.dtype)
+            self.limits[number] = stretch_limits(
+                band_histogram(band, self.block_rows, raw))
+        return self.limits[number]
+
+    def render(self, numbers, out):
+        """
+        Render the composite of the given band numbers into out.
+        """
+        render_composite([self.band(number) for number in numbers], out,
+                         self.block_rows,
+                         limits=[self.stretch(number) for number in numbers])
+
+    def close(self):
+        for band in self.bands.values():
+            band.close()
+        self.bands = {}
+
+
+def scene_path_row(entityid):
+    """
+    Return the WRS-2 path and row of a Landsat 8 scene id.
+    """
+    return int(entityid[3:6]), int(entityid[6:9])
+
+
+def composite_name(job):
+    return '{}_bands_{}{}{}_{}.png'.format(job.entityid, job.band1,
+                                           job.band2, job.band3,
+                                           job.rendertype)
+
+
+class FileOutput(object):
+    """
+    File object that writes to name in directory under a temporary name,
+    moved into place when closed.
+    """
+
+    def __init__(self, directory, name):
+        self.path = os.path.join(directory, name)
+        self.partial = self.path + '.part'
+        self.file = open(self.partial, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        os.rename(self.partial, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.partial)
+
+
+def band_source(band_cache, job, band, url):
+    """
+    Return where to read a band of a job from. Full renders read whole
+    bands, so they go through the band cache. Previews read a fraction of
+    a band, so they use a cached copy if there is one and otherwise read
+    straight from url.
+    """
+    if band_cache is None:
+        return '/vsicurl/' + url
+    if job.rendertype == u'preview':
+        return band_cache.lookup(job.entityid, band) or '/vsicurl/' + url
+    return band_cache.get(job.entityid, band, url)
+
+
+def job_renderer(settings, connect_s3=make_S3_connection):
+    """
+    Return a render function for the worker that reads bands from
+    render.band_url, through the band cache if render.band_cache.directory
+    is set, and streams composites to render.s3.bucket if it is set, or
+    else writes them into render.output_dir. It returns their urls under
+    render.output_url. Its open_scene opens the bands of a scene once for
+    a batch of jobs.
+    """
+    band_url = settings.get('render.band_url', LANDSAT_BAND_URL)
+    band_cache = None
+    if settings.get('render.band_cache.directory'):
+        band_cache = BandCache(
+            settings['render.band_cache.directory'],
+            int(settings.get('render.band_cache.max_bytes', 10 * 1024 ** 3)))
+    output_url = settings['render.output_url']
+    block_rows = int(settings.get('render.block_rows', BLOCK_ROWS))
+    preview_size = int(settings.get('render.preview_size', PREVIEW_SIZE))
+    if settings.get('render.s3.bucket'):
+        bucket = get_bucket(
+            connect_s3(settings.get('render.s3.region', 'us-west-2'),
+                       os.environ.get('AWS_ACCESS_KEY_ID'),
+                       os.environ.get('AWS_SECRET_ACCESS_KEY')),
+            settings['render.s3.bucket'])
+        part_size = int(settings.get('render.s3.part_size', PART_SIZE))
+        uploaders = int(settings.get('render.s3.uploaders', UPLOADERS))
+
+        def open_output(name, on_upload):
+            return S3Output(bucket, name, part_size, uploaders,
+                            on_upload=on_upload)
+    else:
+        output_dir = settings['render.output_dir']
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        def open_output(name, on_upload):
+            return FileOutput(output_dir, name)
+
+    def open_scene(job):
+        """
+        Return the bands of a job's scene, for the jobs of a batch.
+        """
+        path, row = scene_path_row(job.entityid)
+
+        def open_band(number):
+            url = band_url.format(entityid=job.entityid,
+                                  path=path, row=row, band=number)
+            return RasterioBand(band_source(band_cache, job, number, url))
+
+        if job.rendertype == u'preview':
+            return SceneBands(open_band, block_rows, preview_size)
+        return SceneBands(open_band, block_rows)
+
+    def render(job, set_status, scene=None):
+        numbers = (job.band1, job.band2, job.band3)
+        own_scene = scene is None
+        if own_scene:
+            scene = open_scene(job)
+        name = composite_name(job)
+        uploading = []
+
+        def start_upload():
+            if not uploading:
+                uploading.append(True)
+                set_status(4)
+
+        try:
+            for number in numbers:
+                scene.band(number)
+            set_status(2)
+            for number in numbers:
+                scene.stretch(number)
+            set_status(3)
+            # Parts of the PNG are uploaded as it is compressed, from the
+            # first one on; what is left goes up, or a file is moved into
+            # place, on close.
+            out = open_output(name, start_upload)
+            try:
+                scene.render(numbers, out)
+                start_upload()
+            except:
+                out.abort()
+                raise
+            out.close()
+        finally:
+            if own_scene:
+                scene.close()
+        return output_url.format(name=name)
+
+    render.open_scene = open_scene
+    render.band_cache = band_cache
+    return render
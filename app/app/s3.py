@@ -0,0 +1,168 @@
+"""
+Stream rendered composites to S3.
+
+S3Output is a file object that cuts what is written to it into parts and
+uploads them on a few threads while the writer carries on, so that
+compressing a composite and uploading it overlap instead of the file
+being written to disk and uploaded afterwards. At most a few parts are
+held in memory: writes block while every uploader is busy and the queue
+of parts waiting for one is full.
+"""
+import io
+import time
+import threading
+from Queue import Queue
+from boto.s3 import connect_to_region
+
+# S3 takes parts of at least 5 MB, except for the last one.
+PART_SIZE = 8 * 1024 * 1024
+
+# Parts uploaded at once.
+UPLOADERS = 4
+
+# Attempts at uploading a part before the upload is abandoned.
+ATTEMPTS = 3
+
+
+def make_S3_connection(region_name, aws_access_key_id, aws_secret_access_key):
+    """
+    Make an S3Connection to an AWS account. Pass in region, AWS access
+    key id, and AWS secret access key
+    """
+    return connect_to_region(region_name,
+                             aws_access_key_id=aws_access_key_id,
+                             aws_secret_access_key=aws_secret_access_key)
+
+
+def get_bucket(conn, bucket_name):
+    """
+    Get a bucket without a request to check that it exists.
+    """
+    return conn.get_bucket(bucket_name, validate=False)
+
+
+class S3Output(object):
+    """
+    File object that uploads what is written to it to key_name in bucket.
+    Output that fits in one part is sent with a single PUT when closed;
+    anything larger goes up as a multipart upload, completed by close.
+    abort drops whatever was uploaded. on_upload is called when the
+    multipart upload starts, on the writer's thread.
+    """
+
+    def __init__(self, bucket, key_name, part_size=PART_SIZE,
+                 uploaders=UPLOADERS, content_type='image/png',
+                 policy='public-read', on_upload=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.part_size = part_size
+        self.uploaders = uploaders
+        self.headers = {'Content-Type': content_type}
+        self.policy = policy
+        self.on_upload = on_upload
+        self.buffer = io.BytesIO()
+        self.upload = None
+        self.parts = 0
+        self.bytes = 0
+        self.upload_seconds = 0.0
+        self.error = None
+        self._threads = []
+        self._queue = Queue(maxsize=uploaders)
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        self._raise()
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_size:
+            data = self.buffer.getvalue()
+            full = len(data) - len(data) % self.part_size
+            for start in xrange(0, full, self.part_size):
+                self._submit(data[start:start + self.part_size])
+            self.buffer = io.BytesIO()
+            self.buffer.write(data[full:])
+
+    def _raise(self):
+        if self.error is not None:
+            raise self.error
+
+    def _submit(self, data):
+        if self.upload is None:
+            if self.on_upload is not None:
+                self.on_upload()
+            self.upload = self.bucket.initiate_multipart_upload(
+                self.key_name, headers=self.headers, policy=self.policy)
+            for _ in xrange(self.uploaders):
+                thread = threading.Thread(target=self._upload_parts)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self.parts += 1
+        self.bytes += len(data)
+        # Blocks while every uploader is busy and the queue is full.
+        self._queue.put((self.parts, data))
+
+    def _upload_parts(self):
+        while True:
+            part = self._queue.get()
+            if part is None:
+                return
+            if self.error is not None:
+                # Drain the queue so that writers are not left blocked.
+                continue
+            part_num, data = part
+            start = time.time()
+            for attempt in xrange(ATTEMPTS):
+                try:
+                    self.upload.upload_part_from_file(io.BytesIO(data),
+                                                      part_num,
+                                                      size=len(data))
+                    break
+                except Exception as e:
+                    if attempt == ATTEMPTS - 1:
+                        self.error = e
+            with self._lock:
+                self.upload_seconds += time.time() - start
+
+    def _join(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def close(self):
+        """
+        Upload what is left and wait for every part to be uploaded.
+        """
+        data = self.buffer.getvalue()
+        self.buffer = io.BytesIO()
+        if self.upload is None:
+            self._raise()
+            start = time.time()
+            key = self.bucket.new_key(self.key_name)
+            key.set_contents_from_file(io.BytesIO(data),
+                                       headers=self.headers,
+                                       policy=self.policy)
+            self.parts = 1
+            self.bytes = len(data)
+            self.upload_seconds = time.time() - start
+            return
+        if data and self.error is None:
+            self._submit(data)
+        self._join()
+        upload, self.upload = self.upload, None
+        if self.error is not None:
+            upload.cancel_upload()
+            raise self.error
+        upload.complete_upload()
+
+    def abort(self):
+        """
+        Stop uploading and throw away the parts uploaded so far.
+        """
+        if self.error is None:
+            self.error = IOError('upload aborted')
+        self._join()
+        if self.upload is not None:
+            self.upload.cancel_upload()
+            self.upload = None
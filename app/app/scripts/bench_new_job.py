@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import transaction
+from datetime import datetime
+
+from sqlalchemy import engine_from_config, event
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..models import Session, UserJob, RenderCache
+
+BENCH_PREFIX = u'BENCHJOB'
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [jobs]\n'
+          '(example: "%s development.ini 500")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def legacy_new_job(entityid, band1, band2, band3, rendertype):
+    """
+    Job creation as it used to be done: flush, refresh and commit the job,
+    then re-read it to build its render_cache row and commit again.
+    """
+    current_time = datetime.utcnow()
+    job = UserJob(entityid=entityid,
+                  band1=band1, band2=band2, band3=band3,
+                  jobstatus=0,
+                  starttime=current_time,
+                  lastmodified=current_time,
+                  rendertype=rendertype)
+    Session.add(job)
+    Session.flush()
+    Session.refresh(job)
+    pk = job.jobid
+    transaction.commit()
+    transaction.begin()
+    jobQuery = Session.query(UserJob).get(pk)
+    Session.add(RenderCache(entityid=jobQuery.entityid, jobid=pk,
+                            band1=jobQuery.band1, band2=jobQuery.band2,
+                            band3=jobQuery.band3, currentlyrend=True,
+                            rendertype=rendertype))
+    transaction.commit()
+    return pk
+
+
+def new_job(entityid, band1, band2, band3, rendertype):
+    return UserJob.new_job(entityid=entityid,
+                           band1=band1, band2=band2, band3=band3,
+                           rendertype=rendertype)
+
+
+def run(create, name, count, engine):
+    """
+    Create count jobs with create and return jobs per second and statements
+    per job.
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    start = time.time()
+    for i in xrange(count):
+        create(u'{}{}{:08d}'.format(BENCH_PREFIX, name, i), 4, 3, 2,
+               u'preview')
+    elapsed = time.time() - start
+    event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return count / elapsed, float(len(statements)) / count
+
+
+def cleanup():
+    with transaction.manager:
+        for model in (RenderCache, UserJob):
+            Session.query(model).filter(
+                model.entityid.like(BENCH_PREFIX + u'%')).delete(
+                synchronize_session=False)
+
+
+def main(argv=sys.argv):
+    """
+    Compare jobs created per second by the old and new job creation.
+    """
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    count = int(argv[2]) if len(argv) > 2 else 500
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    settings['sqlalchemy.url'] = os.environ.get('DATABASE_URL',
+                                                settings.get('sqlalchemy.url'))
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    Session.configure(bind=engine)
+
+    cleanup()
+    try:
+        for name, create in (('legacy', legacy_new_job), ('new', new_job)):
+            transaction.begin()
+            rate, per_job = run(create, name, count, engine)
+            transaction.commit()
+            print('%-8s %8.1f jobs/s  %4.1f statements/job' %
+                  (name, rate, per_job))
+    finally:
+        cleanup()
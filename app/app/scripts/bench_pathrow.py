@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import random
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..models import Session, Paths
+from ..wrs2 import WRS2Index
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [points]\n'
+          '(example: "%s development.ini 5000")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def random_points(count, seed=0):
+    """
+    Return count random (lat, lng) points over the area Landsat images.
+    """
+    rand = random.Random(seed)
+    return [(rand.uniform(-80.0, 80.0), round(rand.uniform(-180.0, 180.0), 5))
+            for _ in xrange(count)]
+
+
+def time_lookups(lookup, points):
+    """
+    Return the results of lookup for every point and the seconds it took.
+    """
+    start = time.time()
+    results = [lookup(lat, lng) for lat, lng in points]
+    return results, time.time() - start
+
+
+def main(argv=sys.argv):
+    """
+    Compare PostGIS and in-process path/row lookups over random points.
+    """
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    count = int(argv[2]) if len(argv) > 2 else 5000
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    settings['sqlalchemy.url'] = os.environ.get('DATABASE_URL',
+                                                settings.get('sqlalchemy.url'))
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    Session.configure(bind=engine)
+
+    start = time.time()
+    index = WRS2Index.from_rows(Paths.footprints())
+    load_time = time.time() - start
+
+    points = random_points(count)
+    postgis, postgis_time = time_lookups(Paths.pathandrow, points)
+    local, local_time = time_lookups(index.lookup, points)
+
+    mismatches = sum(
+        1 for a, b in zip(postgis, local)
+        if sorted((x.path, x.row) for x in a) !=
+        sorted((x.path, x.row) for x in b))
+
+    print('footprints indexed: %d in %.2fs' % (len(index), load_time))
+    print('points:             %d' % count)
+    print('postgis:            %.1f us/lookup' % (postgis_time / count * 1e6))
+    print('index:              %.1f us/lookup' % (local_time / count * 1e6))
+    print('speedup:            %.0fx' % (postgis_time / max(local_time, 1e-9)))
+    print('mismatches:         %d' % mismatches)
+    if mismatches:
+        sys.exit(1)
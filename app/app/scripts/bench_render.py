@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import numpy as np
+from multiprocessing import Process, Queue
+
+from ..render import (RawBand, PNGWriter, render_composite, render_preview,
+                      STRETCH, NODATA)
+
+# Size of a Landsat 8 band.
+LANDSAT_SHAPE = (7800, 7700)
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s [rows] [columns] [block_rows]\n'
+          '(example: "%s 7800 7700 512")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def write_band(path, shape, seed):
+    """
+    Write a synthetic band, with a border of fill like a real scene, a
+    block of rows at a time.
+    """
+    rand = np.random.RandomState(seed)
+    border = shape[1] // 10
+    with open(path, 'wb') as out:
+        for start in xrange(0, shape[0], 512):
+            rows = min(512, shape[0] - start)
+            block = rand.randint(5000, 30000, (rows, shape[1])).astype(
+                np.uint16)
+            block[:, :border] = NODATA
+            block.tofile(out)
+
+
+def whole_array_render(bands, out):
+    """
+    Rendering as landsat-util does it: load, stack and scale whole bands.
+    """
+    stack = np.dstack([np.fromfile(band.file, band.dtype).reshape(band.shape)
+                       for band in bands])
+    valid = (stack != NODATA).all(axis=2)
+    rgb = np.zeros(stack.shape, np.uint8)
+    for i in range(3):
+        band = stack[:, :, i].astype(np.float32)
+        low, high = np.percentile(band[band != NODATA], STRETCH)
+        rgb[:, :, i] = np.clip((band - low) * 255.0 / (high - low), 0, 255)
+    rgb[~valid] = 0
+    writer = PNGWriter(out, stack.shape[1], stack.shape[0])
+    writer.write(rgb)
+    writer.close()
+
+
+def block_render(block_rows):
+    return lambda bands, out: render_composite(bands, out, block_rows)
+
+
+def run(render, paths, shape, results):
+    bands = [RawBand(path, shape) for path in paths]
+    start = time.time()
+    with open(os.devnull, 'wb') as out:
+        render(bands, out)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux.
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def measure(render, paths, shape):
+    """
+    Render in a fresh process, so that each renderer's peak RSS is its own,
+    and return seconds taken and peak RSS in MB.
+    """
+    results = Queue()
+    process = Process(target=run, args=(render, paths, shape, results))
+    process.start()
+    elapsed, maxrss = results.get()
+    process.join()
+    return elapsed, maxrss / 1024.0
+
+
+def main(argv=sys.argv):
+    """
+    Compare time, throughput and peak memory of whole-array, block-wise
+    and preview rendering of three synthetic bands.
+    """
+    try:
+        rows = int(argv[1]) if len(argv) > 1 else LANDSAT_SHAPE[0]
+        columns = int(argv[2]) if len(argv) > 2 else LANDSAT_SHAPE[1]
+        block_rows = int(argv[3]) if len(argv) > 3 else 512
+    except ValueError:
+        usage(argv)
+    shape = (rows, columns)
+    directory = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(directory, 'B{}.raw'.format(band))
+                 for band in (4, 3, 2)]
+        for seed, path in enumerate(paths):
+            write_band(path, shape, seed)
+        megabytes = 3 * rows * columns * 2 / 1e6
+        print('%d x %d pixels, %.0f MB of bands' % (rows, columns, megabytes))
+        for name, render in (('whole', whole_array_render),
+                             ('blocks', block_render(block_rows)),
+                             ('preview', render_preview)):
+            elapsed, peak = measure(render, paths, shape)
+            print('%-8s %7.2f s  %8.1f MB/s  peak RSS %8.1f MB' %
+                  (name, elapsed, megabytes / elapsed, peak))
+    finally:
+        shutil.rmtree(directory)
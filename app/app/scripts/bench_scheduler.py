@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import random
+import threading
+
+from ..fakes import FakeSQS
+from ..sqs import SQSClient, build_job_message
+from .worker import Worker, QueueSpec
+
+QUEUE = 'bench_queue'
+
+# Simulated seconds to load a band and to render a composite, run SPEEDUP
+# times faster than real time.
+LOAD_SECONDS = 20.0
+RENDER_SECONDS = 8.0
+SPEEDUP = 400.0
+
+COMBOS = [(4, 3, 2), (5, 4, 3), (7, 6, 4), (6, 5, 2), (7, 5, 3), (5, 6, 4)]
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s [jobs] [scenes] [threads]\n'
+          '(example: "%s 400 40 4")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def click_order(count, scenes, seed=0):
+    """
+    Return count (scene, bands) requests as users make them: a few popular
+    scenes, each asked for in several combos, interleaved.
+    """
+    rand = random.Random(seed)
+    weights = [1.0 / (rank + 1) for rank in xrange(scenes)]
+    names = [u'LC8{:03d}0272015{:03d}LGN00'.format(scene, scene)
+             for scene in xrange(scenes)]
+    requests = []
+    for _ in xrange(count):
+        scene = rand.random() * sum(weights)
+        for name, weight in zip(names, weights):
+            scene -= weight
+            if scene <= 0:
+                break
+        requests.append((name, rand.choice(COMBOS)))
+    return requests
+
+
+class SimulatedScene(object):
+    """
+    Scene whose bands take LOAD_SECONDS to load, once each.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.bands = set()
+
+    def band(self, number):
+        if number not in self.bands:
+            time.sleep(LOAD_SECONDS / SPEEDUP)
+            with self.stats['lock']:
+                self.stats['band_reads'] += 1
+            self.bands.add(number)
+
+    def close(self):
+        pass
+
+
+def simulated_renderer(stats):
+    def open_scene(job):
+        return SimulatedScene(stats)
+
+    def render(job, set_status, scene=None):
+        own_scene = scene is None
+        if own_scene:
+            scene = open_scene(job)
+        for number in (job.band1, job.band2, job.band3):
+            scene.band(number)
+        time.sleep(RENDER_SECONDS / SPEEDUP)
+        with stats['lock']:
+            stats['latencies'].append(time.time() - stats['start'])
+        return u'http://example.com/{}.png'.format(job.jobid)
+
+    render.open_scene = open_scene
+    return render
+
+
+def simulate(requests, threads, batched):
+    """
+    Drain a queue of requests with a worker and return band reads per
+    job, jobs per hour and mean and worst seconds to finish a job, all in
+    simulated time.
+    """
+    client = SQSClient('us-west-2', 'key', 'secret', connect=FakeSQS())
+    for jobid, (scene, bands) in enumerate(requests):
+        message = build_job_message(job_id=jobid, scene_id=scene,
+                                    band_1=bands[0], band_2=bands[1],
+                                    band_3=bands[2])
+        client.send_message(QUEUE, message['body'], message['attributes'])
+    stats = {'band_reads': 0, 'latencies': [], 'lock': threading.Lock(),
+             'start': time.time()}
+    render = simulated_renderer(stats)
+    worker = Worker(client, [QueueSpec(QUEUE, u'full')], render,
+                    concurrency=threads, wait_time_seconds=0,
+                    open_scene=render.open_scene if batched else None,
+                    window=40 if batched else None,
+                    max_wait=0, record_status=lambda *args: None)
+    worker.start()
+    while worker.processed < len(requests):
+        worker.receive()
+    worker.join()
+    elapsed = (time.time() - stats['start']) * SPEEDUP
+    latencies = [latency * SPEEDUP for latency in stats['latencies']]
+    return (float(stats['band_reads']) / len(requests),
+            len(requests) / elapsed * 3600,
+            sum(latencies) / len(latencies), max(latencies))
+
+
+def main(argv=sys.argv):
+    """
+    Compare click-order and scene-batched scheduling of a backlog of jobs.
+    """
+    try:
+        jobs = int(argv[1]) if len(argv) > 1 else 400
+        scenes = int(argv[2]) if len(argv) > 2 else 40
+        threads = int(argv[3]) if len(argv) > 3 else 4
+    except ValueError:
+        usage(argv)
+    requests = click_order(jobs, scenes)
+    print('%d jobs over %d scenes on %d threads' % (jobs, scenes, threads))
+    for name, batched in (('fifo', False), ('batched', True)):
+        reads, rate, mean, worst = simulate(requests, threads, batched)
+        print('%-8s %5.2f band reads/job  %7.1f jobs/hour  '
+              'finish mean %6.0f s  worst %6.0f s' %
+              (name, reads, rate, mean, worst))
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import transaction
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import Pool
+from webtest import TestApp
+
+from .. import main as make_app, profiling
+from ..models import Session, Base
+from ..migrations import migrate
+from ..synthetic import generate, BAND_COMBOS
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'bench_web.json')
+
+# A view regresses when it issues more queries than its baseline, or when
+# its p95 latency grows past TOLERANCE times the baseline plus SLACK_MS.
+TOLERANCE = 1.5
+SLACK_MS = 2.0
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s [requests] [baseline] [save]\n'
+          '(example: "%s 500 bench_web.json save")' % (cmd, cmd))
+    sys.exit(2)
+
+
+def sqlite_functions(dbapi_connection, connection_record):
+    """
+    Stand in for the PostGIS function the wrs2 index is loaded with;
+    synthetic footprints are stored as WKT already.
+    """
+    if hasattr(dbapi_connection, 'create_function'):
+        dbapi_connection.create_function('ST_AsText', 1, lambda wkt: wkt)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+
+def requests_for(data):
+    """
+    Return (name, route, make) for every benchmarked view, make returning
+    the url, params and headers of a random request.
+    """
+    def scene_options(rand):
+        lat, lng = data.point(rand)
+        return '/scene_options_ajax/', {'lat': lat, 'lng': lng}, {}
+
+    def scene(rand):
+        return '/scene/{}/'.format(rand.choice(data.popular)), {}, {}
+
+    def scene_band(rand):
+        return '/scene/{}/bands/{}/'.format(rand.choice(data.popular),
+                                            rand.choice(BAND_COMBOS)), {}, {}
+
+    def status_poll(rand):
+        return '/status_poll/', {'jobid': rand.choice(data.jobids)}, {}
+
+    def request_composite(rand):
+        # Mostly composites that already exist, some new ones.
+        scene_id = rand.choice(data.popular if rand.random() < 0.8
+                               else data.scenes)
+        bands = rand.sample('1234567', 3)
+        return ('/request/preview/{}/'.format(scene_id),
+                {'band1': bands[0], 'band2': bands[1], 'band3': bands[2]},
+                {'Referer': 'http://localhost/scene/{}/'.format(scene_id)})
+
+    return [('scene_options_ajax', 'scene_options_ajax', scene_options),
+            ('scene', 'scene', scene),
+            ('scene_band', 'scene_band', scene_band),
+            ('status_poll', 'status_poll', status_poll),
+            ('request_composite', 'request', request_composite)]
+
+
+def run(app, route, make, count, rand):
+    """
+    Make count requests and return latency percentiles in milliseconds and
+    queries per request.
+    """
+    profiling.route_stats = profiling.RouteStats()
+    latencies = []
+    for _ in xrange(count):
+        url, params, headers = make(rand)
+        start = time.time()
+        app.get(url, params, headers=headers, status=[200, 302])
+        latencies.append((time.time() - start) * 1000)
+    stats = profiling.route_stats.stats()[route]
+    return {'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'mean_queries': round(stats['mean_queries'], 2),
+            'max_queries': stats['max_queries']}
+
+
+def regressions(results, baseline):
+    """
+    Return a description of every view that got worse than its baseline.
+    """
+    found = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        if result['max_queries'] > before['max_queries']:
+            found.append('%s: %d queries, baseline %d' % (
+                name, result['max_queries'], before['max_queries']))
+        if result['p95_ms'] > before['p95_ms'] * TOLERANCE + SLACK_MS:
+            found.append('%s: p95 %.1f ms, baseline %.1f ms' % (
+                name, result['p95_ms'], before['p95_ms']))
+    return found
+
+
+def main(argv=sys.argv):
+    """
+    Benchmark the web views in process against synthetic data and compare
+    latency and query counts with a baseline.
+    """
+    try:
+        count = int(argv[1]) if len(argv) > 1 else 500
+    except ValueError:
+        usage(argv)
+    baseline_path = argv[2] if len(argv) > 2 else BASELINE
+    save = len(argv) > 3 and argv[3] == 'save'
+
+    directory = tempfile.mkdtemp()
+    try:
+        url = 'sqlite:///' + os.path.join(directory, 'bench.sqlite')
+        event.listen(Pool, 'connect', sqlite_functions)
+        engine = create_engine(url)
+        Base.metadata.create_all(engine)
+        migrate(engine)
+        engine.dispose()
+        # The app reads its database from DATABASE_URL.
+        os.environ['DATABASE_URL'] = url
+        app = TestApp(make_app({}, **{
+            'pyramid.includes': 'pyramid_tm',
+            'wrs2.index': 'true',
+            'scene_cache.size': '512',
+            'scene_cache.timeout': '300',
+            'job_stream.enabled': 'false',
+            'sqs.backend': 'fake',
+            'profiling.enabled': 'true',
+            'profiling.slow_query_ms': '1000'}))
+        with transaction.manager:
+            data = generate()
+        Session.remove()
+        print('%d scenes, %d jobs, %d requests per view' %
+              (len(data.scenes), len(data.jobids), count))
+
+        rand = random.Random(0)
+        results = {}
+        for name, route, make in requests_for(data):
+            # Warm up templates, the wrs2 index and the caches.
+            run(app, route, make, 20, rand)
+            results[name] = result = run(app, route, make, count, rand)
+            print('%-20s p50 %6.2f ms  p95 %6.2f ms  p99 %6.2f ms  '
+                  '%4.1f queries (max %d)' %
+                  (name, result['p50_ms'], result['p95_ms'],
+                   result['p99_ms'], result['mean_queries'],
+                   result['max_queries']))
+    finally:
+        shutil.rmtree(directory)
+
+    if save or not os.path.exists(baseline_path):
+        with open(baseline_path, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+        print('baseline written to %s' % baseline_path)
+        return
+    with open(baseline_path) as baseline:
+        found = regressions(results, json.load(baseline))
+    for regression in found:
+        print('REGRESSION %s' % regression)
+    if found:
+        sys.exit(1)
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import transaction
+from datetime import datetime
+
+from sqlalchemy import engine_from_config, event, text
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..models import (Session, Paths, PathRow, PathRowSummary, UserJob,
+                      RenderCache, JobLatency)
+
+# Tables with at least this many rows are expected to be read through an
+# index by every hot query.
+MIN_ROWS = 10000
+
+# Queries that read their whole table on purpose.
+FULL_SCANS = ('Paths.footprints', 'JobLatency.histograms')
+
+CHECK_SCENE = u'EXPLAINCHECK0000000000'
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [min_rows]\n'
+          '(example: "%s development.ini 10000")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def model_queries():
+    """
+    Return (name, call) for every model query on a request path. None of
+    the calls commit, so their writes are rolled back with the check.
+    """
+    row = Session.query(PathRow.entityid, PathRow.path, PathRow.row,
+                        PathRow.acquisitiondate).first()
+    entityid = row.entityid if row else CHECK_SCENE
+    path_row = [row] if row else []
+    pathrows = [(row.path, row.row)] if row else []
+    after = (row.acquisitiondate, row.entityid) if row else None
+    jobid = Session.query(UserJob.jobid).order_by(
+        UserJob.jobid.desc()).limit(1).scalar() or 0
+    return [
+        ('Paths.pathandrow', lambda: Paths.pathandrow(47.6, -122.3)),
+        ('Paths.footprints', lambda: Paths.footprints()),
+        ('PathRow.scenelist', lambda: PathRow.scenelist(path_row).all()),
+        ('PathRow.scenelist filtered', lambda: PathRow.scenelist(
+            path_row, max_cloud=50, start=datetime(2015, 1, 1),
+            end=datetime(2016, 1, 1), limit=100).all()),
+        ('PathRow.scenelist page', lambda: PathRow.scenelist(
+            path_row, limit=100, after=after).all()),
+        ('PathRowSummary.for_pathrows',
+         lambda: PathRowSummary.for_pathrows(pathrows)),
+        ('PathRowSummary.refresh', lambda: PathRowSummary.refresh(pathrows)),
+        ('PathRow.meta_data', lambda: PathRow.meta_data(entityid)),
+        ('UserJob.insert', lambda: UserJob.insert(
+            CHECK_SCENE, 4, 3, 2, u'preview')),
+        ('UserJob.job_status', lambda: UserJob.job_status(jobid)),
+        ('UserJob.job_status_and_times',
+         lambda: UserJob.job_status_and_times(jobid)),
+        ('UserJob.set_job_status', lambda: UserJob.set_job_status(jobid, 1)),
+        ('UserJob.jobs_status', lambda: UserJob.jobs_status([jobid])),
+        ('RenderCache.add', lambda: RenderCache.add(
+            jobid, CHECK_SCENE, 4, 3, 2, True, u'preview')),
+        ('RenderCache.update', lambda: RenderCache.update(jobid, True, None)),
+        ('RenderCache.get_rendered_rendering_composites_sceneid',
+         lambda: RenderCache.get_rendered_rendering_composites_sceneid(
+             entityid)),
+        ('RenderCache.get_rendered_rendering_composites_band_combo',
+         lambda: RenderCache.get_rendered_rendering_composites_band_combo(
+             entityid, 4, 3, 2)),
+        ('RenderCache.hit', lambda: RenderCache.hit(
+            entityid, 4, 3, 2, u'preview')),
+        ('RenderCache.composite_job', lambda: RenderCache.composite_job(
+            entityid, 4, 3, 2, u'preview')),
+        ('RenderCache.get_renderurl',
+         lambda: RenderCache.get_renderurl(jobid)),
+        ('JobLatency.record', lambda: JobLatency.record(
+            u'preview', u'collect', 1.0)),
+        ('JobLatency.histograms', lambda: JobLatency.histograms()),
+        ]
+
+
+def committing_queries():
+    """
+    Return (name, call) for the model queries that commit. They write only
+    rows of CHECK_SCENE, which remove_check_rows deletes afterwards.
+    """
+    claimed = {}
+
+    def claim():
+        claimed['jobid'], _ = RenderCache.claim(CHECK_SCENE, 5, 4, 3,
+                                                u'preview')
+
+    return [
+        ('RenderCache.claim', claim),
+        ('RenderCache.replace_failed_job',
+         lambda: RenderCache.replace_failed_job(
+             CHECK_SCENE, 5, 4, 3, u'preview', claimed.get('jobid'))),
+        ]
+
+
+def remove_check_rows():
+    with transaction.manager:
+        Session.query(RenderCache).filter(
+            RenderCache.entityid == CHECK_SCENE).delete(
+            synchronize_session=False)
+        Session.query(UserJob).filter(
+            UserJob.entityid == CHECK_SCENE).delete(
+            synchronize_session=False)
+
+
+def capture(engine, call):
+    """
+    Run call and return the (statement, parameters) it executed.
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        call()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def seq_scans(plan):
+    """
+    Yield the relation of every sequential scan in an EXPLAIN plan.
+    """
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', ()):
+        for relation in seq_scans(child):
+            yield relation
+
+
+def explain(statement, parameters):
+    cursor = Session.connection().connection.cursor()
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+    plan = cursor.fetchone()[0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def table_rows():
+    """
+    Return the planner's row estimate for every table.
+    """
+    return dict(Session.execute(text(
+        "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")))
+
+
+def check(engine, queries, rows, min_rows):
+    """
+    EXPLAIN the statements of every (name, call) in queries and return the
+    names of those that scan a large table sequentially.
+    """
+    failures = []
+    for name, call in queries:
+        for statement, parameters in capture(engine, call):
+            scans = [relation for relation in
+                     seq_scans(explain(statement, parameters))
+                     if rows.get(relation, 0) >= min_rows]
+            if scans and name not in FULL_SCANS:
+                failures.append(name)
+                print('FAIL %s: Seq Scan on %s\n  %s' %
+                      (name, ', '.join(scans), ' '.join(statement.split())))
+            else:
+                print('ok   %s' % name)
+    return failures
+
+
+def main(argv=sys.argv):
+    """
+    EXPLAIN every model query and exit non-zero if any of them scans a
+    large table sequentially. Run it against a database of realistic size.
+    """
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    min_rows = int(argv[2]) if len(argv) > 2 else MIN_ROWS
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    settings['sqlalchemy.url'] = os.environ.get('DATABASE_URL',
+                                                settings.get('sqlalchemy.url'))
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    if engine.dialect.name != 'postgresql':
+        print('explain_check needs a Postgres database')
+        sys.exit(2)
+    Session.configure(bind=engine)
+
+    failures = []
+    transaction.begin()
+    try:
+        rows = table_rows()
+        failures.extend(check(engine, model_queries(), rows, min_rows))
+    finally:
+        transaction.abort()
+    # The queries that commit run after the others have been rolled back,
+    # so that they do not commit them.
+    transaction.begin()
+    try:
+        failures.extend(check(engine, committing_queries(), rows,
+                              min_rows))
+    finally:
+        transaction.abort()
+        remove_check_rows()
+
+    if failures:
+        sys.exit(1)
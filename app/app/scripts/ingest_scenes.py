@@ -0,0 +1,43 @@
+import os
+import sys
+import transaction
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..models import Session
+from ..ingest import ingest, SCENE_LIST_URL
+from ..cache import touch_stamp
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [scene_list]\n'
+          '(example: "%s development.ini scene_list.gz")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    """
+    Load the AWS scene list, or a local copy of it, into path_row, then
+    tell the web workers their cached scene lists are stale.
+    """
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    source = argv[2] if len(argv) > 2 else SCENE_LIST_URL
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    settings['sqlalchemy.url'] = os.environ.get('DATABASE_URL',
+                                                settings.get('sqlalchemy.url'))
+    Session.configure(bind=engine_from_config(settings, 'sqlalchemy.'))
+    with transaction.manager:
+        stats = ingest(source)
+    print(stats)
+    stamp_file = settings.get('scene_cache.stamp_file')
+    if stamp_file and (stats.new or stats.changed):
+        touch_stamp(stamp_file)
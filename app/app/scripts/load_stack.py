@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import signal
+import tempfile
+import subprocess
+import urllib2
+import transaction
+
+from sqlalchemy import create_engine
+
+from ..models import Session, Base
+from ..migrations import migrate
+from ..synthetic import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+LOCUSTFILE = os.path.join(ROOT, 'locustfile.py')
+GUNICORN_CONF = os.path.join(ROOT, 'app', 'gunicorn_conf.py')
+
+# Settings the stack overrides in the given config.
+OVERRIDES = [('sqs.backend', 'fake'),
+             ('wrs2.index', 'true'),
+             ('job_stream.enabled', 'false'),
+             ('profiling.enabled', 'true'),
+             ('profiling.server_timing', 'false')]
+
+# Seconds to wait for Postgres and gunicorn to come up.
+STARTUP_SECONDS = 30
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [workers] [clients] [requests]\n'
+          '(example: "%s development.ini 4 200 20000")' % (cmd, cmd))
+    sys.exit(2)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(url, process):
+    """
+    Wait until url answers, failing if process exits first.
+    """
+    deadline = time.time() + STARTUP_SECONDS
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('%s exited with %d' % (url, process.returncode))
+        try:
+            urllib2.urlopen(url, timeout=1).close()
+            return
+        except urllib2.HTTPError:
+            return
+        except (urllib2.URLError, socket.error):
+            time.sleep(0.2)
+    raise RuntimeError('%s did not answer in %d seconds' %
+                       (url, STARTUP_SECONDS))
+
+
+def start_postgres(directory):
+    """
+    Start a throwaway Postgres cluster in directory and return its url.
+    """
+    data = os.path.join(directory, 'pgdata')
+    port = free_port()
+    subprocess.check_call(['initdb', '-A', 'trust', '-U', 'postgres',
+                           '-D', data], stdout=open(os.devnull, 'w'))
+    subprocess.check_call(['pg_ctl', 'start', '-w', '-D', data,
+                           '-l', os.path.join(directory, 'postgres.log'),
+                           '-o', '-p %d -k %s -h 127.0.0.1' %
+                           (port, directory)])
+    server = 'postgresql://postgres@127.0.0.1:%d/' % port
+    engine = create_engine(server + 'postgres',
+                           isolation_level='AUTOCOMMIT')
+    engine.execute('CREATE DATABASE landsat')
+    engine.dispose()
+    return server + 'landsat'
+
+
+def stop_postgres(directory):
+    subprocess.call(['pg_ctl', 'stop', '-m', 'fast', '-D',
+                     os.path.join(directory, 'pgdata')])
+
+
+def prepare_database(url):
+    """
+    Create the schema in the database at url and fill it with synthetic
+    data. Without PostGIS, footprints are loaded through a stand-in for
+    the one PostGIS function the wrs2 index needs, as they are stored as
+    WKT already.
+    """
+    engine = create_engine(url)
+    try:
+        engine.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+    except Exception:
+        print('PostGIS is not available, standing in for ST_AsText')
+        engine.execute("CREATE OR REPLACE FUNCTION ST_AsText(text) "
+                       "RETURNS text AS 'SELECT $1' LANGUAGE sql IMMUTABLE")
+    Base.metadata.create_all(engine)
+    migrate(engine)
+    Session.configure(bind=engine)
+    with transaction.manager:
+        data = generate()
+    Session.remove()
+    engine.dispose()
+    print('%d scenes, %d jobs' % (len(data.scenes), len(data.jobids)))
+
+
+def write_config(config_uri, directory):
+    """
+    Write a config that extends config_uri with OVERRIDES and return its
+    path.
+    """
+    path = os.path.join(directory, 'stack.ini')
+    with open(path, 'w') as out:
+        out.write('[app:main]\nuse = config:%s#main\n' %
+                  os.path.abspath(config_uri))
+        for key, value in OVERRIDES:
+            out.write('%s = %s\n' % (key, value))
+    return path
+
+
+def start_gunicorn(config, directory, workers, port, env):
+    return subprocess.Popen(
+        ['gunicorn', '--paste', config, '-c', GUNICORN_CONF,
+         '--workers', str(workers), '--bind', '127.0.0.1:%d' % port,
+         '--log-file', os.path.join(directory, 'gunicorn.log'),
+         '--pid', os.path.join(directory, 'gunicorn.pid')], env=env)
+
+
+def run_locust(host, clients, requests):
+    """
+    Run locustfile headless and return the requests per second it reached.
+    """
+    output = subprocess.check_output(
+        ['locust', '-f', LOCUSTFILE, '--host', host, '--no-web',
+         '-c', str(clients), '-r', str(max(1, clients // 10)),
+         '-n', str(requests), '--only-summary'],
+        stderr=subprocess.STDOUT)
+    print(output)
+    for line in output.splitlines():
+        fields = line.split()
+        if fields and fields[0] == 'Total':
+            return float(fields[-1])
+    return None
+
+
+def main(argv=sys.argv):
+    """
+    Serve synthetic data with gunicorn on a local database and a fake SQS,
+    and load it with locustfile.py. Uses DATABASE_URL when set, otherwise
+    starts a throwaway Postgres. Without clients, prints how to run locust
+    and serves until interrupted.
+    """
+    if len(argv) < 2:
+        usage(argv)
+    try:
+        workers = int(argv[2]) if len(argv) > 2 else 4
+        clients = int(argv[3]) if len(argv) > 3 else None
+        requests = int(argv[4]) if len(argv) > 4 else 10000
+    except ValueError:
+        usage(argv)
+
+    directory = tempfile.mkdtemp()
+    url = os.environ.get('DATABASE_URL')
+    postgres = url is None
+    gunicorn = None
+    try:
+        if postgres:
+            url = start_postgres(directory)
+        prepare_database(url)
+        port = free_port()
+        host = 'http://127.0.0.1:%d' % port
+        env = dict(os.environ, DATABASE_URL=url)
+        gunicorn = start_gunicorn(write_config(argv[1], directory),
+                                  directory, workers, port, env)
+        wait_for(host + '/', gunicorn)
+        print('%d workers serving at %s' % (workers, host))
+
+        if clients is None:
+            print('locust -f %s --host %s' % (LOCUSTFILE, host))
+            try:
+                gunicorn.wait()
+            except KeyboardInterrupt:
+                pass
+            return
+        rps = run_locust(host, clients, requests)
+        if rps is not None:
+            print('%.1f requests/s, %.1f per worker' % (rps, rps / workers))
+    finally:
+        if gunicorn is not None and gunicorn.poll() is None:
+            gunicorn.send_signal(signal.SIGTERM)
+            gunicorn.wait()
+        if postgres:
+            stop_postgres(directory)
+        shutil.rmtree(directory)
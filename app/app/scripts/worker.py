@@ -0,0 +1,525 @@
+import os
+import sys
+import math
+import time
+import signal
+import threading
+import traceback
+import transaction
+from Queue import Queue
+from collections import namedtuple, OrderedDict
+from multiprocessing import cpu_count
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+from pyramid.path import DottedNameResolver
+from pyramid.scripts.common import parse_vars
+
+from ..models import Session, UserJob, RenderCache
+from ..sqs import SQSClient, message_attributes
+from ..views import (REGION, PREVIEW_QUEUE, COMPOSITE_QUEUE,
+                     AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+
+QUEUES = OrderedDict([(u'preview', PREVIEW_QUEUE),
+                      (u'full', COMPOSITE_QUEUE)])
+
+# A received job, as sent by views.add_to_queue.
+Job = namedtuple('Job', ['jobid', 'entityid', 'band1', 'band2', 'band3',
+                         'rendertype'])
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [preview|full|all] [var=value]\n'
+          '(example: "%s production.ini all")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def parse_job(message, rendertype):
+    """
+    Build a Job from the attributes of a queued message.
+    """
+    attributes = message_attributes(message)
+    return Job(int(attributes['job_id']), attributes['scene_id'],
+               int(attributes['band_1']), int(attributes['band_2']),
+               int(attributes['band_3']), rendertype)
+
+
+def set_status(jobid, jobstatus, renderurl=None):
+    """
+    Record a job's transition to jobstatus in its own transaction, so that
+    pages watching the job see it at once. A finished job's render url is
+    recorded with its last transition. Going back to queued resets the
+    status without recording stage latency.
+    """
+    with transaction.manager:
+        if renderurl is not None:
+            RenderCache.update(jobid, False, renderurl)
+        if jobstatus == 0:
+            UserJob.requeue(jobid)
+        else:
+            UserJob.set_job_status(jobid, jobstatus)
+
+
+class QueueSpec(namedtuple('QueueSpec', ['name', 'rendertype', 'weight',
+                                         'slo'])):
+    """
+    A queue a worker consumes: its name, the rendertype of its jobs, its
+    weight in sharing the worker's threads with other queues and, for
+    queues users wait on, the seconds within which its jobs should start.
+    """
+
+    def __new__(cls, name, rendertype, weight=1, slo=None):
+        return super(QueueSpec, cls).__new__(cls, name, rendertype, weight,
+                                             slo)
+
+
+class Preempted(Exception):
+    """
+    Raised at the next stage of a job that gave up its thread.
+    """
+
+
+class Running(object):
+    """
+    A group of jobs running on a thread.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.started = time.time()
+        self.preempt = threading.Event()
+
+
+class Worker(object):
+    """
+    Render jobs from one or more queues on a bounded pool of threads.
+
+    Received messages wait in a window of at most window messages per
+    queue, grouped by scene, and each group is rendered on one thread.
+    With open_scene, a group shares one load of its scene's bands:
+    open_scene(job) returns the scene's bands, to be passed to render and
+    closed afterwards. A group is held back for more jobs of its scene
+    while the window has room, the queue has more messages and its oldest
+    job has waited less than max_wait seconds.
+
+    Threads are shared between queues in proportion to their weights.
+    Jobs of a queue with an slo jump ahead once they have waited half of
+    it, other queues' groups do not take the last reserve threads while
+    such jobs wait, and when no thread is free the most recently started
+    group of another queue is preempted: it stops at its next stage and
+    its remaining messages go back to their queue.
+
+    A heartbeat thread keeps the messages of waiting and running jobs
+    hidden from other workers until they are done.
+
+    render(job, set_status[, scene]) renders a Job, calling
+    set_status(jobstatus) as it moves through the stages of status_key,
+    and returns the render url.
+    """
+
+    MAX_RECEIVE = 10
+
+    # Fraction of its slo after which a waiting job is urgent.
+    URGENT = 0.5
+
+    def __init__(self, client, queues, render, concurrency=None,
+                 visibility_timeout=300, heartbeat=60, wait_time_seconds=20,
+                 open_scene=None, window=None, max_wait=0, reserve=0,
+                 record_status=set_status):
+        self.client = client
+        # Queues users wait on are polled first.
+        self.queues = sorted(queues, key=lambda spec: (spec.slo is None,
+                                                       -spec.weight))
+        self.render = render
+        self.concurrency = concurrency or cpu_count()
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat = heartbeat
+        self.wait_time_seconds = wait_time_seconds
+        self.open_scene = open_scene
+        self.window = max(window or self.concurrency, self.concurrency)
+        self.max_wait = max_wait
+        self.reserve = min(reserve, self.concurrency - 1)
+        self.record_status = record_status
+        self.running = {}
+        self.pending = OrderedDict()
+        self.active = set()
+        self.processed = 0
+        self.failed = 0
+        self.preempted = 0
+        self.served = dict((spec.name, 0) for spec in self.queues)
+        self.waits = dict((spec.name, []) for spec in self.queues)
+        self.idle = self.concurrency
+        self._jobs = Queue()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._stopping = threading.Event()
+        self._done = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """
+        Start the pool and heartbeat threads.
+        """
+        for _ in xrange(self.concurrency):
+            self._spawn(self._work)
+        self._spawn(self._beat)
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def run(self):
+        """
+        Receive and run jobs until stop is called, then wait for the jobs
+        already received.
+        """
+        self.start()
+        while not self._stopping.is_set():
+            self.receive()
+        self.join()
+
+    def group_key(self, spec, job, message):
+        if self.open_scene is None:
+            return spec, message.receipt_handle
+        return spec, job.entityid
+
+    def waiting(self, spec=None):
+        return sum(len(group) for key, group in self.pending.iteritems()
+                   if spec is None or key[0] == spec)
+
+    def receive(self):
+        """
+        Receive messages into the windows, up to 10 at a time from each
+        queue, and hand groups that are ready to idle threads.
+        """
+        with self._lock:
+            if self.pending and not self.idle:
+                self._idle.wait(self._patience())
+            rooms = [(spec, self.window - self.waiting(spec))
+                     for spec in self.queues]
+            wait = self.wait_time_seconds
+            if self.pending:
+                # Wait for more jobs of held groups only until the oldest
+                # of them is due. SQS takes whole seconds.
+                oldest = min(group[0][0] for group in self.pending.values())
+                due = oldest + self.max_wait - time.time()
+                wait = max(0, min(wait, int(math.ceil(due))))
+        drained = set()
+        received = 0
+        for spec, room in rooms:
+            if room <= 0:
+                continue
+            # Only the first queue is long-polled.
+            messages = self._get_messages(spec, room,
+                                          0 if received or spec != rooms[0][0]
+                                          else wait)
+            if not messages:
+                drained.add(spec)
+            received += len(messages)
+            now = time.time()
+            for message in messages:
+                try:
+                    job = parse_job(message, spec.rendertype)
+                except (KeyError, ValueError):
+                    print 'Dropping malformed message {}'.format(
+                        message.get_body())
+                    self.client.delete_message(spec.name, message)
+                    continue
+                with self._lock:
+                    self.running[message.receipt_handle] = (spec.name,
+                                                            message)
+                    self.pending.setdefault(
+                        self.group_key(spec, job, message), []).append(
+                        (now, job, message))
+        self.dispatch(drained)
+        return received
+
+    def _get_messages(self, spec, room, wait):
+        try:
+            return self.client.get_messages(
+                spec.name, min(room, self.MAX_RECEIVE),
+                self.visibility_timeout, wait)
+        except Exception:
+            traceback.print_exc()
+            self._stopping.wait(self.wait_time_seconds)
+            return []
+
+    def _patience(self):
+        """
+        Return how long to wait for a thread before checking whether a
+        waiting job has become urgent.
+        """
+        now = time.time()
+        patience = min(self.heartbeat, 1)
+        for key, group in self.pending.iteritems():
+            if key[0].slo is not None:
+                due = group[0][0] + key[0].slo * self.URGENT - now
+                patience = min(patience, max(due, 0.01))
+        return patience
+
+    def urgent(self, spec, age):
+        return spec.slo is not None and age >= spec.slo * self.URGENT
+
+    def ready(self, key, group, now, drained):
+        spec = key[0]
+        age = now - group[0][0]
+        return (spec in drained or age >= self.max_wait or
+                self.urgent(spec, age) or
+                self.waiting(spec) >= self.window)
+
+    def choose(self, now, drained):
+        """
+        Return the key of the next group to run, or None.
+        """
+        oldest = {}
+        for key, group in self.pending.iteritems():
+            if key[0] not in oldest and self.ready(key, group, now, drained):
+                oldest[key[0]] = (group[0][0], key)
+        urgent = [(received, key) for spec, (received, key)
+                  in oldest.iteritems() if self.urgent(spec, now - received)]
+        if urgent:
+            return min(urgent)[1]
+        if self.idle <= self.reserve and any(
+                key[0].slo is not None for key in self.pending):
+            # Keep the reserve for jobs users are waiting on.
+            oldest = dict((spec, item) for spec, item in oldest.iteritems()
+                          if spec.slo is not None)
+        if not oldest:
+            return None
+        spec = min(oldest, key=lambda spec: (
+            float(self.served[spec.name]) / spec.weight, oldest[spec][0]))
+        return oldest[spec][1]
+
+    def dispatch(self, drained=()):
+        """
+        Hand ready groups to idle threads, and preempt other work for
+        urgent groups that find no idle thread.
+        """
+        now = time.time()
+        with self._lock:
+            while self.idle and self.pending:
+                key = self.choose(now, drained)
+                if key is None:
+                    break
+                group = self.pending.pop(key)
+                spec = key[0]
+                self.idle -= 1
+                self.served[spec.name] += 1
+                self.waits[spec.name].extend(now - received
+                                             for received, _, _ in group)
+                running = Running(spec)
+                self.active.add(running)
+                self._jobs.put((running, group))
+            self._preempt(now)
+
+    def _preempt(self, now):
+        urgent = sum(1 for key, group in self.pending.iteritems()
+                     if self.urgent(key[0], now - group[0][0]))
+        if not urgent or self.idle:
+            return
+        preempting = sum(1 for running in self.active
+                         if running.preempt.is_set())
+        candidates = sorted((running for running in self.active
+                             if running.spec.slo is None and
+                             not running.preempt.is_set()),
+                            key=lambda running: -running.started)
+        for running in candidates[:max(0, urgent - preempting)]:
+            running.preempt.set()
+
+    def stop(self):
+        """
+        Stop receiving. Jobs already received are finished.
+        """
+        self._stopping.set()
+
+    def join(self):
+        """
+        Wait for every received job to finish, then stop the threads.
+        """
+        while True:
+            with self._lock:
+                if not self.pending:
+                    break
+                if not self.idle:
+                    self._idle.wait(self._patience())
+            self.dispatch(drained=set(self.queues))
+        self._jobs.join()
+        self._done.set()
+        for _ in xrange(self.concurrency):
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                self._jobs.task_done()
+                return
+            running, group = item
+            try:
+                self.process_group(running, [(job, message)
+                                             for _, job, message in group])
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    for _, _, message in group:
+                        self.running.pop(message.receipt_handle, None)
+                    self.active.discard(running)
+                    self.idle += 1
+                    self._idle.notify()
+                Session.remove()
+                self._jobs.task_done()
+
+    def process_group(self, running, group):
+        """
+        Run a group of jobs of one scene, sharing one load of its bands.
+        """
+        scene = None
+        if self.open_scene is not None:
+            scene = self.open_scene(group[0][0])
+        try:
+            for index, (job, message) in enumerate(group):
+                if running.preempt.is_set():
+                    self.release(running.spec, group[index:])
+                    return
+                self.process(running, job, message, scene)
+        finally:
+            if scene is not None:
+                scene.close()
+
+    def release(self, spec, group):
+        """
+        Put the messages of jobs that were not run back on their queue.
+        """
+        for job, message in group:
+            self.record_status(job.jobid, 0)
+            self.client.change_message_visibility(spec.name, message, 0)
+        with self._lock:
+            self.preempted += len(group)
+
+    def process(self, running, job, message, scene=None):
+        """
+        Run one job and delete its message. Failed jobs are marked failed
+        rather than retried; requesting the composite again queues a new
+        job. Preempted jobs go back on their queue.
+        """
+        def set_job_status(jobstatus):
+            if running.preempt.is_set():
+                raise Preempted()
+            self.record_status(job.jobid, jobstatus)
+
+        try:
+            set_job_status(1)
+            if scene is None:
+                renderurl = self.render(job, set_job_status)
+            else:
+                renderurl = self.render(job, set_job_status, scene)
+            self.record_status(job.jobid, 5, renderurl)
+            with self._lock:
+                self.processed += 1
+        except Preempted:
+            self.release(running.spec, [(job, message)])
+            return
+        except Exception:
+            traceback.print_exc()
+            with self._lock:
+                self.failed += 1
+            try:
+                self.record_status(job.jobid, 10)
+            except Exception:
+                traceback.print_exc()
+        self.client.delete_message(running.spec.name, message)
+
+    def stats(self):
+        """
+        Return jobs served and seconds waited between receipt and start,
+        per queue.
+        """
+        with self._lock:
+            return dict((name, {'groups': self.served[name],
+                                'jobs': len(waits),
+                                'mean_wait': sum(waits) / len(waits)
+                                if waits else 0.0,
+                                'max_wait': max(waits) if waits else 0.0})
+                        for name, waits in self.waits.iteritems())
+
+    def _beat(self):
+        while not self._done.wait(self.heartbeat):
+            with self._lock:
+                messages = self.running.values()
+            for queue_name, message in messages:
+                try:
+                    self.client.change_message_visibility(
+                        queue_name, message, self.visibility_timeout)
+                except Exception:
+                    traceback.print_exc()
+
+
+def main(argv=sys.argv):
+    """
+    Render jobs from the preview queue, the full composite queue, or both.
+    """
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    rendertype = u'all'
+    if len(argv) > 2 and '=' not in argv[2]:
+        rendertype = argv.pop(2).decode('utf-8')
+    if rendertype != u'all' and rendertype not in QUEUES:
+        usage(argv)
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    settings['sqlalchemy.url'] = os.environ.get('DATABASE_URL',
+                                                settings.get('sqlalchemy.url'))
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    Session.configure(bind=engine)
+
+    if 'worker.render' not in settings:
+        print('worker.render must name a factory of render functions')
+        sys.exit(1)
+    render = DottedNameResolver().resolve(settings['worker.render'])(settings)
+    queues = [QueueSpec(QUEUES[u'preview'], u'preview',
+                        int(settings.get('worker.preview_weight', 1)),
+                        int(settings.get('worker.preview_slo', 0)) or None),
+              QueueSpec(QUEUES[u'full'], u'full',
+                        int(settings.get('worker.full_weight', 1)))]
+    if rendertype != u'all':
+        queues = [spec for spec in queues if spec.rendertype == rendertype]
+    concurrency = int(settings.get('worker.concurrency', 0)) or None
+    # Jobs are batched by scene when a window is set.
+    window = int(settings.get('worker.batch_window', 0))
+    worker = Worker(SQSClient(REGION, AWS_ACCESS_KEY_ID,
+                              AWS_SECRET_ACCESS_KEY),
+                    queues, render,
+                    concurrency=concurrency,
+                    visibility_timeout=int(settings.get(
+                        'worker.visibility_timeout', 300)),
+                    heartbeat=int(settings.get('worker.heartbeat', 60)),
+                    open_scene=getattr(render, 'open_scene', None)
+                    if window else None,
+                    window=window,
+                    max_wait=int(settings.get('worker.max_wait', 0)),
+                    reserve=int(settings.get('worker.preview_reserve', 0)))
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+    print('Rendering jobs from {} on {} threads'.format(
+        ', '.join(spec.name for spec in worker.queues), worker.concurrency))
+    worker.run()
+    print('Rendered {} jobs, {} failed, {} preempted'.format(
+        worker.processed, worker.failed, worker.preempted))
+    for queue_name, stats in worker.stats().iteritems():
+        print('{}: {}'.format(queue_name, stats))
+    band_cache = getattr(render, 'band_cache', None)
+    if band_cache is not None:
+        print('Band cache: {}'.format(band_cache.stats()))
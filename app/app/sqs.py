@@ -1,4 +1,9 @@
+import os
+import time
+import socket
+import threading
 from boto.sqs import connect_to_region
+from boto.exception import BotoServerError, BotoClientError
 
 
 def make_SQS_connection(region_name, aws_access_key_id, aws_secret_access_key):
@@ -25,7 +30,8 @@ def get_message(queue, num_messages=1, visibility_timeout=300,
     Get a message from the given queue. Default visibility timeout is
     5 minutes, message wait time is 20 seconds, number of messages is 1.
     """
-    return queue.get_messages(visibility_timeout=visibility_timeout,
+    return queue.get_messages(num_messages=num_messages,
+                              visibility_timeout=visibility_timeout,
                               wait_time_seconds=wait_time_seconds,
                               message_attributes=['All'])
 
@@ -34,8 +40,24 @@ def get_attributes(message):
     """
     Return a dictionary of the message attributes.
     """
+    return message_attributes(message[0])
+
+
+def message_attributes(message):
+    """
+    Return a dictionary of the attributes of a single message.
+    """
     return {key: value['string_value']
-            for key, value in message[0].message_attributes.iteritems()}
+            for key, value in message.message_attributes.iteritems()}
+
+
+def change_message_visibility(conn, queue, message, visibility_timeout):
+    """
+    Hide a received message from other consumers for another
+    visibility_timeout seconds.
+    """
+    return conn.change_message_visibility(queue, message.receipt_handle,
+                                          visibility_timeout)
 
 
 def delete_message_from_handle(conn, queue, message):
@@ -89,3 +111,226 @@ def send_message(conn, queue, message_content, message_attributes=None):
     return conn.send_message(queue=queue,
                              message_content=message_content,
                              message_attributes=message_attributes)
+
+
+def send_message_batch(conn, queue, messages):
+    """
+    Write up to 10 messages to the given queue in one call. Messages are
+    (id, body, delay_seconds, message_attributes) tuples.
+    """
+    return conn.send_message_batch(queue, messages)
+
+
+class SQSClient(object):
+    """
+    Long-lived SQS connection for one process.
+
+    The connection, and the HTTP connection pool inside it, is made on first
+    use and made again after a fork or a failed call. Queue handles are
+    looked up once and cached.
+    """
+
+    def __init__(self, region_name, aws_access_key_id, aws_secret_access_key,
+                 connect=make_SQS_connection):
+        self.region_name = region_name
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.connect = connect
+        self._conn = None
+        self._pid = None
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        """
+        Return this process's connection, connecting if needed.
+        """
+        with self._lock:
+            if self._conn is None or self._pid != os.getpid():
+                self._conn = self.connect(self.region_name,
+                                          self.aws_access_key_id,
+                                          self.aws_secret_access_key)
+                self._pid = os.getpid()
+                self._queues = {}
+            return self._conn
+
+    def reset(self):
+        """
+        Drop the connection and queue handles, to be remade on next use.
+        """
+        with self._lock:
+            self._conn = None
+            self._queues = {}
+
+    def get_queue(self, queue_name):
+        """
+        Return the handle of the named queue, looked up once per connection.
+        """
+        conn = self.conn
+        queue = self._queues.get(queue_name)
+        if queue is None:
+            queue = get_queue(conn, queue_name)
+            if queue is not None:
+                self._queues[queue_name] = queue
+        return queue
+
+    def call(self, method, queue_name, *args, **kwargs):
+        """
+        Call method(conn, queue, ...) and retry once on a new connection if
+        the call fails.
+        """
+        try:
+            return method(self.conn, self.get_queue(queue_name),
+                          *args, **kwargs)
+        except (BotoServerError, BotoClientError, socket.error):
+            self.reset()
+            return method(self.conn, self.get_queue(queue_name),
+                          *args, **kwargs)
+
+    def send_message(self, queue_name, message_content,
+                     message_attributes=None):
+        """
+        Write a message to the named queue.
+        """
+        return self.call(send_message, queue_name,
+                         message_content, message_attributes)
+
+    def send_message_batch(self, queue_name, messages):
+        """
+        Write up to 10 messages to the named queue in one call.
+        """
+        return self.call(send_message_batch, queue_name, messages)
+
+    def get_messages(self, queue_name, num_messages=10,
+                     visibility_timeout=300, wait_time_seconds=20):
+        """
+        Long-poll the named queue for up to num_messages messages.
+        """
+        return self.call(
+            lambda conn, queue: get_message(queue, num_messages,
+                                            visibility_timeout,
+                                            wait_time_seconds),
+            queue_name)
+
+    def change_message_visibility(self, queue_name, message,
+                                  visibility_timeout):
+        """
+        Extend the visibility timeout of a message received from the named
+        queue.
+        """
+        return self.call(change_message_visibility, queue_name, message,
+                         visibility_timeout)
+
+    def delete_message(self, queue_name, message):
+        """
+        Delete a message received from the named queue.
+        """
+        return self.call(delete_message_from_handle, queue_name, message)
+
+
+class BatchSender(object):
+    """
+    Buffer messages per queue and send them with send_message_batch.
+
+    A message put when its queue has been quiet for linger seconds is sent
+    at once with send_message, and goes the batch way if that fails.
+    Messages that arrive in a burst are buffered and sent in batches of up
+    to 10, as soon as a batch is full or linger seconds after the first of
+    them was buffered.
+
+    Entries SQS rejects are sent again up to retries times, then passed to
+    on_error(queue_name, messages, error), so every message is either
+    delivered at least once or reported.
+    """
+
+    MAX_BATCH = 10
+
+    def __init__(self, client, linger=0.05, retries=2, on_error=None):
+        self.client = client
+        self.linger = linger
+        self.retries = retries
+        self.on_error = on_error
+        self._buffers = {}
+        self._last_put = {}
+        self._timers = []
+        self._lock = threading.Lock()
+
+    def put(self, queue_name, message_content, message_attributes=None):
+        """
+        Send a message to the named queue, now or in the next batch.
+        """
+        now = time.time()
+        with self._lock:
+            buffer = self._buffers.setdefault(queue_name, [])
+            quiet = now - self._last_put.get(queue_name, 0) >= self.linger
+            self._last_put[queue_name] = now
+            if not (quiet and not buffer):
+                buffer.append((message_content, message_attributes))
+                if len(buffer) == 1:
+                    self._schedule(queue_name, self.linger)
+                elif len(buffer) == self.MAX_BATCH:
+                    self._schedule(queue_name, 0)
+                return
+
+        try:
+            return self.client.send_message(queue_name, message_content,
+                                            message_attributes)
+        except (BotoServerError, BotoClientError, socket.error):
+            # Retry and report it like a batch, off the request thread.
+            with self._lock:
+                self._buffers[queue_name].append((message_content,
+                                                  message_attributes))
+                self._schedule(queue_name, 0)
+
+    def _schedule(self, queue_name, delay):
+        # Batches are always sent off the request thread, which also keeps
+        # on_error out of the request's transaction.
+        timer = threading.Timer(delay, self.flush, [queue_name])
+        timer.daemon = True
+        self._timers = [t for t in self._timers if t.is_alive()] + [timer]
+        timer.start()
+
+    def close(self):
+        """
+        Wait for scheduled batches and send whatever is still buffered.
+        """
+        with self._lock:
+            timers, self._timers = self._timers, []
+        for timer in timers:
+            timer.cancel()
+            timer.join()
+        self.flush()
+
+    def flush(self, queue_name=None):
+        """
+        Send every buffered message, for one queue or for all of them.
+        """
+        queue_names = [queue_name] if queue_name else list(self._buffers)
+        for name in queue_names:
+            with self._lock:
+                messages = self._buffers.get(name, [])
+                self._buffers[name] = []
+            for start in xrange(0, len(messages), self.MAX_BATCH):
+                self._send_batch(name, messages[start:start + self.MAX_BATCH])
+
+    def _send_batch(self, queue_name, messages):
+        error = None
+        for attempt in xrange(self.retries + 1):
+            entries = [(str(i), body, 0, attributes or {})
+                       for i, (body, attributes) in enumerate(messages)]
+            try:
+                result = self.client.send_message_batch(queue_name, entries)
+            except (BotoServerError, BotoClientError, socket.error) as e:
+                error = e
+                continue
+            failed = set(int(entry['id']) for entry in result.errors)
+            messages = [message for i, message in enumerate(messages)
+                        if i in failed]
+            if not messages:
+                return
+            error = result.errors
+        print 'Could not send {} messages to {}'.format(len(messages),
+                                                         queue_name)
+        if self.on_error:
+            self.on_error(queue_name, messages, error)
@@ -1,96 +1,180 @@
 // Start polling for preview and full render job status and take action when document is ready
 $(document).ready(function(){
-  // Poll for preview image
-  $(".js-nopreview").each(function(){
-    var jobId = this.id;
-    var intervalTime = 1000;
-    var windowLoc = $(location).attr('pathname');
-    var intervalID = setInterval(function poll(){
-      $.ajax({
-        url: "/preview_poll/",
-        data: {'jobid': jobId},
-        dataType: "json"
-      }).done(function(json){
-        var info = json.job_info;
-        var newid = '#'.concat(jobId);
-        if(info.jobstatus != 'Done' && info.jobstatus != 'Failed'){
-          // Display loading gif.
-          $(newid).html(
-            "<div class='loading'><img src='/static/img/loading.gif'></div>");
-        }else{
-          if(info.jobstatus != 'Failed'){
-            // Stop polling on success
-            if(windowLoc.indexOf('bands') == -1){
-              $(newid).html(
-                "<a id= '" + info.scene_id + "'" +
-                  "href='/scene/" + info.scene_id + "/bands/" +
-                  info.band1 + info.band2 + info.band3 + "'" +
-                  "class='js-preview block sm-col sm-col-6 md-col md-col-4 lg-col lg-col-3'" +
-                  "style='background-image: url( " + info.renderurl + " );'>" +
+  var windowLoc = $(location).attr('pathname');
 
-                  "<h1 class='composite-description p1 m0'" + info.band1 + info.band2 + info.band3 + ">" +
-                  "<span class='band-red'>    " + info.band1 + "</span>" +
-                  "<span class='band-green'>    " + info.band2 + "</span>" +
-                  "<span class='band-blue'>    " + info.band3 + "</span>" +
-                  "</h1>" +
-                  "</a>");
-            }else{
-              $(newid).html(
-                "<div class='sm-col sm-col-6 p1'>" +
-                  "<a href='" + info.renderurl + "' class='js-preview'>" +
-                  "<img src='" + info.renderurl + "'>" +
-                  "</a>" +
-                  "</div>");
-            }
-            clearInterval(intervalID);
-          }else{
-            // Stop polling on failure
-            $(newid).html(
-              "<p><strong class='red'>Preview Failure</strong></p>");
-              clearInterval(intervalID);
-          }
-        }
-      });
-    }, intervalTime);
+  // Poll for preview images
+  var previewJobIds = $(".js-nopreview").map(function(){
+    return this.id;
+  }).get();
+  watchJobs(previewJobIds, 1000, function(jobId, info){
+    var newid = '#'.concat(jobId);
+    if(info.jobstatus != 'Done' && info.jobstatus != 'Failed'){
+      // Display loading gif.
+      $(newid).html(
+        "<div class='loading'><img src='/static/img/loading.gif'></div>");
+      return false;
+    }
+    if(info.jobstatus != 'Failed'){
+      // Stop polling on success
+      if(windowLoc.indexOf('bands') == -1){
+        $(newid).html(
+          "<a id= '" + info.scene_id + "'" +
+            "href='/scene/" + info.scene_id + "/bands/" +
+            info.band1 + info.band2 + info.band3 + "'" +
+            "class='js-preview block sm-col sm-col-6 md-col md-col-4 lg-col lg-col-3'" +
+            "style='background-image: url( " + info.renderurl + " );'>" +
+
+            "<h1 class='composite-description p1 m0'" + info.band1 + info.band2 + info.band3 + ">" +
+            "<span class='band-red'>    " + info.band1 + "</span>" +
+            "<span class='band-green'>    " + info.band2 + "</span>" +
+            "<span class='band-blue'>    " + info.band3 + "</span>" +
+            "</h1>" +
+            "</a>");
+      }else{
+        $(newid).html(
+          "<div class='sm-col sm-col-6 p1'>" +
+            "<a href='" + info.renderurl + "' class='js-preview'>" +
+            "<img src='" + info.renderurl + "'>" +
+            "</a>" +
+            "</div>");
+      }
+    }else{
+      // Stop polling on failure
+      $(newid).html(
+        "<p><strong class='red'>Preview Failure</strong></p>");
+    }
+    return true;
   });
 
   // Poll for full render job status
-  $(".js-nofull").each(function(){
-    var jobId = this.id;
-    var intervalTime = 10000;
-    if(jobId){
-      var intervalID = setInterval(function poll(){
-        $.ajax({
-          url: "/status_poll/",
-          data: {'jobid': jobId},
-          dataType: "json"
-        }).done(function(json){
-          var info = json.job_info;
-          var newid = '#'.concat(jobId);
-          if(info.jobstatus != 'Done' && info.jobstatus != 'Failed'){
-            // Update status and elapsed time.
-            $(newid).find("#js-fullstatus").html("Status: " + info.jobstatus);
-          }else{
-            if(info.jobstatus != 'Failed'){
-              // Stop polling on success
-              $(newid).html(
-                "<a  class='button bg-grey black not-rounded full-width center'" +
-                  "href=" + info.renderurl + ">Download full size image." +
-                  "</a>");
-                clearInterval(intervalID);
-            }else{
-              // Stop polling on failure
-              $(newid).html(
-                "<p><strong class='red'>Composite Failure</strong></p>");
-                clearInterval(intervalID);
-            }
-          }
-        });
-      }, intervalTime);
+  var fullJobIds = $(".js-nofull").map(function(){
+    return this.id || null;
+  }).get();
+  watchJobs(fullJobIds, 10000, function(jobId, info){
+    var newid = '#'.concat(jobId);
+    if(info.jobstatus != 'Done' && info.jobstatus != 'Failed'){
+      // Update status and elapsed time.
+      $(newid).find("#js-fullstatus").html("Status: " + info.jobstatus);
+      return false;
+    }
+    if(info.jobstatus != 'Failed'){
+      // Stop polling on success
+      $(newid).html(
+        "<a  class='button bg-grey black not-rounded full-width center'" +
+          "href=" + info.renderurl + ">Download full size image." +
+          "</a>");
+    }else{
+      // Stop polling on failure
+      $(newid).html(
+        "<p><strong class='red'>Composite Failure</strong></p>");
     }
+    return true;
   });
 });
 
+// Most job ids the server takes in one jobs_poll or status_stream request.
+var MAX_POLL_JOBS = 100;
+
+// Streams that fail this many times in a row without opening give way to
+// polling; others reconnect after a delay that doubles up to the maximum.
+var STREAM_FAILURES = 3;
+var STREAM_RETRY = 1000;
+var STREAM_MAX_RETRY = 30000;
+
+// Split ids into lists of at most MAX_POLL_JOBS.
+function chunkJobIds(ids){
+  var chunks = [];
+  for(var i = 0; i < ids.length; i += MAX_POLL_JOBS){
+    chunks.push(ids.slice(i, i + MAX_POLL_JOBS));
+  }
+  return chunks;
+}
+
+// Follow the status of every job in jobIds over server-sent event streams,
+// falling back to polling every intervalTime when the browser or server does
+// not support streams. update is called with each job's info and returns
+// true once the job no longer needs watching.
+function watchJobs(jobIds, intervalTime, update){
+  $.each(chunkJobIds(jobIds), function(i, chunk){
+    watchChunk(chunk, intervalTime, update);
+  });
+}
+
+function watchChunk(jobIds, intervalTime, update){
+  var pending = jobIds.slice(),
+      failures = 0,
+      retry = STREAM_RETRY;
+  if(pending.length === 0){
+    return;
+  }
+  if(!window.EventSource){
+    pollJobs(pending, intervalTime, update);
+    return;
+  }
+  function connect(){
+    var source = new EventSource("/status_stream/?" +
+      $.param({'jobid': pending}, true));
+    source.onopen = function(){
+      failures = 0;
+      retry = STREAM_RETRY;
+    };
+    source.onmessage = function(event){
+      var json = JSON.parse(event.data);
+      var jobId = json.jobid.toString();
+      if(update(jobId, json.job_info)){
+        pending = $.grep(pending, function(id){ return id != jobId; });
+      }
+      if(pending.length === 0){
+        source.close();
+      }
+    };
+    source.onerror = function(){
+      // The server closes streams after a while; reconnect for what is
+      // left, and poll instead if streams keep failing to open.
+      source.close();
+      if(pending.length === 0){
+        return;
+      }
+      failures += 1;
+      if(failures >= STREAM_FAILURES){
+        pollJobs(pending, intervalTime, update);
+        return;
+      }
+      setTimeout(connect, retry);
+      retry = Math.min(retry * 2, STREAM_MAX_RETRY);
+    };
+  }
+  connect();
+}
+
+// Poll for the status of every job in jobIds every interval, with one
+// request per MAX_POLL_JOBS jobs. update is called with each job's info and
+// returns true once the job no longer needs polling.
+function pollJobs(jobIds, intervalTime, update){
+  var pending = jobIds.slice();
+  if(pending.length === 0){
+    return;
+  }
+  var intervalID = setInterval(function poll(){
+    $.each(chunkJobIds(pending), function(i, chunk){
+      $.ajax({
+        url: "/jobs_poll/",
+        data: {'jobid': chunk},
+        traditional: true,
+        dataType: "json"
+      }).done(function(json){
+        pending = $.grep(pending, function(jobId){
+          var info = json.jobs[jobId];
+          return !(info && update(jobId, info));
+        });
+        if(pending.length === 0){
+          clearInterval(intervalID);
+        }
+      });
+    });
+  }, intervalTime);
+}
+
 // Stop polling for a preview when 
 function stopPreviewPoll(data, intervalID){
   if(data.bool === false){
@@ -39,42 +39,37 @@ $(document).ready(function() {
 
 // Subsequent render's ========================================================
 
-// Debounce to prevent excessive AJAX calls
-var sceneList = _.debounce(function() {
+// Cursor of the next, older page of scenes, if there is one.
+var nextScenes = null;
+
+// Filters set in the form above the scene list.
+var sceneFilters = function() {
+  var filters = {};
+  $('#js-scenefilters').serializeArray().forEach(function(field) {
+    if (field.value) { filters[field.name] = field.value; }
+  });
+  return filters;
+};
 
-  // Define the center of the map.
-  var center = map.getCenter(),
-      lat = center.lat,
-      lng = center.lng;
+// Add a page of scenes to their path-row groups, creating missing groups.
+var addScenes = function(json) {
 
-  // Submit a post request with the relevant information.
-  $.ajax({
-    url: "/scene_options_ajax",
-    dataType: "json",
-    data: {'lat': lat, 'lng': lng, },
-  }).done(function(json) {
+  var allScenes = json.scenes,
+      headers = json.groups || [];
 
-    var allScenes = json.scenes;
+  for (var i in allScenes) {
 
-    if (Modernizr.sessionstorage) {
-      sessionStorage['lat'] = lat;
-      sessionStorage['lng'] = lng;
-    }
-
-    // Update path-row groupings of scenes on map move
-    $('#js-pathrowgrouping').html('');
-
-    for (var i in allScenes) {
-
-      var scenes = allScenes[i],
-          index = i.toString(),
-          // Group scenes by Path/Row
-          sceneByPathRow = 'pathrowgroup'.concat(index),
-          sceneByPathRowID = '#'.concat(sceneByPathRow),
-          // Further group scenes to just include actual scenes
-          listOfScenes = 'pathrowsubgroup'.concat(index),
-          listOfScenesID = '#'.concat(listOfScenes);
+    var scenes = allScenes[i],
+        header = headers[i] || {},
+        pathRow = scenes[0].path + '-' + scenes[0].row,
+        // Group scenes by Path/Row
+        sceneByPathRow = 'pathrowgroup'.concat(pathRow),
+        sceneByPathRowID = '#'.concat(sceneByPathRow),
+        // Further group scenes to just include actual scenes
+        listOfScenes = 'pathrowsubgroup'.concat(pathRow),
+        listOfScenesID = '#'.concat(listOfScenes);
 
+    if ($(sceneByPathRowID).length === 0) {
       // Each Path/Row has it's own column.
       // Note: By just passing in `class='col'`, the width is set based on size
       $('#js-pathrowgrouping').append(
@@ -84,6 +79,9 @@ var sceneList = _.debounce(function() {
       // Create the headings for each Path/Row listing
       $(sceneByPathRowID).append(
         "<h4 class='mb1'>Path " + scenes[0].path + " - " + "Row " + scenes[0].row + "</h4>" +
+        (header.scenes ?
+          "<p class='mb0 h6 gray'>" + header.scenes + " scenes, around " +
+          header.average_time + " UTC</p>" : "") +
         "<div class='flex flex-justify border-bottom'>" +
           "<p class='mb0 h5'>Date</p>" +
           "<p class='mb0 gray h5'>Cloud cover</p>" +
@@ -94,22 +92,73 @@ var sceneList = _.debounce(function() {
       $(sceneByPathRowID).append(
         $('<div></div>').attr('id', listOfScenes)
       );
+    }
 
-      // Generate entry for each date within a path-row group.
-      for (var k in scenes) {
-        $(listOfScenesID).append(
-          "<div class='mobile'>" +
-            "<a style='text-decoration: none' class='flex flex-justify button-transparent' href ='/scene/" + scenes[k].entityid + "'>" +
-              "<div class='regular black mr4'>" + scenes[k].acquisitiondate + "</div>" +
-              "<div class='regular gray'>" + scenes[k].cloudcover + "%</div>" + 
-            "</a>" +
-          "</div>"
-        );
-      }
+    // Generate entry for each date within a path-row group.
+    for (var k in scenes) {
+      $(listOfScenesID).append(
+        "<div class='mobile'>" +
+          "<a style='text-decoration: none' class='flex flex-justify button-transparent' href ='/scene/" + scenes[k].entityid + "'>" +
+            "<div class='regular black mr4'>" + scenes[k].acquisitiondate + "</div>" +
+            "<div class='regular gray'>" + scenes[k].cloudcover + "%</div>" + 
+          "</a>" +
+        "</div>"
+      );
     }
+  }
+
+  // Offer older scenes while the server has more.
+  nextScenes = json.next || null;
+  $('#js-olderscenes').toggle(nextScenes !== null);
+};
+
+// Request a page of scenes around the map's center; the first page when
+// cursor is null.
+var requestScenes = function(cursor) {
+
+  // Define the center of the map.
+  var center = map.getCenter(),
+      lat = center.lat,
+      lng = center.lng,
+      data = $.extend({'lat': lat, 'lng': lng}, sceneFilters());
+
+  if (cursor) { data.cursor = cursor; }
+
+  // Submit a request with the relevant information.
+  return $.ajax({
+    url: "/scene_options_ajax",
+    dataType: "json",
+    data: data,
+  }).done(function(json) {
+
+    if (Modernizr.sessionstorage) {
+      sessionStorage['lat'] = lat;
+      sessionStorage['lng'] = lng;
+    }
+
+    // A first page replaces the path-row groupings.
+    if (!cursor) { $('#js-pathrowgrouping').html(''); }
+
+    addScenes(json);
   });
+};
+
+// Debounce to prevent excessive AJAX calls
+var sceneList = _.debounce(function() {
+  requestScenes(null);
 }, 250);
 
+$('#js-olderscenes').on('click', function(event) {
+  event.preventDefault();
+  if (nextScenes) { requestScenes(nextScenes); }
+});
+
+$('#js-scenefilters').on('change', sceneList);
+$('#js-scenefilters').on('submit', function(event) {
+  event.preventDefault();
+  sceneList();
+});
+
 // Once a user finishes moving the map, send an AJAX request to Pyramid
 // which will repopulate the HTML with an updated list of the Landsat
 // scenes present.
@@ -0,0 +1,147 @@
+"""
+Synthetic data for benchmarks and load tests.
+
+Fills paths, path_row, path_row_summary, user_job and render_cache with
+made-up but realistically shaped rows: a block of overlapping footprints
+on a grid of paths and rows, a run of scenes for each of them, and
+composites in every state for a sample of popular scenes. Rows are
+inserted in batches, so large data sets load in seconds.
+"""
+import random
+from datetime import datetime, timedelta
+from zope.sqlalchemy import mark_changed
+
+from models import (Session, Paths, PathRow, PathRowSummary, UserJob,
+                    RenderCache)
+
+# Degrees between neighbouring paths and rows, and how far footprints
+# reach past them, so that neighbours overlap as WRS-2 footprints do.
+PATH_STEP = 1.5
+ROW_STEP = 1.2
+OVERLAP = 0.3
+
+# The grid starts at the footprint over Seattle.
+FIRST_PATH = 40
+FIRST_ROW = 20
+ORIGIN = (-118.0, 51.0)
+
+BAND_COMBOS = ['432', '543', '764', '652', '753', '564', '754', '765']
+
+# Rows per INSERT statement.
+CHUNK = 500
+
+
+def footprint(path, row):
+    """
+    Return the bounding box of a path/row's footprint as (min_lon, min_lat,
+    max_lon, max_lat).
+    """
+    min_lon = ORIGIN[0] - (path - FIRST_PATH) * PATH_STEP - OVERLAP
+    max_lat = ORIGIN[1] - (row - FIRST_ROW) * ROW_STEP + OVERLAP
+    return (min_lon, max_lat - ROW_STEP - 2 * OVERLAP,
+            min_lon + PATH_STEP + 2 * OVERLAP, max_lat)
+
+
+def footprint_wkt(path, row):
+    min_lon, min_lat, max_lon, max_lat = footprint(path, row)
+    return u'POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))'.format(
+        min_lon, min_lat, max_lon, max_lat)
+
+
+def scene_id(path, row, acquisitiondate):
+    return u'LC8{:03d}{:03d}{}{:03d}LGN00'.format(
+        path, row, acquisitiondate.year,
+        acquisitiondate.timetuple().tm_yday)
+
+
+def insert_rows(table, rows):
+    for start in xrange(0, len(rows), CHUNK):
+        Session.execute(table.insert(), rows[start:start + CHUNK])
+
+
+class SyntheticData(object):
+    """
+    What generate wrote: the path/rows, the scenes, the popular scenes that
+    have composites, and the jobs.
+    """
+
+    def __init__(self):
+        self.pathrows = []
+        self.scenes = []
+        self.popular = []
+        self.jobids = []
+
+    def point(self, rand):
+        """
+        Return a random (lat, lng) inside one of the footprints.
+        """
+        path, row = rand.choice(self.pathrows)
+        min_lon, min_lat, max_lon, max_lat = footprint(path, row)
+        return (rand.uniform(min_lat, max_lat),
+                round(rand.uniform(min_lon, max_lon), 5))
+
+
+def generate(paths=10, rows=10, scenes=20, popular=100, seed=0,
+             start=datetime(2015, 1, 1, 18, 0, 0)):
+    """
+    Write paths by rows footprints, scenes acquisitions of each 16 days
+    apart, and for popular of the scenes every BAND_COMBOS composite as
+    preview and full render jobs in random states. Does not commit.
+    """
+    rand = random.Random(seed)
+    data = SyntheticData()
+    footprints, pathrows = [], []
+    for path in xrange(FIRST_PATH, FIRST_PATH + paths):
+        for row in xrange(FIRST_ROW, FIRST_ROW + rows):
+            data.pathrows.append((path, row))
+            footprints.append({'gid': u'{}_{}'.format(path, row),
+                               'geom': footprint_wkt(path, row),
+                               'path': path, 'row': row, 'mode': u'D'})
+            min_lon, min_lat, max_lon, max_lat = footprint(path, row)
+            for number in xrange(scenes):
+                acquisitiondate = start + timedelta(
+                    days=16 * number, minutes=rand.randint(0, 30))
+                entityid = scene_id(path, row, acquisitiondate)
+                data.scenes.append(entityid)
+                pathrows.append({
+                    'entityid': entityid,
+                    'acquisitiondate': acquisitiondate,
+                    'cloudcover': round(rand.uniform(0, 100), 2),
+                    'path': path, 'row': row,
+                    'min_lat': min_lat, 'min_lon': min_lon,
+                    'max_lat': max_lat, 'max_lon': max_lon,
+                    'download_url': u'https://landsat-pds.s3.amazonaws.com/'
+                                    u'L8/{:03d}/{:03d}/{}/index.html'.format(
+                                        path, row, entityid)})
+    insert_rows(Paths.__table__, footprints)
+    insert_rows(PathRow.__table__, pathrows)
+    PathRowSummary.refresh(data.pathrows)
+
+    now = datetime.utcnow()
+    data.popular = rand.sample(data.scenes, min(popular, len(data.scenes)))
+    for entityid in data.popular:
+        jobs = []
+        for combo in BAND_COMBOS:
+            for rendertype in (u'preview', u'full'):
+                jobstatus = rand.choice([0, 1, 2, 3, 4, 5, 5, 5, 10])
+                jobs.append(dict(
+                    entityid=entityid, band1=int(combo[0]),
+                    band2=int(combo[1]), band3=int(combo[2]),
+                    jobstatus=jobstatus, starttime=now, lastmodified=now,
+                    rendertype=rendertype))
+        for job in jobs:
+            result = Session.execute(UserJob.__table__.insert(), job)
+            jobid = result.inserted_primary_key[0]
+            data.jobids.append(jobid)
+            done = job['jobstatus'] == 5
+            job.update(jobid=jobid, rendercount=rand.randint(0, 20),
+                       currentlyrend=not done,
+                       renderurl=u'http://example.com/{}.png'.format(jobid)
+                       if done else None)
+        insert_rows(RenderCache.__table__, [
+            dict((key, job[key]) for key in (
+                'jobid', 'entityid', 'band1', 'band2', 'band3', 'renderurl',
+                'rendercount', 'currentlyrend', 'rendertype'))
+            for job in jobs])
+    mark_changed(Session())
+    return data
@@ -1,17 +1,22 @@
 import unittest
 import os
+import transaction
+from contextlib import contextmanager
+from datetime import datetime
 from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
 from time import sleep
 from pyramid import testing
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
 
-from .models import Session
-
+from .models import Session, Base, PathRow, UserJob, RenderCache
 
 DEFAULT_WAIT = 5
 SCREEN_DUMP_LOCATION = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), 'screendumps'
 )
+SCENE_ID = u'LC80460272015001LGN00'
 
 
 class TestMyViewSuccessCondition(unittest.TestCase):
@@ -38,6 +43,1303 @@ class TestMyViewFailureCondition(unittest.TestCase):
         pass
 
 
+class DatabaseTest(unittest.TestCase):
+    """
+    Base class for tests against an in-memory SQLite copy of the schema.
+    """
+    def setUp(self):
+        self.config = testing.setUp()
+        self.engine = create_engine('sqlite://', poolclass=StaticPool,
+                                    connect_args={'check_same_thread': False})
+        Session.remove()
+        Session.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        Base.metadata.drop_all(self.engine)
+        testing.tearDown()
+
+    @contextmanager
+    def count_queries(self):
+        """
+        Yield a list that collects every statement sent to the database.
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(self.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+    def add_scene(self, entityid=SCENE_ID, path=46, row=27,
+                  acquisitiondate=datetime(2015, 1, 1, 18, 52, 10),
+                  cloudcover=12.5):
+        Session.add(PathRow(
+            entityid=entityid, acquisitiondate=acquisitiondate,
+            cloudcover=cloudcover, path=path, row=row,
+            min_lat=46.0, min_lon=-123.0, max_lat=48.0, max_lon=-120.0,
+            download_url=u'https://landsat-pds.s3.amazonaws.com/L8/{:03d}/'
+                         u'{:03d}/{}/index.html'.format(path, row, entityid)))
+        Session.flush()
+
+    def add_composite(self, band1=4, band2=3, band3=2, rendertype=u'preview',
+                      jobstatus=0, renderurl=None, entityid=SCENE_ID):
+        now = datetime.utcnow()
+        job = UserJob(entityid=entityid, band1=band1, band2=band2,
+                      band3=band3, jobstatus=jobstatus, starttime=now,
+                      lastmodified=now, rendertype=rendertype)
+        Session.add(job)
+        Session.flush()
+        Session.add(RenderCache(jobid=job.jobid, entityid=entityid,
+                                band1=band1, band2=band2, band3=band3,
+                                renderurl=renderurl,
+                                currentlyrend=renderurl is None,
+                                rendertype=rendertype))
+        Session.flush()
+        return job.jobid
+
+
+class SceneViewQueryTest(DatabaseTest):
+    def setUp(self):
+        super(SceneViewQueryTest, self).setUp()
+        self.add_scene()
+
+    def add_composites(self, count, start=0):
+        combos = [(b1, b2, b3) for b1 in range(1, 8) for b2 in range(1, 8)
+                  for b3 in range(1, 8) if len(set([b1, b2, b3])) == 3]
+        for band1, band2, band3 in combos[start:start + count]:
+            self.add_composite(band1, band2, band3, u'preview', 5,
+                               u'http://example.com/preview.png')
+            self.add_composite(band1, band2, band3, u'full', 2)
+
+    def scene_query_count(self, view, **matchdict):
+        request = testing.DummyRequest()
+        request.matchdict = dict(scene_id=SCENE_ID, **matchdict)
+        Session.expunge_all()
+        with self.count_queries() as statements:
+            result = view(request)
+        return result, len(statements)
+
+    def test_scene_constant_query_count(self):
+        from .views import scene
+        self.add_composites(1)
+        result, one = self.scene_query_count(scene)
+        self.add_composites(39, start=1)
+        result, many = self.scene_query_count(scene)
+        self.assertEqual(one, many)
+        self.assertEqual(many, 2)
+        self.assertEqual(len(result['composites']), 40)
+
+    def test_scene_band_constant_query_count(self):
+        from .views import scene_band
+        self.add_composite(1, 2, 3, u'preview', 5,
+                           u'http://example.com/preview.png')
+        result, one = self.scene_query_count(scene_band, band_combo='123')
+        self.add_composite(1, 2, 3, u'full', 2)
+        result, many = self.scene_query_count(scene_band, band_combo='123')
+        self.assertEqual(one, many)
+        self.assertEqual(result['composites']['123']['fullstatus'],
+                         'Processing')
+
+    def test_scene_composites_output(self):
+        from .views import scene
+        preview = self.add_composite(4, 3, 2, u'preview', 5,
+                                     u'http://example.com/preview.png')
+        full = self.add_composite(4, 3, 2, u'full', 2)
+        result, count = self.scene_query_count(scene)
+        composite = result['composites']['432']
+        self.assertEqual(composite['previewjobid'], preview)
+        self.assertEqual(composite['previewurl'],
+                         u'http://example.com/preview.png')
+        self.assertEqual(composite['previewstatus'],
+                         ('Done', SCENE_ID, 4, 3, 2))
+        self.assertEqual(composite['fulljobid'], full)
+        self.assertEqual(composite['fullurl'], False)
+        self.assertEqual(composite['fullstatus'], 'Processing')
+        self.assertEqual(result['meta_data']['path'], 46)
+
+
+class JobsPollTest(DatabaseTest):
+    def test_jobs_poll_single_query(self):
+        from webob.multidict import MultiDict
+        from .views import jobs_poll
+        done = self.add_composite(4, 3, 2, u'preview', 5,
+                                  u'http://example.com/preview.png')
+        running = self.add_composite(4, 3, 2, u'full', 1)
+        request = testing.DummyRequest()
+        request.params = MultiDict([('jobid', str(done)),
+                                    ('jobid', str(running)),
+                                    ('jobid', '999')])
+        with self.count_queries() as statements:
+            jobs = jobs_poll(request)['jobs']
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(sorted(jobs), sorted([str(done), str(running)]))
+        self.assertEqual(jobs[str(done)]['jobstatus'], 'Done')
+        self.assertEqual(jobs[str(done)]['renderurl'],
+                         u'http://example.com/preview.png')
+        self.assertEqual(jobs[str(done)]['scene_id'], SCENE_ID)
+        self.assertEqual(jobs[str(running)]['jobstatus'], 'Collecting files')
+        self.assertIsNone(jobs[str(running)]['renderurl'])
+        self.assertIn('elapsedtime', jobs[str(running)])
+
+    def test_jobs_poll_bad_jobid(self):
+        from webob.multidict import MultiDict
+        from pyramid.httpexceptions import HTTPBadRequest
+        from .views import jobs_poll
+        request = testing.DummyRequest()
+        request.params = MultiDict([('jobid', 'x')])
+        self.assertRaises(HTTPBadRequest, jobs_poll, request)
+
+
+class ProfilingTest(DatabaseTest):
+    # Most queries each view may issue, however many composites a scene has.
+    BUDGETS = {'scene': 2, 'scene_band': 2, 'jobs_poll': 1}
+
+    def setUp(self):
+        from . import profiling
+        super(ProfilingTest, self).setUp()
+        profiling.install(self.engine)
+        self.add_scene()
+        for band1 in range(1, 6):
+            self.add_composite(band1, 3, 2, u'preview', 5,
+                               u'http://example.com/preview.png')
+            self.add_composite(band1, 3, 2, u'full', 2)
+        Session.expunge_all()
+
+    def test_view_query_budgets(self):
+        from webob.multidict import MultiDict
+        from . import views
+        from .profiling import query_budget
+        requests = {'scene': {'scene_id': SCENE_ID},
+                    'scene_band': {'scene_id': SCENE_ID,
+                                   'band_combo': '132'},
+                    'jobs_poll': {}}
+        for view, matchdict in requests.items():
+            request = testing.DummyRequest()
+            request.matchdict = matchdict
+            request.params = MultiDict([('jobid', '1'), ('jobid', '2')])
+            with query_budget(self.BUDGETS[view]):
+                getattr(views, view)(request)
+
+    def test_budget_exceeded(self):
+        from .views import scene
+        from .profiling import query_budget, QueryBudgetExceeded
+        request = testing.DummyRequest()
+        request.matchdict = {'scene_id': SCENE_ID}
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(1):
+                scene(request)
+
+    def test_failed_statement_leaves_no_timing(self):
+        from sqlalchemy.exc import OperationalError
+        connection = Session.connection()
+        for _ in range(3):
+            with self.assertRaises(OperationalError):
+                connection.execute('SELECT * FROM no_such_table')
+        connection.execute('SELECT 1')
+        self.assertNotIn('query_start', connection.info)
+
+    def test_tween_records_route(self):
+        from pyramid.response import Response
+        from . import profiling
+
+        def handler(request):
+            request.matched_route = testing.DummyResource(name='scene')
+            Session.query(PathRow).all()
+            Session.query(RenderCache).all()
+            return Response('ok')
+
+        profiling.route_stats = profiling.RouteStats()
+        profiling.server_timing = True
+        try:
+            tween = profiling.profiling_tween_factory(handler, None)
+            response = tween(testing.DummyRequest())
+        finally:
+            profiling.server_timing = False
+        stats = profiling.route_stats.stats()['scene']
+        self.assertEqual((stats['requests'], stats['queries']), (1, 2))
+        self.assertIn('desc="2 queries"', response.headers['Server-Timing'])
+
+
+class SyntheticDataTest(DatabaseTest):
+    def test_generate(self):
+        import random
+        from .synthetic import generate, footprint_wkt, BAND_COMBOS
+        from .wrs2 import WRS2Index
+        data = generate(paths=2, rows=3, scenes=4, popular=2)
+        self.assertEqual(Session.query(PathRow).count(), 24)
+        self.assertEqual(Session.query(RenderCache).count(),
+                         2 * 2 * len(BAND_COMBOS))
+        self.assertEqual(len(data.jobids), 2 * 2 * len(BAND_COMBOS))
+        index = WRS2Index.from_rows(
+            [(path, row, footprint_wkt(path, row))
+             for path, row in data.pathrows])
+        rand = random.Random(0)
+        for _ in range(20):
+            self.assertTrue(index.lookup(*data.point(rand)))
+
+    def test_bench_regressions(self):
+        from .scripts.bench_web import regressions
+        baseline = {'scene': {'max_queries': 2, 'p95_ms': 10.0}}
+        self.assertEqual(regressions(
+            {'scene': {'max_queries': 2, 'p95_ms': 12.0}}, baseline), [])
+        self.assertEqual(len(regressions(
+            {'scene': {'max_queries': 3, 'p95_ms': 30.0}}, baseline)), 2)
+
+
+class SceneListTest(DatabaseTest):
+    def setUp(self):
+        super(SceneListTest, self).setUp()
+        from collections import namedtuple
+        for day in range(1, 11):
+            for row in (27, 28):
+                self.add_scene(u'LC8046{:03d}2015{:03d}LGN00'.format(
+                    row, day), row=row,
+                    acquisitiondate=datetime(2015, 1, day, 18, 52, 10),
+                    cloudcover=day * 10.0)
+        Match = namedtuple('Match', ['path', 'row'])
+        self.pathrows = [Match(46, 27), Match(46, 28)]
+
+    def request(self, **params):
+        request = testing.DummyRequest()
+        request.params = params
+        return request
+
+    def test_filters(self):
+        from .views import scene_filters
+        scenes = PathRow.scenelist(self.pathrows, **scene_filters(
+            self.request(max_cloud='50', start='2015-01-03',
+                         end='2015-01-04'))).all()
+        self.assertEqual([scene.entityid for scene in scenes],
+                         [u'LC80460282015004LGN00', u'LC80460272015004LGN00',
+                          u'LC80460282015003LGN00', u'LC80460272015003LGN00'])
+
+    def test_pages(self):
+        from .views import scene_filters, scene_cursor
+        seen = []
+        cursor = None
+        while True:
+            params = {'limit': '3'}
+            if cursor:
+                params['cursor'] = cursor
+            scenes = PathRow.scenelist(
+                self.pathrows, **scene_filters(self.request(**params))).all()
+            seen.extend(scene.entityid for scene in scenes)
+            if len(scenes) < 3:
+                break
+            cursor = scene_cursor(scenes[-1])
+        self.assertEqual(seen, [scene.entityid for scene in
+                                PathRow.scenelist(self.pathrows)])
+        self.assertEqual(len(set(seen)), 20)
+
+    def test_bad_filters(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from .views import scene_filters
+        for params in ({'limit': '0'}, {'limit': '5000'}, {'start': 'x'},
+                       {'max_cloud': 'x'}, {'cursor': 'LC8'}):
+            self.assertRaises(HTTPBadRequest, scene_filters,
+                              self.request(**params))
+
+
+class PathRowSummaryTest(DatabaseTest):
+    def setUp(self):
+        super(PathRowSummaryTest, self).setUp()
+        self.add_scene(u'LC80460272015001LGN00',
+                       acquisitiondate=datetime(2015, 1, 1, 18, 52, 10, 500),
+                       cloudcover=5.0)
+        self.add_scene(u'LC80460272015017LGN00',
+                       acquisitiondate=datetime(2015, 1, 17, 18, 53, 59),
+                       cloudcover=45.0)
+        self.add_scene(u'LC80460282015001LGN00', row=28,
+                       acquisitiondate=datetime(2015, 1, 1, 18, 53, 0),
+                       cloudcover=80.0)
+
+    def scene_groups(self):
+        from .models import PathRowSummary
+        from .views import build_scene_groups
+        scenes = Session.query(PathRow).order_by(
+            PathRow.path, PathRow.row, PathRow.acquisitiondate.desc())
+        return build_scene_groups(
+            scenes, PathRowSummary.for_pathrows([(46, 27), (46, 28)]))
+
+    def test_refresh(self):
+        from .models import PathRowSummary
+        PathRowSummary.refresh([(46, 27), (46, 28)])
+        summary = Session.query(PathRowSummary).get((46, 27))
+        self.assertEqual(summary.scenes, 2)
+        self.assertEqual(summary.latest, datetime(2015, 1, 17, 18, 53, 59))
+        self.assertEqual((summary.under_10, summary.under_30,
+                          summary.under_60), (1, 1, 2))
+        self.add_scene(u'LC80460272015033LGN00',
+                       acquisitiondate=datetime(2015, 2, 2, 18, 55, 0))
+        PathRowSummary.refresh([(46, 27)])
+        Session.expire_all()
+        self.assertEqual(Session.query(PathRowSummary).get((46, 27)).scenes,
+                         3)
+        self.assertEqual(Session.query(PathRowSummary).count(), 2)
+
+    def test_groups_match_unsummarized(self):
+        from .models import PathRowSummary
+        before = self.scene_groups()
+        PathRowSummary.refresh([(46, 27), (46, 28)])
+        groups, headers = self.scene_groups()
+        self.assertEqual(groups, before[0])
+        self.assertEqual([group[0]['entityid'] for group in groups],
+                         [u'LC80460272015017LGN00', u'LC80460282015001LGN00'])
+        # Whole seconds are averaged: (18:52:10 + 18:53:59) / 2.
+        self.assertEqual(headers[0]['average_time'], '18:53')
+        self.assertEqual(groups[0][1]['acquisitiontime'], '18:52:10')
+        self.assertEqual(headers[1]['cloudcover_under'],
+                         {'10': 0, '30': 0, '60': 0})
+
+
+class IngestTest(DatabaseTest):
+    HEADER = ('entityId,acquisitionDate,cloudCover,processingLevel,path,row,'
+              'min_lat,min_lon,max_lat,max_lon,download_url\n')
+    LINE = ('{0},2015-01-{1:02d} 18:52:{2:02d}.123456,{3},L1T,46,{4},46.0,'
+            '-123.0,48.0,-120.0,https://landsat-pds.s3.amazonaws.com/L8/046/'
+            '{4:03d}/{0}/index.html\n')
+
+    def setUp(self):
+        super(IngestTest, self).setUp()
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+        super(IngestTest, self).tearDown()
+
+    def scene_list(self, lines, name='scene_list.gz'):
+        import gzip
+        path = os.path.join(self.directory, name)
+        out = gzip.open(path, 'wb') if name.endswith('.gz') else open(path,
+                                                                      'wb')
+        out.write(self.HEADER + ''.join(lines))
+        out.close()
+        return path
+
+    def line(self, day, row=27, cloudcover=10.0, second=10):
+        entityid = 'LC8046{:03d}2015{:03d}LGN00'.format(row, day)
+        return self.LINE.format(entityid, day, second, cloudcover, row)
+
+    def test_ingest_merges_delta(self):
+        from .ingest import ingest, READ_SIZE
+        from .models import PathRowSummary
+        # Enough rows to span several reads of the decompressed stream.
+        lines = [self.line(day, row) for row in range(20, 80)
+                 for day in range(1, 30)]
+        self.assertGreater(len(''.join(lines)), 2 * READ_SIZE)
+        stats = ingest(self.scene_list(lines))
+        self.assertEqual((stats.staged, stats.new, stats.changed),
+                         (len(lines), len(lines), 0))
+        self.assertEqual(len(stats.pathrows), 60)
+        self.assertEqual(Session.query(PathRowSummary).count(), 60)
+
+        lines[0] = self.line(1, 20, cloudcover=55.5)
+        lines.append(self.line(30, 21))
+        stats = ingest(self.scene_list(lines, 'scene_list.csv'))
+        self.assertEqual((stats.new, stats.changed), (1, 1))
+        self.assertEqual(sorted(stats.pathrows), [(46, 20), (46, 21)])
+        scene = Session.query(PathRow).get(u'LC80460202015001LGN00')
+        self.assertEqual(scene.cloudcover, 55.5)
+        self.assertEqual(scene.acquisitiondate,
+                         datetime(2015, 1, 1, 18, 52, 10, 123456))
+        self.assertEqual(Session.query(PathRowSummary).get(
+            (46, 21)).scenes, 30)
+
+    def test_ingest_rejects_unknown_lists(self):
+        from .ingest import ingest, IngestError
+        path = os.path.join(self.directory, 'other.csv')
+        with open(path, 'w') as out:
+            out.write('entityId,path,row\n')
+        self.assertRaises(IngestError, ingest, path)
+
+
+class StatusStreamTest(DatabaseTest):
+    def setUp(self):
+        super(StatusStreamTest, self).setUp()
+        from . import jobfeed
+        self.notifier = jobfeed.FakeNotifier()
+        jobfeed.feed = jobfeed.JobFeed(self.notifier)
+
+    def tearDown(self):
+        from . import jobfeed
+        jobfeed.feed = None
+        super(StatusStreamTest, self).tearDown()
+
+    def events(self, app_iter):
+        import json
+        return [json.loads(event[len('data: '):])
+                for event in app_iter if event.startswith('data: ')]
+
+    def test_stream_pushes_transitions(self):
+        from webob.multidict import MultiDict
+        from . import jobfeed
+        from .views import status_stream
+        jobid = self.add_composite(4, 3, 2, u'preview', 0)
+        request = testing.DummyRequest()
+        request.params = MultiDict([('jobid', str(jobid))])
+        response = status_stream(request)
+        self.assertEqual(response.content_type, 'text/event-stream')
+
+        self.notifier.notify(jobid, 1)
+        self.notifier.notify(jobid, 1)
+        self.notifier.notify(jobid + 1, 2)
+        self.notifier.notify(jobid, 5, u'http://example.com/preview.png')
+        events = self.events(response.app_iter)
+
+        self.assertEqual([e['job_info']['jobstatus'] for e in events],
+                         ['In queue', 'Collecting files', 'Done'])
+        self.assertEqual(events[-1]['job_info']['renderurl'],
+                         u'http://example.com/preview.png')
+        self.assertEqual(events[-1]['job_info']['band1'], 4)
+        self.assertEqual(jobfeed.feed.subscriptions, {})
+
+    def test_stream_closes_for_finished_jobs(self):
+        from webob.multidict import MultiDict
+        from .views import status_stream
+        jobid = self.add_composite(4, 3, 2, u'full', 10)
+        request = testing.DummyRequest()
+        request.params = MultiDict([('jobid', str(jobid))])
+        events = self.events(status_stream(request).app_iter)
+        self.assertEqual([e['job_info']['jobstatus'] for e in events],
+                         ['Failed'])
+
+    def test_stream_disabled(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        from . import jobfeed
+        from .views import status_stream
+        jobfeed.feed = None
+        self.assertRaises(HTTPNotFound, status_stream, testing.DummyRequest())
+
+    def test_failed_listen_connection_closed(self):
+        from .jobfeed import PostgresNotifier
+
+        class Stop(BaseException):
+            pass
+
+        class BrokenConnection(object):
+            closed = False
+
+            def fileno(self):
+                raise IOError('connection lost')
+
+            def close(self):
+                self.closed = True
+
+        connections = []
+
+        def connect():
+            if len(connections) == 2:
+                raise Stop()
+            connections.append(BrokenConnection())
+            return connections[-1]
+
+        notifier = PostgresNotifier(None, timeout=0, retry_wait=0)
+        notifier.connect = connect
+        with self.assertRaises(Stop):
+            notifier.run(lambda *args: None)
+        self.assertEqual([conn.closed for conn in connections], [True, True])
+
+
+class SQSClientTest(unittest.TestCase):
+    def setUp(self):
+        from .fakes import FakeSQS
+        from .sqs import SQSClient
+        self.fake = FakeSQS()
+        self.client = SQSClient('us-west-2', 'key', 'secret',
+                                connect=self.fake)
+
+    def test_connection_and_queue_reused(self):
+        for _ in range(3):
+            self.client.send_message('queue', 'job')
+        self.assertEqual(self.fake.connects, 1)
+        self.assertEqual(self.fake.connection.calls,
+                         ['get_queue'] + ['send_message'] * 3)
+        self.assertEqual(len(self.fake.messages('queue')), 3)
+
+    def test_reconnect_after_fork(self):
+        self.client.send_message('queue', 'job')
+        self.client._pid = -1
+        self.client.send_message('queue', 'job')
+        self.assertEqual(self.fake.connects, 2)
+
+    def test_reconnect_after_error(self):
+        self.client.send_message('queue', 'job')
+        self.fake.connection.failures = 1
+        self.client.send_message('queue', 'job')
+        self.assertEqual(self.fake.connects, 2)
+        self.assertEqual(len(self.fake.messages('queue')), 2)
+
+
+class BatchSenderTest(unittest.TestCase):
+    def setUp(self):
+        from .fakes import FakeSQS
+        from .sqs import SQSClient, BatchSender
+        self.fake = FakeSQS()
+        self.failed = []
+        self.sender = BatchSender(
+            SQSClient('us-west-2', 'key', 'secret', connect=self.fake),
+            linger=60, retries=1,
+            on_error=lambda queue, messages, error:
+                self.failed.extend(messages))
+
+    def calls(self, name):
+        return self.fake.connection.calls.count(name)
+
+    def test_single_message_sent_at_once(self):
+        self.sender.put('queue', 'job')
+        self.assertEqual(self.calls('send_message'), 1)
+        self.assertEqual(len(self.fake.messages('queue')), 1)
+
+    def test_burst_is_batched(self):
+        for i in range(25):
+            self.sender.put('queue', 'job{}'.format(i))
+        self.sender.close()
+        self.assertEqual(self.calls('send_message'), 1)
+        self.assertEqual(self.calls('send_message_batch'), 3)
+        self.assertEqual(sorted(m.body for m in self.fake.messages('queue')),
+                         sorted('job{}'.format(i) for i in range(25)))
+
+    def test_rejected_entries_retried(self):
+        self.sender.put('queue', 'job0')
+        self.fake.connection.batch_errors = 2
+        for i in range(1, 6):
+            self.sender.put('queue', 'job{}'.format(i))
+        self.sender.close()
+        self.assertEqual(len(self.fake.messages('queue')), 6)
+        self.assertEqual(self.failed, [])
+
+    def test_persistent_failure_reported(self):
+        self.sender.put('queue', 'job0')
+        self.fake.connection.batch_errors = 100
+        self.sender.put('queue', 'job1', {'job_id': {'string_value': 1}})
+        self.sender.close()
+        self.assertEqual(self.failed, [('job1', {'job_id':
+                                                 {'string_value': 1}})])
+
+
+    def test_quiet_send_failure_retried(self):
+        self.fake.connection.failures = 3
+        self.sender.put('queue', 'job0')
+        self.sender.close()
+        self.assertEqual([m.body for m in self.fake.messages('queue')],
+                         ['job0'])
+        self.assertEqual(self.failed, [])
+
+    def test_quiet_send_failure_reported(self):
+        self.fake.connection.failures = 100
+        self.sender.put('queue', 'job0', {'job_id': {'string_value': 1}})
+        self.sender.close()
+        self.assertEqual(self.failed, [('job0', {'job_id':
+                                                 {'string_value': 1}})])
+
+    def test_credentials_required_without_fake_backend(self):
+        from . import views
+        key = views.AWS_ACCESS_KEY_ID
+        views.AWS_ACCESS_KEY_ID = None
+        try:
+            with self.assertRaises(RuntimeError):
+                views.configure({'sqs.backend': 'sqs'})
+        finally:
+            views.AWS_ACCESS_KEY_ID = key
+
+
+class SingleFlightTest(unittest.TestCase):
+    """
+    Fire identical composite requests from parallel threads against a
+    shared SQLite file.
+    """
+    def setUp(self):
+        import tempfile
+        from . import views
+        from .fakes import FakeSQS
+        from .sqs import SQSClient, BatchSender
+        self.config = testing.setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), 'app.sqlite')
+        self.engine = create_engine('sqlite:///' + self.path,
+                                    connect_args={'timeout': 30})
+        Session.remove()
+        Session.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        self.fake = FakeSQS()
+        self.sender = views.sqs_sender
+        views.sqs_sender = BatchSender(
+            SQSClient('us-west-2', 'key', 'secret', connect=self.fake),
+            linger=0)
+
+    def tearDown(self):
+        from . import views
+        views.sqs_sender = self.sender
+        Session.remove()
+        self.engine.dispose()
+        os.remove(self.path)
+        testing.tearDown()
+
+    def request_composites(self, count, rendertype=u'preview'):
+        import threading
+        from .views import add_to_queue
+        jobids = []
+        errors = []
+
+        def request_composite():
+            request = testing.DummyRequest(
+                params={'band1': '4', 'band2': '3', 'band3': '2'})
+            request.matchdict = {'scene_id': SCENE_ID}
+            try:
+                with transaction.manager:
+                    jobids.append(add_to_queue(request, rendertype))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                Session.remove()
+
+        threads = [threading.Thread(target=request_composite)
+                   for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return jobids
+
+    def test_concurrent_requests_enqueue_once(self):
+        from .views import PREVIEW_QUEUE
+        jobids = self.request_composites(8)
+        self.assertEqual(len(self.fake.messages(PREVIEW_QUEUE)), 1)
+        self.assertEqual(len(set(jobids)), 1)
+        self.assertEqual(Session.query(UserJob).count(), 1)
+        self.assertEqual(Session.query(RenderCache.rendercount).scalar(), 7)
+
+    def test_rendered_composite_is_one_statement(self):
+        from .views import PREVIEW_QUEUE
+        first = self.request_composites(1)[0]
+        with transaction.manager:
+            RenderCache.update(first, False, u'http://example.com/432.png')
+            UserJob.set_job_status(first, 5)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        jobids = self.request_composites(3)
+        event.remove(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        self.assertEqual(jobids, [first] * 3)
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(len(self.fake.messages(PREVIEW_QUEUE)), 1)
+        self.assertEqual(Session.query(RenderCache.rendercount).scalar(), 3)
+
+    def test_failed_job_is_requeued_once(self):
+        from .views import PREVIEW_QUEUE
+        first = self.request_composites(1)[0]
+        with transaction.manager:
+            UserJob.set_job_status(first, 10)
+        jobids = self.request_composites(4)
+        self.assertEqual(len(self.fake.messages(PREVIEW_QUEUE)), 2)
+        self.assertEqual(len(set(jobids)), 1)
+        self.assertNotEqual(jobids[0], first)
+
+
+class JobLatencyTest(DatabaseTest):
+    def setUp(self):
+        from .migrations import migrate
+        super(JobLatencyTest, self).setUp()
+        migrate(self.engine)
+
+    def run_job(self, rendertype, queued_seconds):
+        from datetime import timedelta
+        jobid = self.add_composite(rendertype=rendertype,
+                                   entityid=unicode(queued_seconds))
+        Session.query(UserJob).filter(UserJob.jobid == jobid).update(
+            {'starttime': datetime.utcnow() -
+             timedelta(seconds=queued_seconds)})
+        for jobstatus in (1, 2, 3, 4, 5):
+            UserJob.set_job_status(jobid, jobstatus)
+
+    def test_stages_counted_as_jobs_finish(self):
+        from .views import job_metrics
+        for queued_seconds in (0.3, 3, 4, 40):
+            self.run_job(u'preview', queued_seconds)
+        self.run_job(u'full', 700)
+        request = testing.DummyRequest()
+        with self.count_queries() as statements:
+            result = job_metrics(request)
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('user_job', statements[0])
+        wait = result[u'preview']['queue_wait']
+        self.assertEqual(wait['count'], 4)
+        self.assertTrue(2.5 <= wait['p50'] <= 5)
+        self.assertTrue(30 <= wait['p99'] <= 60)
+        self.assertAlmostEqual(wait['mean'], 47.3 / 4, places=1)
+        self.assertEqual(result[u'preview']['upload']['count'], 4)
+        self.assertTrue(result[u'preview']['upload']['p95'] <= 0.1)
+        self.assertEqual(result[u'full']['queue_wait']['count'], 1)
+
+    def test_requeued_job_counted_once(self):
+        from .views import job_metrics
+        jobid = self.add_composite(rendertype=u'full')
+        for jobstatus in (1, 2, 3):
+            UserJob.set_job_status(jobid, jobstatus)
+        # Preempted while compressing, then run again from the start.
+        UserJob.requeue(jobid)
+        self.assertEqual(Session.query(UserJob).get(jobid).jobstatus, 0)
+        for jobstatus in (1, 2, 3, 4, 5):
+            UserJob.set_job_status(jobid, jobstatus)
+        result = job_metrics(testing.DummyRequest())[u'full']
+        for stage in ('queue_wait', 'collect', 'process', 'compress',
+                      'upload'):
+            self.assertEqual(result[stage]['count'], 1)
+
+    def test_prometheus_text(self):
+        from .views import job_metrics
+        for queued_seconds in (3, 4000):
+            self.run_job(u'full', queued_seconds)
+        request = testing.DummyRequest(params={'format': 'prometheus'})
+        text = job_metrics(request).text
+        labels = 'rendertype="full",stage="queue_wait"'
+        self.assertIn('landsat_job_stage_seconds_bucket{%s,le="5.0"} 1'
+                      % labels, text)
+        self.assertIn('landsat_job_stage_seconds_bucket{%s,le="+Inf"} 2'
+                      % labels, text)
+        self.assertIn('landsat_job_stage_seconds_count{%s} 2' % labels,
+                      text)
+
+
+class WorkerTest(unittest.TestCase):
+    """
+    Run the render worker against a fake queue and a shared SQLite file.
+    """
+    def setUp(self):
+        import tempfile
+        import threading
+        from .fakes import FakeSQS
+        from .sqs import SQSClient
+        self.path = os.path.join(tempfile.mkdtemp(), 'app.sqlite')
+        self.engine = create_engine('sqlite:///' + self.path,
+                                    connect_args={'timeout': 30})
+        Session.remove()
+        Session.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        self.fake = FakeSQS()
+        self.client = SQSClient('us-west-2', 'key', 'secret',
+                                connect=self.fake)
+        self.rendering = 0
+        self.most_rendering = 0
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        Session.remove()
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def queue_jobs(self, count):
+        from .sqs import build_job_message
+        jobids = []
+        for band1 in range(1, count + 1):
+            jobid = UserJob.new_job(entityid=SCENE_ID, band1=band1,
+                                    rendertype=u'preview')
+            message = build_job_message(job_id=jobid, scene_id=SCENE_ID,
+                                        band_1=band1, band_2=3, band_3=2)
+            self.client.send_message('queue', message['body'],
+                                     message['attributes'])
+            jobids.append(jobid)
+        Session.remove()
+        return jobids
+
+    def render(self, job, set_status, seconds=0.05):
+        import time
+        with self.lock:
+            self.rendering += 1
+            self.most_rendering = max(self.most_rendering, self.rendering)
+        try:
+            time.sleep(seconds)
+            for jobstatus in (2, 3, 4):
+                set_status(jobstatus)
+            if job.band1 == 13:
+                raise IOError('band 13 does not exist')
+            return u'http://example.com/{}.png'.format(job.jobid)
+        finally:
+            with self.lock:
+                self.rendering -= 1
+
+    def run_worker(self, count, render=None, **kwargs):
+        from .scripts.worker import Worker, QueueSpec
+        kwargs.setdefault('wait_time_seconds', 0)
+        worker = Worker(self.client, [QueueSpec('queue', u'preview')],
+                        render or self.render, **kwargs)
+        worker.start()
+        while worker.processed + worker.failed < count:
+            worker.receive()
+        worker.join()
+        return worker
+
+    def test_jobs_rendered_concurrently(self):
+        jobids = self.queue_jobs(8)
+        worker = self.run_worker(8, concurrency=4)
+        self.assertEqual(worker.processed, 8)
+        self.assertEqual(self.most_rendering, 4)
+        self.assertEqual(self.fake.messages('queue'), [])
+        for job, renderurl in UserJob.jobs_status(jobids):
+            self.assertEqual(job.jobstatus, 5)
+            self.assertTrue(job.status1time <= job.status2time <=
+                            job.status4time <= job.status5time)
+            self.assertEqual(renderurl,
+                             u'http://example.com/{}.png'.format(job.jobid))
+
+    def test_failed_job_marked_and_deleted(self):
+        jobids = self.queue_jobs(13)
+        worker = self.run_worker(13, concurrency=2)
+        self.assertEqual((worker.processed, worker.failed), (12, 1))
+        self.assertEqual(self.fake.messages('queue'), [])
+        job = Session.query(UserJob).get(jobids[-1])
+        self.assertEqual(job.jobstatus, 10)
+        self.assertIsNotNone(job.status10time)
+
+    def test_jobs_batched_by_scene(self):
+        from .sqs import build_job_message
+        scenes = [u'LC8046027201500{}LGN00'.format(i) for i in range(3)]
+        for jobid in range(9):
+            message = build_job_message(job_id=jobid,
+                                        scene_id=scenes[jobid % 3],
+                                        band_1=jobid, band_2=3, band_3=2)
+            self.client.send_message('queue', message['body'],
+                                     message['attributes'])
+        opened = []
+        rendered = []
+
+        class Scene(object):
+            def close(self):
+                pass
+
+        def open_scene(job):
+            opened.append(job.entityid)
+            return Scene()
+
+        def render(job, set_status, scene):
+            rendered.append((job.entityid, job.band1))
+            return u'http://example.com/{}.png'.format(job.jobid)
+
+        worker = self.run_worker(9, render=render, concurrency=1, window=10,
+                                 open_scene=open_scene,
+                                 record_status=lambda *args: None)
+        self.assertEqual(worker.processed, 9)
+        self.assertEqual(opened, scenes)
+        self.assertEqual(rendered, [(scenes[band1 % 3], band1)
+                                    for band1 in (0, 3, 6, 1, 4, 7, 2, 5, 8)])
+
+    def send_job(self, queue_name, jobid):
+        from .sqs import build_job_message
+        message = build_job_message(job_id=jobid, scene_id=SCENE_ID,
+                                    band_1=4, band_2=3, band_3=2)
+        self.client.send_message(queue_name, message['body'],
+                                 message['attributes'])
+
+    def test_queues_share_threads_by_weight(self):
+        from .scripts.worker import Worker, QueueSpec
+        for jobid in range(6):
+            self.send_job('preview', jobid)
+            self.send_job('full', 10 + jobid)
+        order = []
+
+        def render(job, set_status):
+            order.append(job.rendertype)
+            return u'http://example.com/{}.png'.format(job.jobid)
+
+        worker = Worker(self.client, [QueueSpec('full', u'full', 1),
+                                      QueueSpec('preview', u'preview', 2)],
+                        render, concurrency=1, wait_time_seconds=0,
+                        record_status=lambda *args: None)
+        worker.start()
+        while worker.processed < 12:
+            worker.receive()
+        worker.join()
+        self.assertEqual(order[:6].count(u'preview'), 4)
+        self.assertEqual(worker.stats()['full']['jobs'], 6)
+
+    def test_urgent_preview_preempts_full_render(self):
+        import time
+        import threading
+        from .scripts.worker import Worker, QueueSpec
+        statuses = []
+        started = []
+
+        def render(job, set_status):
+            if job.rendertype == u'full':
+                started.append(job.jobid)
+                for _ in range(20):
+                    set_status(2)
+                    time.sleep(0.05)
+            return u'http://example.com/{}.png'.format(job.jobid)
+
+        def send_preview():
+            # Once both threads are busy with full renders.
+            while len(started) < 2:
+                time.sleep(0.01)
+            self.send_job('preview', 1)
+
+        for jobid in (10, 11):
+            self.send_job('full', jobid)
+        sender = threading.Thread(target=send_preview)
+        sender.start()
+        worker = Worker(self.client, [QueueSpec('full', u'full'),
+                                      QueueSpec('preview', u'preview',
+                                                slo=0.2)],
+                        render, concurrency=2, wait_time_seconds=0.05,
+                        record_status=lambda jobid, jobstatus, url=None:
+                            statuses.append((jobid, jobstatus)))
+        worker.start()
+        while worker.processed < 3:
+            worker.receive()
+        worker.join()
+        sender.join()
+        self.assertEqual(worker.preempted, 1)
+        self.assertTrue(worker.stats()['preview']['max_wait'] < 0.2)
+        self.assertIn((1, 5), statuses)
+        # The preempted render went back to its queue and was rerun.
+        self.assertEqual(statuses.count((10, 5)) + statuses.count((11, 5)),
+                         2)
+        self.assertTrue((10, 0) in statuses or (11, 0) in statuses)
+
+    def test_heartbeat_keeps_long_job_hidden(self):
+        self.queue_jobs(1)
+        message = self.fake.messages('queue')[0]
+        # A second thread keeps polling the queue while the job runs.
+        self.run_worker(1, concurrency=2, visibility_timeout=0.3,
+                        heartbeat=0.1, wait_time_seconds=0.05,
+                        render=lambda job, set_status:
+                            self.render(job, set_status, seconds=1))
+        self.assertEqual(message.receives, 1)
+        self.assertIn('change_message_visibility', self.fake.connection.calls)
+
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        import numpy as np
+        rand = np.random.RandomState(0)
+        self.arrays = [rand.randint(1, 20000, (45, 31)).astype(np.uint16)
+                       for _ in range(3)]
+        self.arrays[0][:, :3] = 0
+
+    def decode_png(self, data):
+        import zlib
+        import struct
+        import numpy as np
+        self.assertEqual(data[:8], '\x89PNG\r\n\x1a\n')
+        position, idat = 8, []
+        while position < len(data):
+            length, tag = struct.unpack('>I4s', data[position:position + 8])
+            chunk = data[position + 8:position + 8 + length]
+            if tag == 'IHDR':
+                width, height = struct.unpack('>II', chunk[:8])
+            elif tag == 'IDAT':
+                idat.append(chunk)
+            position += length + 12
+        rows = np.frombuffer(zlib.decompress(''.join(idat)), np.uint8)
+        return rows.reshape(height, width * 3 + 1)[:, 1:].reshape(
+            height, width, 3)
+
+    def render(self, block_rows):
+        import io
+        from .render import ArrayBand, render_composite
+        out = io.BytesIO()
+        render_composite([ArrayBand(array) for array in self.arrays], out,
+                         block_rows)
+        return self.decode_png(out.getvalue())
+
+    def test_blocks_match_whole_scene(self):
+        import numpy as np
+        from .render import STRETCH
+        whole = self.render(45)
+        for i, array in enumerate(self.arrays):
+            low, high = np.percentile(array[array != 0], STRETCH)
+            expected = np.clip((array - low) * 255.0 / (high - low), 0, 255)
+            expected[:, :3] = 0
+            # Percentiles are taken from the histogram, so allow a step.
+            self.assertTrue(np.abs(whole[:, :, i] - expected).max() <= 1.5)
+        for block_rows in (1, 7, 512):
+            self.assertTrue((self.render(block_rows) == whole).all())
+
+    def test_preview_from_decimated_bands(self):
+        import io
+        from .render import ArrayBand, render_preview
+        out = io.BytesIO()
+        render_preview([ArrayBand(array) for array in self.arrays], out,
+                       size=10)
+        preview = self.decode_png(out.getvalue())
+        self.assertEqual(preview.shape, (9, 7, 3))
+        self.arrays = [array[::5, ::5] for array in self.arrays]
+        self.assertTrue((self.render(512) == preview).all())
+
+    def test_scene_bands_loaded_once(self):
+        import io
+        from .render import ArrayBand, SceneBands
+        opened = []
+
+        def open_band(number):
+            opened.append(number)
+            return ArrayBand(self.arrays[number])
+
+        scene = SceneBands(open_band, block_rows=8)
+        for numbers in ((0, 1, 2), (2, 1, 0), (1, 2, 0)):
+            out = io.BytesIO()
+            scene.render(numbers, out)
+        scene.close()
+        self.assertEqual(sorted(opened), [0, 1, 2])
+        self.assertTrue((self.decode_png(out.getvalue()) ==
+                         self.render(8)[:, :, [1, 2, 0]]).all())
+
+    def test_fill_is_black(self):
+        rgb = self.render(8)
+        self.assertEqual(rgb[:, :3].max(), 0)
+        self.assertTrue(rgb[:, 3:].any())
+
+
+class BandCacheTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from .bandcache import BandCache
+        self.fetched = []
+        self.directory = tempfile.mkdtemp()
+        self.cache = BandCache(self.directory, 250, fetch=self.fetch)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def fetch(self, url, path):
+        import time
+        self.fetched.append(url)
+        time.sleep(0.05)
+        with open(path, 'wb') as out:
+            out.write('x' * 100)
+
+    def test_hits_skip_download(self):
+        self.cache.max_bytes = 1000
+        for band in (4, 3, 2, 5, 4, 3):
+            path = self.cache.get(SCENE_ID, band, 'url{}'.format(band))
+            self.assertTrue(os.path.exists(path))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 4))
+        self.assertEqual(stats['bytes_saved'], 200)
+        self.assertEqual(len(self.fetched), 4)
+
+    def test_least_recently_used_evicted(self):
+        import time
+        for band in (4, 3):
+            self.cache.get(SCENE_ID, band, 'url')
+            time.sleep(0.01)
+        self.cache.get(SCENE_ID, 4, 'url')
+        time.sleep(0.01)
+        self.cache.get(SCENE_ID, 2, 'url')
+        self.assertIsNone(self.cache.lookup(SCENE_ID, 3))
+        self.assertIsNotNone(self.cache.lookup(SCENE_ID, 4))
+        self.assertEqual(self.cache.stats()['bytes'], 200)
+
+    def test_concurrent_misses_download_once(self):
+        import threading
+        threads = [threading.Thread(target=self.cache.get,
+                                    args=(SCENE_ID, 4, 'url'))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.fetched, ['url'])
+        self.assertEqual(self.cache.stats()['hits'], 4)
+        self.assertFalse([name for name in os.listdir(self.directory)
+                          if name.endswith('.part')])
+
+
+class S3OutputTest(unittest.TestCase):
+    def setUp(self):
+        from .fakes import FakeS3
+        self.connection = FakeS3()('us-west-2', 'key', 'secret')
+        self.bucket = self.connection.get_bucket('renders')
+        self.data = ''.join(chr(i % 251) for i in range(95))
+
+    def write(self, out, size=7):
+        for start in range(0, len(self.data), size):
+            out.write(self.data[start:start + size])
+
+    def test_small_output_single_put(self):
+        from .s3 import S3Output
+        out = S3Output(self.bucket, 'small.png', part_size=100)
+        self.write(out)
+        out.close()
+        self.assertEqual(self.bucket.objects['small.png'], self.data)
+        self.assertEqual(self.connection.calls, ['put_object'])
+
+    def test_parts_uploaded_concurrently(self):
+        from .s3 import S3Output
+        self.connection.part_seconds = 0.05
+        out = S3Output(self.bucket, 'big.png', part_size=10, uploaders=3)
+        self.write(out)
+        out.close()
+        self.assertEqual(self.bucket.objects['big.png'], self.data)
+        self.assertEqual(self.connection.calls.count('upload_part'), 10)
+        self.assertEqual(self.connection.max_in_flight, 3)
+        self.assertEqual(self.bucket.uploads, [])
+
+    def test_on_upload_called_with_first_part(self):
+        from .s3 import S3Output
+        started = []
+        out = S3Output(self.bucket, 'big.png', part_size=10, uploaders=2,
+                       on_upload=lambda: started.append(
+                           list(self.connection.calls)))
+        self.write(out, size=10)
+        out.close()
+        self.assertEqual(started, [[]])
+        small = S3Output(self.bucket, 'small.png', part_size=100,
+                         on_upload=lambda: started.append(None))
+        self.write(small)
+        small.close()
+        self.assertEqual(len(started), 1)
+
+    def test_failed_part_cancels_upload(self):
+        from .s3 import S3Output, ATTEMPTS
+        initiate = self.bucket.initiate_multipart_upload
+
+        def failing_initiate(*args, **kwargs):
+            upload = initiate(*args, **kwargs)
+            self.connection.failures = ATTEMPTS
+            return upload
+
+        self.bucket.initiate_multipart_upload = failing_initiate
+        out = S3Output(self.bucket, 'big.png', part_size=10, uploaders=1)
+        with self.assertRaises(Exception):
+            try:
+                self.write(out)
+                out.close()
+            except Exception:
+                out.abort()
+                raise
+        self.assertNotIn('big.png', self.bucket.objects)
+        self.assertIn('cancel_upload', self.connection.calls)
+        self.assertEqual(self.bucket.uploads, [])
+
+
+class WRS2IndexTest(unittest.TestCase):
+    def setUp(self):
+        from .wrs2 import WRS2Index
+        self.index = WRS2Index.from_rows([
+            (46, 27, u'POLYGON((-123 46,-120 46,-120 49,-123 49,-123 46))'),
+            (47, 27, u'POLYGON((-125 46,-122 46,-122 49,-125 49,-125 46),'
+                     u'(-124 47,-123.5 47,-123.5 48,-124 48,-124 47))'),
+            (1, 1, u'SRID=4236;MULTIPOLYGON(((10 10,11 10,11 11,10 11,10 10)),'
+                   u'((20 20,21 20,21 21,20 21,20 20)))'),
+            ])
+
+    def pathrows(self, lat, lng):
+        return sorted((x.path, x.row) for x in self.index.lookup(lat, lng))
+
+    def test_point_in_single_footprint(self):
+        self.assertEqual(self.pathrows(47.5, -121), [(46, 27)])
+
+    def test_point_in_overlapping_footprints(self):
+        self.assertEqual(self.pathrows(47.5, -122.5), [(46, 27), (47, 27)])
+
+    def test_point_in_hole(self):
+        self.assertEqual(self.pathrows(47.5, -123.75), [])
+
+    def test_point_outside_footprints(self):
+        self.assertEqual(self.pathrows(0, 0), [])
+
+    def test_multipolygon(self):
+        self.assertEqual(self.pathrows(10.5, 10.5), [(1, 1)])
+        self.assertEqual(self.pathrows(20.5, 20.5), [(1, 1)])
+        self.assertEqual(self.pathrows(15, 15), [])
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from .cache import ResponseCache
+        self.stamp_file = os.path.join(tempfile.mkdtemp(), 'path_row.stamp')
+        self.cache = ResponseCache(size=2, timeout=60,
+                                   stamp_file=self.stamp_file)
+
+    def test_hits_and_misses(self):
+        key = frozenset([(46, 27)])
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, {'scenes': []})
+        self.assertEqual(self.cache.get(key), {'scenes': []})
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_bounded(self):
+        for path in range(3):
+            self.cache.put(frozenset([(path, 27)]), path)
+        self.assertEqual(self.cache.stats()['size'], 2)
+        self.assertIsNone(self.cache.get(frozenset([(0, 27)])))
+
+    def test_stamp_invalidates(self):
+        from .cache import touch_stamp
+        key = frozenset([(46, 27)])
+        self.cache.put(key, {'scenes': []})
+        self.assertIsNotNone(self.cache.get(key))
+        touch_stamp(self.stamp_file)
+        self.assertIsNone(self.cache.get(key))
+        stats = self.cache.stats()
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_put_after_invalidation_dropped(self):
+        from .cache import touch_stamp
+        key = frozenset([(46, 27)])
+        self.assertIsNone(self.cache.get(key))
+        generation = self.cache.generation
+        # path_row changes while the response is being computed.
+        touch_stamp(self.stamp_file)
+        self.cache.put(key, {'scenes': []}, generation)
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, {'scenes': []}, self.cache.generation)
+        self.assertIsNotNone(self.cache.get(key))
+
+
+class MigrationsTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://', poolclass=StaticPool)
+
+    def indexes(self, table):
+        from sqlalchemy import inspect
+        return set(index['name'] for index in
+                   inspect(self.engine).get_indexes(table))
+
+    def test_migrate_existing_schema(self):
+        from .migrations import MIGRATIONS, migrate
+        # A database created before the models declared their indexes.
+        # Missing tables come from create_all before migrating.
+        from .models import JobLatency
+        for table in (PathRow.__table__, RenderCache.__table__,
+                      JobLatency.__table__):
+            table.create(self.engine)
+            for index in table.indexes:
+                index.drop(self.engine)
+        self.assertEqual(migrate(self.engine),
+                         [version for version, _, _ in MIGRATIONS])
+        self.assertIn('path_row_path_row_idx', self.indexes('path_row'))
+        self.assertIn('render_cache_jobid_idx', self.indexes('render_cache'))
+        self.assertEqual(migrate(self.engine), [])
+
+    def test_migrate_fresh_schema(self):
+        from .migrations import migrate
+        Base.metadata.create_all(self.engine)
+        self.assertTrue(migrate(self.engine))
+        self.assertIn('path_row_path_row_idx', self.indexes('path_row'))
+
+
 class FunctionalTest(unittest.TestCase):
 
     def setUp(self):
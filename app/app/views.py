@@ -1,20 +1,78 @@
 import os
+import atexit
 import operator
 import itertools
 from datetime import datetime, timedelta
-from models import Paths, PathRow, UserJob, RenderCache
+from models import (PathRow, PathRowSummary, UserJob, RenderCache,
+                    JobLatency, status_key, seconds_of_day, average_time)
 from pyramid.view import view_config, notfound_view_config
 from pyramid.httpexceptions import HTTPFound, HTTPNotFound
-from sqs import make_SQS_connection, get_queue, build_job_message, send_message
-from collections import OrderedDict
+from pyramid.response import Response
+import wrs2
+import cache
+import jobfeed
+import metrics
+import profiling
+from sqs import SQSClient, BatchSender, build_job_message
+from fakes import FakeSQS
+from collections import OrderedDict, namedtuple
 import pyramid.httpexceptions as exc
 import time
+import json
+import transaction
 
 # Define AWS credentials
-AWS_ACCESS_KEY_ID = os.environ['AWS_ACCESS_KEY_ID']
-AWS_SECRET_ACCESS_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
+AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
+AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 REGION = 'us-west-2'
 
+# One SQS connection per worker process, shared by every request.
+sqs_client = SQSClient(REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+
+
+def fail_unsent_jobs(queue_name, messages, error):
+    """
+    Mark jobs whose messages could not be queued as failed, so that their
+    pages stop waiting on them.
+    """
+    with transaction.manager:
+        for body, attributes in messages:
+            UserJob.set_job_status(attributes['job_id']['string_value'], 10)
+
+
+def configure(settings):
+    """
+    Queue jobs in memory instead of on SQS when sqs.backend is fake, for
+    benchmarks and load tests without an AWS account. Otherwise the AWS
+    credentials must be set, so that a misconfigured app fails at startup
+    rather than on its first job.
+    """
+    if settings.get('sqs.backend') == 'fake':
+        sqs_client.connect = FakeSQS()
+        sqs_client.reset()
+    elif not (AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY):
+        raise RuntimeError('AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY '
+                           'must be set unless sqs.backend is fake')
+
+
+# Messages from bursts of requests are sent in batches. Anything still
+# buffered when the worker exits is sent on the way out.
+sqs_sender = BatchSender(sqs_client, on_error=fail_unsent_jobs)
+atexit.register(sqs_sender.close)
+
+# Most job ids a client may poll for in one jobs_poll request.
+MAX_POLL_JOBS = 100
+
+# Scenes scene_options_ajax returns by default, and at most, per page.
+SCENE_LIMIT = 100
+MAX_SCENE_LIMIT = 1000
+
+# Format of the acquisition date in scene list cursors.
+CURSOR_DATE = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Scene and bands of a job, kept by status streams.
+Bands = namedtuple('Bands', ['entityid', 'band1', 'band2', 'band3'])
+
 # Requests are passed into appropriate queues, as defined here.
 
 COMPOSITE_QUEUE = 'snapsat_composite_queue'
@@ -83,39 +141,35 @@ def add_to_queue(request, rendertype):
     band2 = request.params.get('band2')
     band3 = request.params.get('band3')
     scene_id = request.matchdict['scene_id']
-    available = RenderCache.composite_availability(scene_id,
-                                                   band1, band2, band3,
-                                                   rendertype)
-
-    if available:
-        # if this scene/band has already been requested, increase the count
-        RenderCache.update_render_count(scene_id, 
-                                        band1, band2, band3,
-                                        rendertype)
-
-    if not available:
-        SQSconn = make_SQS_connection(REGION,
-                                      AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
-
-        if rendertype == u'preview':
-            current_queue = get_queue(SQSconn, PREVIEW_QUEUE)
-            email = None
-        elif rendertype == u'full':
-            current_queue = get_queue(SQSconn, COMPOSITE_QUEUE)
-            email = request.params.get('email_address')
-
-        jobid = UserJob.new_job(entityid=scene_id,
-                                band1=band1, band2=band2, band3=band3,
-                                rendertype=rendertype, email=email)
 
+    # Count the request and look the composite up in one statement.
+    composite = RenderCache.hit(scene_id, band1, band2, band3, rendertype)
+
+    # Rendered or rendering composites need no new job.
+    if composite is not None and composite.jobstatus != 10:
+        return composite.jobid
+
+    if rendertype == u'preview':
+        current_queue = PREVIEW_QUEUE
+        email = None
+    elif rendertype == u'full':
+        current_queue = COMPOSITE_QUEUE
+        email = request.params.get('email_address')
+
+    # Only the request that creates the job enqueues it; identical
+    # requests made while it renders attach to the same job.
+    jobid, created = RenderCache.claim(scene_id,
+                                       band1, band2, band3,
+                                       rendertype, email,
+                                       existing=composite)
+
+    if created:
         message = build_job_message(job_id=jobid,
                                     scene_id=scene_id,
                                     band_1=band1, band_2=band2, band_3=band3)
 
-        send_message(SQSconn,
-                     current_queue,
-                     message['body'], message['attributes'])
-        return jobid
+        sqs_sender.put(current_queue, message['body'], message['attributes'])
+    return jobid
 
 
 @view_config(route_name='request', renderer='json')
@@ -191,7 +245,7 @@ def scene(request):
     # Populate composites dictionary with one dictionary per band combination
     if rendered_rendering_composites:
         # Loop through list of rendered or rendering composites
-        for composite in rendered_rendering_composites:
+        for composite, job in rendered_rendering_composites:
             # Get band combination and create string for dictionary key
             band_combo = '{}{}{}'.format(composite.band1,
                                          composite.band2,
@@ -204,7 +258,7 @@ def scene(request):
                                                 'band3': composite.band3}})
 
             # Build dictionary of composites
-            composites = build_composites_dict(composite,
+            composites = build_composites_dict(composite, job,
                                                composites,
                                                band_combo)
 
@@ -244,10 +298,10 @@ def scene_band(request):
     # Populate composites dictionary with one dictionary per band combination
     if rendered_rendering_composites:
         # Loop through list of rendered or rendering composites
-        for composite in rendered_rendering_composites:
+        for composite, job in rendered_rendering_composites:
 
             # Build dictionary of composites
-            composites = build_composites_dict(composite,
+            composites = build_composites_dict(composite, job,
                                                composites,
                                                band_combo)
 
@@ -263,8 +317,13 @@ def scene_band(request):
     return {'meta_data': meta_data, 'composites': composites}
 
 
-def build_composites_dict(composite, composites, band_combo):
-    """Return dictionary of composites that are rendering or rendered."""
+def build_composites_dict(composite, job, composites, band_combo):
+    """
+    Return dictionary of composites that are rendering or rendered.
+
+    The job is the UserJob row of the composite, loaded in the same query
+    as the composite.
+    """
 
     # If band combination dictionary is not in composites dictionary,
     # add it and initialize it with band values
@@ -276,8 +335,7 @@ def build_composites_dict(composite, composites, band_combo):
     # For full render of a band combination that is currently being
     # rendered update dictionary with status and elapsed time.
     if composite.currentlyrend and composite.rendertype == u'full':
-        job_status, start_time, last_modified = (
-            UserJob.job_status_and_times(composite.jobid))
+        job_status, start_time, last_modified = job_status_and_times(job)
         elapsed_time = str(datetime.utcnow() - start_time)
         composites[band_combo].update({'fulljobid': composite.jobid,
                                        'fullurl': False,
@@ -287,7 +345,7 @@ def build_composites_dict(composite, composites, band_combo):
     # For preview render of a band combination that is currently being
     # rendered update dictionary with status.
     if composite.currentlyrend and composite.rendertype == u'preview':
-        job_status = UserJob.job_status(composite.jobid)
+        job_status = job_status_tuple(job)
         composites[band_combo].update({'previewjobid': composite.jobid,
                                        'previewurl': False,
                                        'previewstatus': job_status})
@@ -295,8 +353,7 @@ def build_composites_dict(composite, composites, band_combo):
     # For full render of a band combination that has been rendered,
     # update dictionary with status and elapsed time.
     if not composite.currentlyrend and composite.rendertype == u'full':
-        job_status, start_time, last_modified = (
-            UserJob.job_status_and_times(composite.jobid))
+        job_status, start_time, last_modified = job_status_and_times(job)
         elapsed_time = str(datetime.utcnow() - start_time)
         composites[band_combo].update({'fulljobid': composite.jobid,
                                        'fullurl': composite.renderurl,
@@ -306,7 +363,7 @@ def build_composites_dict(composite, composites, band_combo):
     # For preview render of a band combination that has been rendered,
     # update dictionary with status.
     if not composite.currentlyrend and composite.rendertype == u'preview':
-        job_status = UserJob.job_status(composite.jobid)
+        job_status = job_status_tuple(job)
         composites[band_combo].update({'previewjobid': composite.jobid,
                                        'previewurl': composite.renderurl,
                                        'previewstatus': job_status})
@@ -314,6 +371,19 @@ def build_composites_dict(composite, composites, band_combo):
     return composites
 
 
+def job_status_and_times(job):
+    """Return status and times of a job, as UserJob.job_status_and_times."""
+    return status_key[job.jobstatus], job.starttime, job.lastmodified
+
+
+def job_status_tuple(job):
+    """Return status, sceneid and bands of a job, as UserJob.job_status."""
+    if job is None:
+        return None
+    return (status_key[job.jobstatus],
+            job.entityid, job.band1, job.band2, job.band3)
+
+
 def build_meta_data(scene_id, meta_data_list):
     """Return dictionary of meta data for a given sceneid."""
 
@@ -348,58 +418,132 @@ def scene_options_ajax(request):
     # lat/lng provided from the user. Then, populate a list with
     # the information relevant to our view.
 
-    path_row_list = Paths.pathandrow(lat, lng)
+    path_row_list = wrs2.pathandrow(lat, lng)
 
     # Check for zero length path row list to prevent return of all path row
     # combinations n ithe world.
     if not path_row_list:
         return {'scenes': []}
 
-    scenes = PathRow.scenelist(path_row_list)
-    sceneList = []
-    times = 0
-    for i, scene in enumerate(scenes):
-        sceneList.append({
+    # Nearby map centers resolve to the same path/rows, so the response is
+    # cached on the set of path/rows and the filters rather than on lat/lng.
+    pathrows = frozenset((x.path, x.row) for x in path_row_list)
+    filters = scene_filters(request)
+    key = (pathrows, tuple(sorted(filters.items())))
+    response = cache.scene_options_cache.get(key)
+    if response is None:
+        generation = cache.scene_options_cache.generation
+        scenes = PathRow.scenelist(path_row_list, **filters).all()
+        groups, headers = build_scene_groups(
+            scenes, PathRowSummary.for_pathrows(pathrows))
+        response = {'scenes': groups, 'groups': headers,
+                    'next': scene_cursor(scenes[-1])
+                    if len(scenes) == filters['limit'] else None}
+        cache.scene_options_cache.put(key, response, generation)
+
+    return response
+
+
+def scene_filters(request):
+    """
+    Return the scenelist filters requested: max_cloud percent, start and
+    end dates as YYYY-MM-DD, end included, limit, and the cursor of the
+    previous page. Raise bad request for malformed ones.
+    """
+    params = request.params
+    try:
+        filters = {'limit': int(params.get('limit', SCENE_LIMIT))}
+        if params.get('max_cloud'):
+            filters['max_cloud'] = float(params['max_cloud'])
+        if params.get('start'):
+            filters['start'] = datetime.strptime(params['start'], '%Y-%m-%d')
+        if params.get('end'):
+            filters['end'] = (datetime.strptime(params['end'], '%Y-%m-%d') +
+                              timedelta(days=1))
+        if params.get('cursor'):
+            acquisitiondate, entityid = params['cursor'].split('_', 1)
+            filters['after'] = (datetime.strptime(acquisitiondate,
+                                                  CURSOR_DATE),
+                                unicode(entityid))
+    except ValueError:
+        raise exc.HTTPBadRequest()
+    if not 0 < filters['limit'] <= MAX_SCENE_LIMIT:
+        raise exc.HTTPBadRequest()
+    return filters
+
+
+def scene_cursor(scene):
+    """
+    Return the cursor of the page after scene.
+    """
+    return '{}_{}'.format(scene.acquisitiondate.strftime(CURSOR_DATE),
+                          scene.entityid)
+
+
+def build_scene_groups(scenes, summaries):
+    """
+    Return scenes grouped by path/row, newest first, and a header for each
+    group from its path_row_summary row. Scenes must come newest first.
+    """
+    groups = []
+    headers = []
+    # sorted is stable, so each group stays newest first.
+    for pathrow, group in itertools.groupby(
+            sorted(scenes, key=operator.attrgetter('path', 'row')),
+            operator.attrgetter('path', 'row')):
+        group = list(group)
+        summary = summaries.get(pathrow)
+        if summary is not None:
+            header = summary.header()
+        else:
+            # Not summarized yet, so average the scenes of this page.
+            header = {'path': pathrow[0], 'row': pathrow[1],
+                      'scenes': len(group),
+                      'average_time': average_time(
+                          sum(seconds_of_day(scene.acquisitiondate)
+                              for scene in group), len(group))}
+        headers.append(header)
+        groups.append([{
             'acquisitiondate': scene.acquisitiondate.strftime('%Y %m %d'),
-            'acquisitiontime': scene.acquisitiondate,
+            'acquisitiontime': scene.acquisitiondate.strftime('%H:%M:%S'),
             'cloudcover': scene.cloudcover,
             'download_url': scene.download_url,
             'entityid': scene.entityid,
             'sliced': scene.entityid[3:9],
             'path': scene.path,
-            'row': scene.row})
+            'row': scene.row,
+            'average_time': header['average_time']} for scene in group])
 
-    # This line may not be necessary.
-    sort = sorted(sceneList, key=operator.itemgetter('sliced'), reverse=False)
+    return groups, headers
 
-    # Sort the available scenes based on their Path, then Row.
-    outputList = []
-    for key, items in itertools.groupby(sort, operator.itemgetter('sliced')):
-        outputList.append(list(items))
 
-    # Sort the vailable scenes in each group by date in reverse.
-    for group in outputList:
-        group.sort(key=operator.itemgetter('acquisitiondate'), reverse=True)
+@view_config(route_name='cache_stats', renderer='json')
+def cache_stats(request):
+    """
+    Return hit/miss counters of this worker's response caches.
+    """
+    return {'scene_options': cache.scene_options_cache.stats()}
 
-    for group in outputList:
-        times = 0
-        for subgroup in group:
-            time_strtime = subgroup['acquisitiontime'].strftime('%H:%M:%S')
-            stripped_strtime = time.strptime(time_strtime.split(',')[0],
-                                             '%H:%M:%S')
-            times += timedelta(hours=stripped_strtime.tm_hour,
-                               minutes=stripped_strtime.tm_min,
-                               seconds=stripped_strtime.tm_sec
-                               ).total_seconds()
-            subgroup['acquisitiontime'] = time_strtime
 
-        average_seconds = times / len(group)
-        average_time = time.strftime('%H:%M', time.gmtime(average_seconds))
+@view_config(route_name='route_stats', renderer='json')
+def route_stats(request):
+    """
+    Return query counts and database time per route for this worker.
+    """
+    return profiling.route_stats.stats()
 
-        for subgroup in group:
-            subgroup['average_time'] = average_time
 
-    return {'scenes': outputList}
+@view_config(route_name='metrics', renderer='json')
+def job_metrics(request):
+    """
+    Return latency quantiles of every job stage by rendertype as JSON, or
+    the underlying histograms for Prometheus with ?format=prometheus.
+    """
+    rows = JobLatency.histograms()
+    if request.params.get('format') == 'prometheus':
+        return Response(metrics.prometheus_text(rows),
+                        content_type='text/plain', charset='utf-8')
+    return metrics.summary(rows)
 
 
 @view_config(route_name='status_poll', renderer='json')
@@ -456,3 +600,140 @@ def preview_poll(request):
                 'band3': band3}
 
     return {'job_info': job_info}
+
+
+@view_config(route_name='jobs_poll', renderer='json')
+def jobs_poll(request):
+    """
+    Poll database for the status of many render jobs at once.
+
+    Returns, per jobid, the fields of both status_poll and preview_poll.
+    """
+
+    # Get jobids from request
+    jobids = poll_jobids(request)
+    if not jobids:
+        return {'jobs': {}}
+
+    # Query the database for every job and its render url
+    jobs = UserJob.jobs_status(jobids) or []
+
+    now = datetime.utcnow()
+    jobs_info = {}
+    for job, render_url in jobs:
+        jobs_info[str(job.jobid)] = build_job_info(job.jobstatus,
+                                                   job.starttime, render_url,
+                                                   job, now)
+
+    return {'jobs': jobs_info}
+
+
+def poll_jobids(request):
+    """Return the set of jobids requested, or raise bad request."""
+    try:
+        jobids = set(int(jobid) for jobid in request.params.getall('jobid'))
+    except ValueError:
+        raise exc.HTTPBadRequest()
+    if len(jobids) > MAX_POLL_JOBS:
+        raise exc.HTTPBadRequest()
+    return jobids
+
+
+def build_job_info(jobstatus, start_time, render_url, job, now):
+    """
+    Return the job info reported to pollers and streams for a job with
+    the given status.
+    """
+    job_status = status_key[jobstatus]
+
+    # Only report the render url when job is done
+    if job_status != 'Done':
+        render_url = None
+
+    return {'jobstatus': job_status,
+            'elapsedtime': str(now - start_time),
+            'renderurl': render_url,
+            'scene_id': job.entityid,
+            'band1': job.band1,
+            'band2': job.band2,
+            'band3': job.band3}
+
+
+@view_config(route_name='status_stream')
+def status_stream(request):
+    """
+    Stream status transitions of the requested jobs as server-sent events.
+
+    Each open stream holds its connection, so this needs a cooperative
+    worker class. Transitions come from the worker's job feed rather than
+    from querying the database per client.
+    """
+    if jobfeed.feed is None:
+        raise exc.HTTPNotFound()
+
+    jobids = poll_jobids(request)
+
+    # Subscribe before reading the current status, so that no transition
+    # between the two is missed.
+    subscription = jobfeed.feed.subscribe(jobids)
+    try:
+        jobs = UserJob.jobs_status(jobids) or []
+        snapshot = [(job.jobid, job.jobstatus, job.starttime, render_url,
+                     Bands(job.entityid, job.band1, job.band2, job.band3))
+                    for job, render_url in jobs]
+    except:
+        jobfeed.feed.unsubscribe(subscription)
+        raise
+
+    response = Response(content_type='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.app_iter = job_events(
+        subscription, snapshot,
+        keepalive=int(request.registry.settings.get(
+            'job_stream.keepalive', 15)),
+        max_age=int(request.registry.settings.get(
+            'job_stream.max_age', 600)))
+    return response
+
+
+def job_events(subscription, snapshot, keepalive=15, max_age=600):
+    """
+    Yield server-sent events with the current status of every job in the
+    snapshot, then one per status transition until every job is done or
+    failed, or max_age seconds have passed.
+    """
+    try:
+        now = datetime.utcnow()
+        jobs = {}
+        for jobid, jobstatus, start_time, render_url, job in snapshot:
+            jobs[jobid] = [jobstatus, start_time, job]
+            yield job_event(jobid, build_job_info(jobstatus, start_time,
+                                                  render_url, job, now))
+
+        deadline = time.time() + max_age
+        while time.time() < deadline:
+            if all(jobstatus in jobfeed.FINAL_STATUSES
+                   for jobstatus, start_time, job in jobs.values()):
+                return
+
+            transition = subscription.get(keepalive)
+            if transition is None:
+                yield ': keepalive\n\n'
+                continue
+
+            jobid, jobstatus, render_url = transition
+            if jobid not in jobs or jobs[jobid][0] == jobstatus:
+                continue
+            jobs[jobid][0] = jobstatus
+            start_time, job = jobs[jobid][1:]
+            yield job_event(jobid, build_job_info(jobstatus, start_time,
+                                                  render_url, job,
+                                                  datetime.utcnow()))
+    finally:
+        jobfeed.feed.unsubscribe(subscription)
+
+
+def job_event(jobid, job_info):
+    """Return a server-sent event for a job's info."""
+    return 'data: {}\n\n'.format(json.dumps({'jobid': jobid,
+                                               'job_info': job_info}))
@@ -0,0 +1,164 @@
+"""
+In-process spatial index of the descending-mode WRS-2 footprints.
+
+The index is built once per worker from the paths table and answers the same
+question as Paths.pathandrow without a round-trip to PostGIS: candidate
+footprints are found by bucketing their bounding boxes on a regular lon/lat
+grid, then confirmed with an exact point-in-polygon test.
+"""
+import math
+import threading
+from collections import namedtuple
+from pyramid.settings import asbool
+from models import Paths
+
+PathAndRow = namedtuple('PathAndRow', ['path', 'row'])
+
+# Grid cell size in degrees. WRS-2 footprints are roughly 2 by 2 degrees at
+# the equator, so most cells hold a handful of candidates.
+CELL_SIZE = 1.0
+
+_index = None
+_enabled = False
+_lock = threading.Lock()
+
+
+def parse_wkt(wkt):
+    """
+    Return a list of polygons, each a list of rings of (x, y) tuples, from a
+    POLYGON or MULTIPOLYGON (E)WKT string.
+    """
+    if ';' in wkt:
+        # Strip the SRID prefix of EWKT.
+        wkt = wkt.split(';', 1)[1]
+    ring_depth = 3 if wkt.lstrip().upper().startswith('MULTI') else 2
+
+    polygons = []
+    depth = 0
+    start = None
+    for i, char in enumerate(wkt):
+        if char == '(':
+            depth += 1
+            if depth == ring_depth - 1:
+                polygons.append([])
+            elif depth == ring_depth:
+                start = i + 1
+        elif char == ')':
+            if depth == ring_depth:
+                polygons[-1].append(
+                    [tuple(float(n) for n in point.split()[:2])
+                     for point in wkt[start:i].split(',')])
+            depth -= 1
+    return polygons
+
+
+def point_in_rings(x, y, rings):
+    """
+    Even-odd ray casting test of a point against a polygon's rings, so that
+    points inside holes are reported as outside.
+    """
+    inside = False
+    for ring in rings:
+        j = len(ring) - 1
+        for i in xrange(len(ring)):
+            xi, yi = ring[i]
+            xj, yj = ring[j]
+            if ((yi > y) != (yj > y) and
+                    x < (xj - xi) * (y - yi) / (yj - yi) + xi):
+                inside = not inside
+            j = i
+    return inside
+
+
+class WRS2Index(object):
+    """
+    Grid bucketed index of WRS-2 footprints.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.footprints = []
+        self.grid = {}
+
+    @classmethod
+    def from_rows(cls, rows, cell_size=CELL_SIZE):
+        """
+        Build an index from (path, row, wkt) rows.
+        """
+        index = cls(cell_size)
+        for path, row, wkt in rows:
+            index.add(path, row, wkt)
+        return index
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def add(self, path, row, wkt):
+        """
+        Add a footprint to the index.
+        """
+        for rings in parse_wkt(wkt):
+            xs = [x for x, y in rings[0]]
+            ys = [y for x, y in rings[0]]
+            bbox = (min(xs), min(ys), max(xs), max(ys))
+            position = len(self.footprints)
+            self.footprints.append((PathAndRow(path, row), bbox, rings))
+
+            min_cell = self._cell(bbox[0], bbox[1])
+            max_cell = self._cell(bbox[2], bbox[3])
+            for cx in xrange(min_cell[0], max_cell[0] + 1):
+                for cy in xrange(min_cell[1], max_cell[1] + 1):
+                    self.grid.setdefault((cx, cy), []).append(position)
+
+    def lookup(self, lat, lon):
+        """
+        Output path and row that contains lat lon.
+        """
+        x, y = float(lon), float(lat)
+        output = []
+        for position in self.grid.get(self._cell(x, y), ()):
+            pathrow, bbox, rings = self.footprints[position]
+            if not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+                continue
+            if point_in_rings(x, y, rings) and pathrow not in output:
+                output.append(pathrow)
+        return output
+
+    def __len__(self):
+        return len(self.footprints)
+
+
+def configure(settings):
+    """
+    Enable the index when wrs2.index is set in the app settings. The index
+    itself is loaded lazily, so each forked worker builds its own copy.
+    """
+    global _enabled, _index
+    _enabled = asbool(settings.get('wrs2.index', False))
+    _index = None
+
+
+def get_index():
+    """
+    Return the loaded index, or None when the index is disabled.
+    """
+    global _index
+    if not _enabled:
+        return None
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _index = WRS2Index.from_rows(Paths.footprints())
+    return _index
+
+
+def pathandrow(lat, lon):
+    """
+    Output path and row that contains lat lon, from the in-process index when
+    it is enabled and from PostGIS otherwise.
+    """
+    index = get_index()
+    if index is None:
+        return Paths.pathandrow(lat, lon)
+    return index.lookup(lat, lon)
@@ -7,9 +7,20 @@ def numCPUs():
     return os.sysconf("SC_NPROCESSORS_ONLN")
 
 workers = numCPUs() * 2 + 1
+# status_stream/ holds a connection open per subscribed client, which needs
+# a cooperative worker class rather than the default sync workers.
+worker_class = "gevent"
+worker_connections = 1000
 bind = "127.0.0.1:8000"
 pidfile = "/tmp/gunicorn-app.pid"
 backlog = 2048
 logfile = "/var/log/gunicorn-app.log"
 loglevel = "info"
 timeout = 120
+
+
+def post_fork(server, worker):
+    # Let psycopg2 wait on Postgres without blocking the worker's other
+    # greenlets.
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -13,7 +13,9 @@ requires = [
     'pyramid_chameleon',
     'pyramid_tm',
     'pyramid_jinja2',
-    'selenium'
+    'selenium',
+    'numpy',
+    'rasterio',
     ]
 
 setup(name='app',
@@ -40,5 +42,14 @@ setup(name='app',
       main = app:main
       [console_scripts]
       initialize_app_db = app.scripts.initializedb:main
+      bench_pathrow = app.scripts.bench_pathrow:main
+      bench_new_job = app.scripts.bench_new_job:main
+      explain_check = app.scripts.explain_check:main
+      worker = app.scripts.worker:main
+      bench_render = app.scripts.bench_render:main
+      bench_scheduler = app.scripts.bench_scheduler:main
+      bench_web = app.scripts.bench_web:main
+      load_stack = app.scripts.load_stack:main
+      ingest_scenes = app.scripts.ingest_scenes:main
       """,
       )
@@ -1,91 +1,190 @@
-from locust import HttpLocust, TaskSet, task
-# from bs4 import BeautifulSoup
+"""
+Load model of snapsat users, for locust.
+
+Users pan the map, open scene and composite pages, request previews and
+full renders through request/{rendertype}/{scene_id}/, and then watch
+their jobs the way the page scripts in static/js/longpoll.js do: one loop
+polls jobs_poll/ for previews every second while another polls it for
+full renders every ten seconds, until the jobs finish or the user leaves.
+A share of users run the older page scripts, which poll preview_poll/ and
+status_poll/ once per job instead.
+
+Paths are reported to locust by route, so the numbers line up with the
+route_stats/ counters. Random choices are seeded per user, so runs are
+reproducible for a given number of users.
+
+Start a stack to run it against with load_stack (see app/app/scripts/
+load_stack.py), which serves synthetic scenes around CENTER.
+"""
+import re
 import random
-import json
-# import urllib3
-# urllib3.disable_warnings()
-lat = 47.614848
-lng = -122.3359059
+import itertools
+import gevent
+from locust import HttpLocust, TaskSet, task
+
+# Map pans stay within PAN degrees of Seattle.
+CENTER = (47.614848, -122.3359059)
+PAN = 2.0
+
+BANDS = [1, 2, 3, 4, 5, 6, 7, 9]
+
+# Poll intervals of static/js/longpoll.js, in seconds.
+PREVIEW_POLL = 1
+FULL_POLL = 10
+
+# Seconds a user stays on a page watching its jobs.
+PAGE_SECONDS = 60
+
+# Share of users whose browsers run the per-job poll loops.
+LEGACY_SHARE = 0.2
+
+PREVIEW_IDS = re.compile(r"class='js-nopreview' id='(\d+)'")
+FULL_IDS = re.compile(r"class='js-nofull' id='(\d+)'")
+
+seeds = itertools.count()
 
 
 class UserBehavior(TaskSet):
-    """Class defining snapsat user behavior/tasks."""
-    @task(1)
-    def index(self):
-        """User goes to main page."""
-        self.client.get("/")
+    """
+    One browser session.
+    """
+
+    def on_start(self):
+        self.rand = random.Random(next(seeds))
+        self.legacy = self.rand.random() < LEGACY_SHARE
+        self.lat, self.lng = CENTER
+        self.scenes = []
+        self.client.get('/', name='index')
+        self.pan()
+
+    def pan(self):
+        """
+        Move the map a little and list the scenes under its center.
+        """
+        self.lat = min(max(self.lat + self.rand.uniform(-0.5, 0.5),
+                           CENTER[0] - PAN), CENTER[0] + PAN)
+        self.lng = min(max(self.lng + self.rand.uniform(-0.5, 0.5),
+                           CENTER[1] - PAN), CENTER[1] + PAN)
+        response = self.client.get('/scene_options_ajax/',
+                                   params={'lat': self.lat, 'lng': self.lng},
+                                   name='scene_options_ajax')
+        if response.ok:
+            self.scenes = [scene['entityid']
+                           for group in response.json()['scenes']
+                           for scene in group]
+
+    def scene_id(self):
+        if not self.scenes:
+            self.pan()
+        return self.rand.choice(self.scenes) if self.scenes else None
+
+    def bands(self):
+        return self.rand.sample(BANDS, 3)
+
+    def open_page(self, url, name):
+        """
+        Load a page and watch the jobs it shows as pending.
+        """
+        response = self.client.get(url, name=name)
+        if response.ok:
+            self.watch(PREVIEW_IDS.findall(response.text),
+                       FULL_IDS.findall(response.text))
+
+    def watch(self, preview_ids, full_ids):
+        """
+        Run the page's poll loops side by side until they are done.
+        """
+        if self.legacy:
+            loops = ([gevent.spawn(self.poll_one, '/preview_poll/',
+                                   'preview_poll', jobid, PREVIEW_POLL)
+                      for jobid in preview_ids] +
+                     [gevent.spawn(self.poll_one, '/status_poll/',
+                                   'status_poll', jobid, FULL_POLL)
+                      for jobid in full_ids])
+        else:
+            loops = [gevent.spawn(self.poll_jobs, preview_ids, PREVIEW_POLL),
+                     gevent.spawn(self.poll_jobs, full_ids, FULL_POLL)]
+        gevent.joinall(loops)
+
+    def poll_jobs(self, jobids, interval):
+        pending = list(jobids)
+        for _ in xrange(PAGE_SECONDS // interval):
+            if not pending:
+                return
+            gevent.sleep(interval)
+            response = self.client.get('/jobs_poll/',
+                                       params={'jobid': pending},
+                                       name='jobs_poll')
+            if not response.ok:
+                continue
+            jobs = response.json()['jobs']
+            pending = [jobid for jobid in pending
+                       if jobs.get(jobid, {}).get('jobstatus')
+                       not in ('Done', 'Failed')]
+
+    def poll_one(self, url, name, jobid, interval):
+        for _ in xrange(PAGE_SECONDS // interval):
+            gevent.sleep(interval)
+            response = self.client.get(url, params={'jobid': jobid},
+                                       name=name)
+            if not response.ok:
+                continue
+            info = response.json()
+            status = info.get('job_info', info).get('jobstatus')
+            if status in ('Done', 'Failed'):
+                return
+
+    @task(10)
+    def map_pan(self):
+        self.pan()
+
+    @task(4)
+    def scene_page(self):
+        scene_id = self.scene_id()
+        if scene_id:
+            self.open_page('/scene/{}/'.format(scene_id), 'scene')
+
+    @task(2)
+    def composite_page(self):
+        scene_id = self.scene_id()
+        if scene_id:
+            self.open_page('/scene/{}/bands/{}/'.format(
+                scene_id, ''.join(str(band) for band in self.bands())),
+                'scene_band')
+
+    def request_render(self, rendertype):
+        scene_id = self.scene_id()
+        if not scene_id:
+            return
+        band1, band2, band3 = self.bands()
+        referer = '{}/scene/{}/'.format(self.locust.host, scene_id)
+        response = self.client.post(
+            '/request/{}/{}/'.format(rendertype, scene_id),
+            data={'band1': band1, 'band2': band2, 'band3': band3},
+            headers={'Referer': referer}, allow_redirects=False,
+            name='request')
+        if response.status_code == 302:
+            # The browser follows the redirect to the page of the job.
+            if rendertype == 'preview':
+                self.open_page('/scene/{}/'.format(scene_id), 'scene')
+            else:
+                self.open_page('/scene/{}/bands/{}{}{}/'.format(
+                    scene_id, band1, band2, band3), 'scene_band')
+
+    @task(3)
+    def request_preview(self):
+        self.request_render('preview')
 
     @task(1)
-    def create(self):
-        """User goes to create page."""
-        self.client.get("/create")
-
-    @task(5)
-    class SubTaskCreate(TaskSet):
-        """Class defining user behavior on create page."""
-        def on_start(self):
-            """Send post request simulating map movement."""
-            self.lat = random.uniform(-1, 1) + lat
-            self.lng = random.uniform(-1, 1) + lng
-            print self.lat, self.lng
-            self.response = self.client.post(
-                                        url="/scene_options_ajax",
-                                        data={'lat': self.lat, 'lng': self.lng}
-                                             )
-
-        @task(10)
-        def map_move(self):
-            """Method defining random map movement."""
-            self.lat = random.uniform(-1, 1) + lat
-            self.lng = random.uniform(-1, 1) + lng
-            self.response = self.client.post(
-                                        url="/scene_options_ajax",
-                                        data={'lat': self.lat, 'lng': self.lng}
-                                             )
-
-        # @task(3)
-        # def preview(self):
-        #     """Request preview for random scene."""
-        #     self.map_move()
-        #     json_scenes = json.loads(self.response.text)["scenes"][0]
-        #     num_scenes = len(json_scenes) - 1
-        #     if num_scenes > 0:
-        #         random_num = random.randint(0, num_scenes)
-        #         random_url = json_scenes[random_num]["download_url"]
-        #         self.client.get(random_url)
-        #         scene_id = json_scenes[random_num]["entityid"]
-        #         band1, band2, band3 = self.random_bands()
-        #         url = "/request_preview/{}".format(scene_id)
-        #         self.client.post(url=url, data={'band1': band1,
-        #                                         'band2': band2,
-        #                                         'band3': band3})
-
-        # @task(2)
-        # def full(self):
-        #     """Request full render for random scene."""
-        #     self.map_move()
-        #     json_scenes = json.loads(self.response.text)["scenes"][0]
-        #     num_scenes = len(json_scenes) - 1
-        #     if num_scenes > 0:
-        #         random_num = random.randint(0, num_scenes)
-        #         random_url = json_scenes[random_num]["download_url"]
-        #         self.client.get(random_url)
-        #         scene_id = json_scenes[random_num]["entityid"]
-        #         band1, band2, band3 = self.random_bands()
-        #         url = "/request_composite/{}".format(scene_id)
-        #         self.client.post(url=url, data={'band1': band1,
-        #                                         'band2': band2,
-        #                                         'band3': band3})
-
-        @task(1)
-        def stop(self):
-            """Stop class."""
-            self.interrupt()
-
-        def random_bands(self):
-            """Return 3 random bands (non-repeating) from possible bands."""
-            choices = [1, 2, 3, 4, 5, 6, 7, 9]
-            return random.sample(choices, 3)
+    def request_full(self):
+        self.request_render('full')
+
+    @task(2)
+    def leave(self):
+        """
+        Start a new session.
+        """
+        self.interrupt()
 
 
 class WebsiteUser(HttpLocust):